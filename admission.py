@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, HTTPException, Request
+
+from auth import get_current_user
+from config import RATE_LIMITS, RATE_LIMIT_MAX_KEYS, WRITE_CONCURRENCY, WRITE_QUEUE_LIMIT, WRITE_QUEUE_SECONDS
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Admission control in front of the single SQLite writer. Two layers, both
+# answering before any SQL runs:
+#
+#   rate limits   a token bucket per Telegram user (per client IP before there
+#                 is a token, /init and /bootstrap) for every limited route,
+#                 budgets in RATE_LIMITS; over budget is 429 with Retry-After
+#   write slots   at most WRITE_CONCURRENCY write requests per worker run at
+#                 once; up to WRITE_QUEUE_LIMIT more wait WRITE_QUEUE_SECONDS
+#                 for a slot, the rest are shed with 503 and Retry-After
+#
+# A retry loop in a broken webview thus gets 429s from memory, and a write
+# storm is shed at the door instead of piling up on busy_timeout and ending
+# in "database is locked" 500s. Both are per worker process.
+#
+#   @router.post("/place-bet", dependencies=[Depends(admission.per_user("place_bet")), Depends(admission.write_slot)])
+
+class RateLimiter:
+    def __init__(self, name: str, per_minute: float, burst: float):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.burst = max(burst, 1.0)
+        self._buckets = OrderedDict()  # key -> (tokens, updated), least recently used first
+
+    def acquire(self, key) -> float:
+        # Takes a token for key; returns 0 when admitted, otherwise seconds until one is available
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > RATE_LIMIT_MAX_KEYS:
+            self._buckets.popitem(last=False)
+        return wait
+
+def _admit(limiter: RateLimiter, key) -> None:
+    wait = limiter.acquire(key)
+    if wait:
+        metrics.admission_rejections.inc((limiter.name, "rate_limit"))
+        logger.info("Rate limit on %s for %s, retry in %.1fs", limiter.name, key, wait,
+                    extra={"sample_rate": 0.1})
+        raise HTTPException(status_code=429, detail="Too many requests",
+                            headers={"Retry-After": str(math.ceil(wait))})
+
+def per_user(name: str):
+    # Dependency limiting a route per Telegram user; get_current_user is
+    # resolved once per request, shared with the route's own Depends
+    limiter = RateLimiter(name, *RATE_LIMITS[name])
+
+    async def dependency(user: dict = Depends(get_current_user)):
+        _admit(limiter, user['id'])
+    return dependency
+
+def per_ip(name: str):
+    # Dependency limiting a route per client address, for routes called before there is a token
+    limiter = RateLimiter(name, *RATE_LIMITS[name])
+
+    async def dependency(request: Request):
+        _admit(limiter, request.client.host if request.client else None)
+    return dependency
+
+class WriteGate:
+    def __init__(self, limit: int, queue_limit: int, timeout: float):
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.waiting = 0
+        self._semaphore = None
+        self._loop = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Bound to the running loop on first use, like the scheduler's Event
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.limit)
+            self._loop = loop
+            self.waiting = 0
+        return self._semaphore
+
+    def _shed(self, reason: str) -> HTTPException:
+        metrics.admission_rejections.inc(("write", reason))
+        logger.warning("Shedding write request: %s (%d waiting)", reason, self.waiting)
+        return HTTPException(status_code=503, detail="Server busy, try again",
+                             headers={"Retry-After": str(math.ceil(self.timeout))})
+
+    @asynccontextmanager
+    async def slot(self):
+        semaphore = self._get_semaphore()
+        if semaphore.locked() and self.waiting >= self.queue_limit:
+            raise self._shed("queue_full")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise self._shed("queue_timeout")
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+write_gate = WriteGate(WRITE_CONCURRENCY, WRITE_QUEUE_LIMIT, WRITE_QUEUE_SECONDS)
+
+async def write_slot():
+    # Dependency holding a write slot for the rest of the request
+    async with write_gate.slot():
+        yield
@@ -1,26 +1,87 @@
+import argparse
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
 import uvicorn
-from sqlalchemy.orm import Session
 
 from routes import router
-from config import logger
+from shell import ShellStaticFiles, get_shell
+from metrics import MetricsMiddleware
+from scheduler import scheduler
+from notifications import dispatcher
+import roles
+import events
+from db import init_db, run_db, db_executor
+from auth import webapp_secret_key
+from config import (SERVER_HOST, SERVER_PORT, SERVER_WORKERS, SERVER_GRACEFUL_SHUTDOWN_SECONDS,
+                    SSL_KEYFILE, SSL_CERTFILE)
+import queries
+
+logger = logging.getLogger(__name__)
+
+# Everything with side effects happens here, once per worker process, rather
+# than at import: the engine, schema check and role sets, the bot secret, the
+# built mini app shell and the reference lists are ready before the first request.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # init_db() may wait for another worker's schema upgrade, off the event loop
+    app.state.engine = await asyncio.get_running_loop().run_in_executor(db_executor, init_db)
+    webapp_secret_key()
+    get_shell()
+    await run_db(queries.list_tournaments)
+    await run_db(queries.list_teams)
+    # Locks betting on matches at kickoff for as long as the app runs
+    scheduler.start()
+    # Sends queued Telegram notifications in the background
+    dispatcher.start()
+    # Picks up role changes made by other workers or the roles.py CLI
+    roles.cache.start()
+    # Relays /events to the clients of the other workers
+    events.bus.start()
+    logger.info("Worker ready")
+    yield
+    await scheduler.stop()
+    await dispatcher.stop()
+    await roles.cache.stop()
+    await events.bus.stop()
+    app.state.engine.dispose()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
-# Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Per-route request, latency and SQL statement metrics, served on /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Mount static files, including the hashed mini app assets built in memory
+app.mount("/static", ShellStaticFiles(directory="static"), name="static")
 
 # Include routes
 app.include_router(router)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the daggybot mini app server")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--no-ssl", action="store_true", help="serve plain HTTP, e.g. behind a proxy")
+    parser.add_argument("--reload", action="store_true", help="development mode: one worker, reload on changes")
+    args = parser.parse_args()
+
+    # Workers share the Bot API send rate, see notifications.py
+    os.environ["SERVER_WORKERS"] = str(1 if args.reload else args.workers)
+    ssl = {} if args.no_ssl else {"ssl_keyfile": SSL_KEYFILE, "ssl_certfile": SSL_CERTFILE}
     uvicorn.run(
         "app:app",
-        host="0.0.0.0",
-        port=5000,
-        ssl_keyfile="/etc/ssl/daggybot.bet/mydomain.key",
-        ssl_certfile="/etc/ssl/daggybot.bet/daggybot_bet.crt",
-        reload=True
-    )
\ No newline at end of file
+        host=args.host,
+        port=args.port,
+        workers=1 if args.reload else args.workers,
+        reload=args.reload,
+        # uvloop and httptools when installed, asyncio and h11 otherwise
+        loop="auto",
+        http="auto",
+        timeout_graceful_shutdown=SERVER_GRACEFUL_SHUTDOWN_SECONDS,
+        **ssl
+    )
@@ -0,0 +1,245 @@
+import argparse
+import json
+import logging
+import sys
+from datetime import datetime
+
+from fastapi import HTTPException
+from sqlalchemy import delete, func, insert, literal, select
+from sqlalchemy.orm import Session, aliased
+
+from db import (init_db, SessionLocal, Tournament, Team, User, Match, Bet, Participation, Standing, Change,
+                MatchBetStat, TournamentArchive, ArchivedMatch, ArchivedBet, ArchivedParticipation)
+from config import ARCHIVE_CACHE_SIZE
+from cache import reference_cache, bump_generation, GenerationCache
+
+logger = logging.getLogger(__name__)
+
+# Archival of finished tournaments. Archiving moves the tournament's matches,
+# bets and participations into the archived_* tables in one transaction and
+# writes a tournament_archives row with the totals and the final table, so the
+# live tables and their indexes only hold the active set. compact() runs
+# VACUUM and ANALYZE to return the freed pages and refresh planner statistics.
+# VACUUM holds the write lock until the whole file is rewritten, so it never
+# runs inside a request: schedule it for a quiet hour.
+#
+#   python archive.py archive 3        (or POST /archive-tournament as admin)
+#   python archive.py list
+#   python archive.py compact          (or archive 3 --compact)
+#
+# The archived tournament leaves /tournaments and /available-tournaments, its
+# participants get a participation tombstone in the change log so /sync makes
+# their clients reload. Archived data is read-only and served by
+# /archived-tournaments, /archived-standings and /archived-matches.
+
+def archive_tournament(db: Session, tournament_id: int) -> dict:
+    tournament = db.get(Tournament, tournament_id)
+    if tournament is None:
+        raise HTTPException(status_code=404, detail="Tournament not found")
+    if tournament.archived_at is not None:
+        raise HTTPException(status_code=409, detail="Tournament is already archived")
+    unfinished = db.execute(
+        select(func.count()).select_from(Match)
+        .where(Match.tournament_id == tournament_id, Match.is_finished.isnot(True))
+    ).scalar()
+    if unfinished:
+        raise HTTPException(status_code=409, detail=f"Tournament has {unfinished} unfinished match(es)")
+
+    table = db.execute(
+        select(Standing.rank, Standing.points, Standing.user_id, User.name)
+        .join(User, User.id == Standing.user_id)
+        .where(Standing.tournament_id == tournament_id)
+        .order_by(Standing.rank, Standing.user_id)
+    ).all()
+    match_ids = select(Match.id).where(Match.tournament_id == tournament_id).scalar_subquery()
+    now = datetime.utcnow()
+
+    matches = db.execute(insert(ArchivedMatch).from_select(
+        ['id', 'tournament_id', 'team_1_id', 'team_2_id', 'start_time_utc', 'score_1', 'score_2'],
+        select(Match.id, Match.tournament_id, Match.team_1_id, Match.team_2_id,
+               Match.start_time_utc, Match.score_1, Match.score_2)
+        .where(Match.tournament_id == tournament_id)
+    )).rowcount
+    bets = db.execute(insert(ArchivedBet).from_select(
+        ['id', 'user_id', 'match_id', 'score_1', 'score_2', 'points'],
+        select(Bet.id, Bet.user_id, Bet.match_id, Bet.score_1, Bet.score_2, Bet.points)
+        .where(Bet.match_id.in_(match_ids))
+    )).rowcount
+    db.execute(insert(ArchivedParticipation).from_select(
+        ['id', 'user_id', 'tournament_id', 'approved'],
+        select(Participation.id, Participation.user_id, Participation.tournament_id, Participation.approved)
+        .where(Participation.tournament_id == tournament_id)
+    ))
+    # One tombstone per participant: /sync answers reset=True and the client reloads without the tournament
+    db.execute(insert(Change).from_select(
+        ['entity', 'entity_id', 'tournament_id', 'user_id', 'deleted', 'created_at'],
+        select(literal('participation'), literal(tournament_id), literal(tournament_id),
+               Participation.user_id, literal(True), literal(now))
+        .where(Participation.tournament_id == tournament_id, Participation.approved == True)
+    ))
+
+    for stmt in (
+        delete(MatchBetStat).where(MatchBetStat.match_id.in_(match_ids)),
+        delete(Bet).where(Bet.match_id.in_(match_ids)),
+        delete(Standing).where(Standing.tournament_id == tournament_id),
+        delete(Participation).where(Participation.tournament_id == tournament_id),
+        delete(Match).where(Match.tournament_id == tournament_id),
+    ):
+        db.execute(stmt.execution_options(synchronize_session=False))
+
+    db.add(TournamentArchive(
+        tournament_id=tournament_id,
+        archived_at=now,
+        matches=matches,
+        bets=bets,
+        participants=len(table),
+        standings=json.dumps([list(row) for row in table], ensure_ascii=False),
+    ))
+    tournament.archived_at = now
+    bump_generation(db, 'tournaments')
+    bump_generation(db, 'archives')
+    # Cached distributions of the moved matches
+    bump_generation(db, 'bet_stats')
+    db.commit()
+
+    logger.info("Archived tournament %s: %d matches, %d bets, %d participants",
+                tournament_id, matches, bets, len(table))
+    return {"tournament_id": tournament_id, "matches": matches, "bets": bets, "participants": len(table)}
+
+def _file_size(conn) -> int:
+    return (conn.exec_driver_sql("PRAGMA page_count").scalar()
+            * conn.exec_driver_sql("PRAGMA page_size").scalar())
+
+def compact(db: Session) -> dict:
+    # VACUUM cannot run inside a transaction, so it gets its own autocommit
+    # connection. It holds the write lock while it rewrites the file; in WAL
+    # mode readers carry on. Returns the file size before and after in bytes.
+    engine = db.get_bind()
+    if engine.dialect.name != "sqlite":
+        return {}
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        before = _file_size(conn)
+        conn.exec_driver_sql("VACUUM")
+        conn.exec_driver_sql("ANALYZE")
+        # VACUUM writes the new file through the WAL, truncate it to give the space back
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        after = _file_size(conn)
+    logger.info("Compacted the database from %d to %d bytes", before, after)
+    return {"bytes_before": before, "bytes_after": after}
+
+def _load_archives(db: Session) -> list:
+    rows = db.execute(
+        select(Tournament.id, Tournament.name_ru, TournamentArchive.archived_at,
+               TournamentArchive.matches, TournamentArchive.bets, TournamentArchive.participants)
+        .join(TournamentArchive, TournamentArchive.tournament_id == Tournament.id)
+        .order_by(TournamentArchive.archived_at.desc())
+    ).all()
+    return [
+        {"id": tournament_id, "name_ru": name, "archived_at": archived_at.isoformat(),
+         "matches": matches, "bets": bets, "participants": participants}
+        for tournament_id, name, archived_at, matches, bets, participants in rows
+    ]
+
+def list_archives(db: Session) -> list:
+    return reference_cache.get(db, 'archives', _load_archives)[1]
+
+_cache = GenerationCache('archives', ARCHIVE_CACHE_SIZE)
+
+def get_archive(db: Session, tournament_id: int) -> dict:
+    # The summary row with the final table parsed, None when not archived
+    generation, archive = _cache.get(db, tournament_id)
+    if archive is not None:
+        return archive
+    row = db.execute(
+        select(TournamentArchive, Tournament.name_ru)
+        .join(Tournament, Tournament.id == TournamentArchive.tournament_id)
+        .where(TournamentArchive.tournament_id == tournament_id)
+    ).first()
+    if row is None:
+        return None
+    summary, name = row
+    table = json.loads(summary.standings)
+    archive = {
+        "tournament_id": tournament_id,
+        "name_ru": name,
+        "archived_at": summary.archived_at.isoformat(),
+        "matches": summary.matches,
+        "bets": summary.bets,
+        "participants": summary.participants,
+        "table": [{"rank": rank, "points": points, "user_name": user_name} for rank, points, _, user_name in table],
+        "positions": {user_id: {"rank": rank, "points": points} for rank, points, user_id, _ in table},
+    }
+    _cache.set(tournament_id, generation, archive)
+    return archive
+
+def get_standings(db: Session, tournament_id: int, user_id: int, limit: int = 20) -> dict:
+    # Final table in the /standings format plus the totals, None when not archived
+    archive = get_archive(db, tournament_id)
+    if archive is None:
+        return None
+    return {
+        "tournament_id": tournament_id,
+        "name_ru": archive["name_ru"],
+        "archived_at": archive["archived_at"],
+        "matches": archive["matches"],
+        "bets": archive["bets"],
+        "total": archive["participants"],
+        "standings": archive["table"][:limit],
+        "me": archive["positions"].get(user_id),
+    }
+
+def list_matches(db: Session, tournament_id: int, user_id: int) -> list:
+    # Archived matches of a tournament with the user's own bet, by kickoff
+    Team1 = aliased(Team)
+    Team2 = aliased(Team)
+    rows = db.execute(
+        select(ArchivedMatch, Team1.name_ru, Team2.name_ru, ArchivedBet.score_1, ArchivedBet.score_2, ArchivedBet.points)
+        .join(Team1, ArchivedMatch.team_1_id == Team1.id)
+        .join(Team2, ArchivedMatch.team_2_id == Team2.id)
+        .outerjoin(ArchivedBet, (ArchivedBet.match_id == ArchivedMatch.id) & (ArchivedBet.user_id == user_id))
+        .where(ArchivedMatch.tournament_id == tournament_id)
+        .order_by(ArchivedMatch.start_time_utc, ArchivedMatch.id)
+    ).all()
+    return [
+        {
+            'id': match.id,
+            'tournament_id': match.tournament_id,
+            'team_1_name': team1_name,
+            'team_2_name': team2_name,
+            'date': match.start_time_utc.isoformat(),
+            'score_1': match.score_1,
+            'score_2': match.score_2,
+            'bet': {
+                'score_1': bet_score_1,
+                'score_2': bet_score_2,
+                'points': points
+            } if bet_score_1 is not None else None
+        }
+        for match, team1_name, team2_name, bet_score_1, bet_score_2, points in rows
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive finished tournaments")
+    sub = parser.add_subparsers(dest="command", required=True)
+    archive_parser = sub.add_parser("archive")
+    archive_parser.add_argument("tournament_id", type=int)
+    archive_parser.add_argument("--compact", action="store_true", help="run VACUUM and ANALYZE afterwards")
+    sub.add_parser("list")
+    sub.add_parser("compact")
+    args = parser.parse_args()
+
+    init_db()
+    with SessionLocal() as session:
+        if args.command == "list":
+            for entry in list_archives(session):
+                print(f"{entry['id']:>5}  {entry['archived_at'][:10]}  {entry['matches']:>5} matches  "
+                      f"{entry['bets']:>8} bets  {entry['participants']:>5} players  {entry['name_ru']}")
+        elif args.command == "archive":
+            try:
+                print(archive_tournament(session, args.tournament_id))
+            except HTTPException as e:
+                sys.exit(e.detail)
+            if args.compact:
+                print(compact(session))
+        else:
+            print(compact(session))
@@ -1,12 +1,20 @@
+import functools
+import logging
 from datetime import datetime, timedelta
 import jwt
 import hmac
 import hashlib
 import json
-from urllib.parse import unquote
+import time
+from urllib.parse import parse_qsl
 from fastapi import HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from config import JWT_SECRET, JWT_ALGORITHM, JWT_EXPIRATION, BOT_TOKEN, ADMIN_USERS, AUTHORIZED_USERS, logger
+from config import (JWT_SECRET, JWT_ALGORITHM, JWT_EXPIRATION, get_bot_token,
+                    INIT_DATA_MAX_AGE, INIT_DATA_CACHE_SIZE, JWT_CACHE_SIZE, EVENTS_TOKEN_SECONDS)
+from cache import TTLCache
+import roles
+
+logger = logging.getLogger(__name__)
 
 security = HTTPBearer()
 
@@ -15,74 +23,135 @@ def create_jwt_token(user_data: dict) -> str:
     payload["exp"] = datetime.utcnow() + timedelta(minutes=JWT_EXPIRATION)
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+def create_stream_token(user_data: dict) -> str:
+    # EventSource cannot send headers, so /events takes its token in the URL,
+    # where access and proxy logs see it. It gets a token of its own: valid
+    # for EVENTS_TOKEN_SECONDS and rejected everywhere else.
+    payload = {
+        "id": user_data["id"],
+        "uid": user_data["uid"],
+        "scope": "events",
+        "exp": datetime.utcnow() + timedelta(seconds=EVENTS_TOKEN_SECONDS),
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
 def verify_jwt_token(token: str) -> dict:
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         return payload
     except jwt.ExpiredSignatureError:
         return None
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         return None
 
-def verify_telegram_data(init_data: str) -> bool:
+# Derived once, on first use: the Mini Apps data check key is HMAC-SHA256("WebAppData", bot token)
+@functools.lru_cache(maxsize=None)
+def webapp_secret_key() -> bytes:
+    return hmac.new(b"WebAppData", get_bot_token().encode(), hashlib.sha256).digest()
+
+# sha256(initData) -> Telegram user for verified data, False for rejected data.
+# Verified entries expire together with auth_date, so a replay after
+# INIT_DATA_MAX_AGE fails again on the freshness check.
+_init_data_cache = TTLCache(INIT_DATA_CACHE_SIZE)
+INIT_DATA_REJECT_TTL = 60  # seconds
+
+def _check_init_data(init_data: str) -> tuple:
+    # Returns (user, expires_at) for valid initData, (None, 0) otherwise
     try:
-        logger.debug(f"Verifying Telegram data: {init_data}")
-        # Parse the init data
-        data = {k: unquote(v) for k, v in [s.split('=', 1) for s in init_data.split('&')]}
-        logger.debug(f"data: {data}")
-        
-        # Remove hash from data
-        received_hash = data.pop("hash", "")
-        logger.debug(f"received_hash: {received_hash}")
-        
-        # Sort data alphabetically
-        data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(data.items()))
-
-        logger.debug(f"data_check_string: {data_check_string}")
-
-        secret_key = hmac.new("WebAppData".encode(), BOT_TOKEN.encode(), hashlib.sha256).digest()
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()        
-        logger.debug(f"calculated_hash: {calculated_hash}")
-        
-        if calculated_hash == received_hash:
-            logger.debug("Telegram data verification successful")
-            return True
+        data = dict(parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+    except ValueError:
+        logger.warning("Telegram data verification failed: malformed initData")
+        return None, 0
+
+    received_hash = data.pop("hash", "")
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(data.items()))
+    calculated_hash = hmac.new(webapp_secret_key(), data_check_string.encode(), hashlib.sha256).hexdigest()
+    # Bytes on both sides: compare_digest raises TypeError for non-ASCII str
+    if not hmac.compare_digest(calculated_hash.encode(), received_hash.encode()):
         logger.warning("Telegram data verification failed: hash mismatch")
-        return False
-    except Exception as e:
-        logger.error(f"Error verifying Telegram data: {str(e)}", exc_info=True)
-        return False
+        return None, 0
 
-def parse_user_data(init_data: str) -> dict:
     try:
-        data = {k: unquote(v) for k, v in [s.split('=', 1) for s in init_data.split('&')]}
-        if "user" not in data:
-            logger.error(f"No \"user\" key info in init_data", exc_info=True)
-            return None
-
-        return json.loads(data["user"])
-    except Exception as e:
-        logger.error(f"Error pasring user_data from init_data: {str(e)}", exc_info=True)
-        return None
+        expires_at = int(data["auth_date"]) + INIT_DATA_MAX_AGE
+        user = json.loads(data["user"])
+    except (KeyError, ValueError):
+        logger.warning("Telegram data verification failed: missing auth_date or user")
+        return None, 0
+
+    if expires_at <= time.time():
+        logger.warning("Telegram data verification failed: auth_date is too old")
+        return None, 0
+    if not isinstance(user, dict) or not user.get("id"):
+        logger.warning("Telegram data verification failed: invalid user")
+        return None, 0
+    return user, expires_at
+
+def verify_init_data(init_data: str) -> dict:
+    # Single verification path for Telegram initData: returns the user dict
+    # or None when the data is forged, stale or malformed
+    key = hashlib.sha256(init_data.encode()).digest()
+    cached = _init_data_cache.get(key)
+    if cached is not None:
+        return cached or None
+
+    user, expires_at = _check_init_data(init_data)
+    if user is None:
+        _init_data_cache.set(key, False, time.time() + INIT_DATA_REJECT_TTL)
+    else:
+        _init_data_cache.set(key, user, expires_at)
+        logger.debug("Telegram data verification successful")
+    return user
+
+# Decoded tokens until their exp, so hot paths skip the PyJWT decode
+_token_cache = TTLCache(JWT_CACHE_SIZE)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    logger.debug("Verifying JWT token")
-    token = credentials.credentials
+    return user_from_token(credentials.credentials)
+
+def user_from_token(token: str) -> dict:
+    user_data = _token_cache.get(token)
+    if user_data is not None:
+        return _check_access(user_data)
+
     user_data = verify_jwt_token(token)
-    if user_data is None:
+    # Tokens issued before the internal user id was embedded must be renewed via /init,
+    # scoped tokens (see create_stream_token) are no session tokens
+    if user_data is None or "uid" not in user_data or "scope" in user_data:
         logger.warning("Invalid or expired JWT token")
         raise HTTPException(status_code=401, detail="Invalid or expired token")
-    logger.debug(f"JWT token verified for user_id: {user_data.get('id')}")
+    _token_cache.set(token, user_data, user_data["exp"])
+    logger.debug("JWT token verified for user_id: %s", user_data.get('id'), extra={"sample_rate": 0.01})
+    return _check_access(user_data)
+
+def user_from_stream_token(token: str) -> dict:
+    # Checked once when the stream opens, so the short lifetime does not cut it off
+    user_data = verify_jwt_token(token)
+    if user_data is None or user_data.get("scope") != "events":
+        logger.warning("Invalid or expired stream token")
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    return _check_access(user_data)
+
+def _check_access(user_data: dict) -> dict:
+    # Tokens outlive role changes, a revoked player is turned away at once
+    if not is_user_authorized(user_data['id']):
+        raise HTTPException(status_code=403, detail="Access revoked")
     return user_data
 
+async def require_admin(user: dict = Depends(get_current_user)) -> dict:
+    # Dependency for admin routes: a cached token and a set lookup, no query
+    if not is_user_admin(user['id']):
+        raise HTTPException(status_code=403, detail="Admin rights required")
+    return user
+
 def is_user_authorized(user_id: int) -> bool:
-    logger.debug(f"Checking authorization for user {user_id}")
-    is_authorized = user_id in AUTHORIZED_USERS
-    logger.debug(f"User {user_id} authorization status: {is_authorized}")
+    logger.debug("Checking authorization for user %s", user_id)
+    # Admins may always use the app
+    is_authorized = roles.cache.has(user_id, 'player') or roles.cache.has(user_id, 'admin')
+    logger.debug("User %s authorization status: %s", user_id, is_authorized)
     return is_authorized 
 
 def is_user_admin(user_id: int) -> bool:
-    logger.debug(f"Checking for user {user_id} is admin")
-    is_admin = user_id in ADMIN_USERS
-    logger.debug(f"User {user_id} admin status: {is_admin}")
+    logger.debug("Checking for user %s is admin", user_id)
+    is_admin = roles.cache.has(user_id, 'admin')
+    logger.debug("User %s admin status: %s", user_id, is_admin)
     return is_admin 
\ No newline at end of file
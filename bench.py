@@ -0,0 +1,327 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select, update
+
+# Load test for the API on a synthetic database.
+#
+#   python bench.py seed --db /tmp/bench.db --users 5000 --matches 20000 --bets 1000000
+#   python bench.py run --db /tmp/bench.db --clients 200 --duration 30 --out before.json
+#   python bench.py run --db /tmp/bench.db --url https://127.0.0.1:5000   (server started
+#       with DATABASE_URL=sqlite:////tmp/bench.db)
+#
+# `seed` fills a fresh database through the models in db.py with bulk inserts,
+# the same random seed always produces the same data. `run` mints tokens with
+# create_jwt_token for existing users and replays a match night: a read-heavy
+# phase (/user-matches, /sync, /standings) followed by a /place-bet burst on
+# the matches about to kick off. Latency percentiles and throughput per
+# endpoint are printed as JSON.
+#
+# In-process runs enter the app's lifespan like a worker does, so the kickoff
+# scheduler and the roles refresh run alongside the requests. The notification
+# dispatcher stays off unless NOTIFICATIONS_ENABLED=1 is set, with
+# TELEGRAM_API_URL pointing at fakebotapi.py: seeded users are not real chats.
+
+CHUNK = 10000
+
+def _chunks(rows, size=CHUNK):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+def seed(url: str, tournaments: int, users: int, teams: int, matches: int, bets: int,
+         per_user: int, rng: random.Random) -> dict:
+    from db import init_db, SessionLocal, Tournament, User, Team, Match, Bet, Participation, Role
+    from cache import bump_generation
+    import betstats
+    import roles
+    import settlement
+    import standings
+
+    engine = init_db(url)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    with SessionLocal() as db:
+        db.execute(insert(Tournament), [{"id": i, "name_ru": f"Турнир {i}"} for i in range(1, tournaments + 1)])
+        db.execute(insert(Team), [{"id": i, "name_ru": f"Команда {i}"} for i in range(1, teams + 1)])
+        for chunk in _chunks([{"id": i, "tg_id": 10**9 + i, "name": f"User {i}"} for i in range(1, users + 1)]):
+            db.execute(insert(User), chunk)
+        # Seeded users are players, otherwise every benchmark request is answered 403
+        db.execute(insert(Role), [{"tg_id": 10**9 + i, "role": "player", "name": "bench"} for i in range(1, users + 1)])
+        bump_generation(db, 'roles')
+
+        # Matches spread over +-60 days, a few kick off within the next hour
+        match_rows = []
+        matches_by_tournament = {t: [] for t in range(1, tournaments + 1)}
+        for match_id in range(1, matches + 1):
+            tournament_id = rng.randint(1, tournaments)
+            if match_id % 50 == 0:
+                start = now + timedelta(minutes=rng.randint(5, 60))
+            else:
+                start = now + timedelta(minutes=rng.randint(-60 * 24 * 60, 60 * 24 * 60))
+            team_1, team_2 = rng.sample(range(1, teams + 1), 2)
+            finished = start < now
+            match_rows.append({
+                "id": match_id,
+                "tournament_id": tournament_id,
+                "team_1_id": team_1,
+                "team_2_id": team_2,
+                "start_time_utc": start,
+                "score_1": rng.randint(0, 4) if finished else None,
+                "score_2": rng.randint(0, 4) if finished else None,
+                "is_finished": finished,
+                # As the scheduler left them, so it does not lock them all when the run starts
+                "locked": finished,
+                "reminded": finished,
+            })
+            matches_by_tournament[tournament_id].append(match_id)
+        for chunk in _chunks(match_rows):
+            db.execute(insert(Match), chunk)
+
+        participation_rows = []
+        user_tournaments = {}
+        for user_id in range(1, users + 1):
+            chosen = rng.sample(range(1, tournaments + 1), min(per_user, tournaments))
+            user_tournaments[user_id] = chosen
+            participation_rows.extend(
+                {"user_id": user_id, "tournament_id": t, "approved": True} for t in chosen
+            )
+        for chunk in _chunks(participation_rows):
+            db.execute(insert(Participation), chunk)
+
+        # Bets only on matches of the user's own tournaments, at most one per match
+        bets_per_user = max(1, bets // users)
+        bet_count = 0
+        bet_rows = []
+        for user_id in range(1, users + 1):
+            eligible = [m for t in user_tournaments[user_id] for m in matches_by_tournament[t]]
+            for match_id in rng.sample(eligible, min(bets_per_user, len(eligible))):
+                bet_rows.append({"user_id": user_id, "match_id": match_id,
+                                 "score_1": rng.randint(0, 3), "score_2": rng.randint(0, 3)})
+            if len(bet_rows) >= CHUNK:
+                db.execute(insert(Bet), bet_rows)
+                bet_count += len(bet_rows)
+                bet_rows = []
+        if bet_rows:
+            db.execute(insert(Bet), bet_rows)
+            bet_count += len(bet_rows)
+        db.commit()
+
+        # Score finished matches the way /finish-match does, then build the standings
+        for row in match_rows:
+            if row["is_finished"]:
+                rule = settlement.get_scoring_rule(db, row["tournament_id"])
+                db.execute(
+                    update(Bet)
+                    .where(Bet.match_id == row["id"])
+                    .values(points=settlement.bet_points_expr(row["score_1"], row["score_2"], rule))
+                    .execution_options(synchronize_session=False)
+                )
+        db.commit()
+        standings.rebuild(db)
+        betstats.rebuild(db)
+        roles.cache.reload(db)
+
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    engine.dispose()
+    return {"tournaments": tournaments, "users": users, "teams": teams, "matches": matches,
+            "participations": len(participation_rows), "bets": bet_count}
+
+def load_clients(url: str, count: int, rng: random.Random) -> list:
+    # (token, tournament ids, upcoming match ids) for a random sample of users
+    from db import init_db, SessionLocal, User, Match, Participation
+    from auth import create_jwt_token
+
+    engine = init_db(url)
+    now = datetime.utcnow()
+    clients = []
+    with SessionLocal() as db:
+        user_ids = db.execute(select(User.id)).scalars().all()
+        for user_id in rng.sample(user_ids, min(count, len(user_ids))):
+            user = db.get(User, user_id)
+            tournament_ids = db.execute(
+                select(Participation.tournament_id)
+                .where(Participation.user_id == user_id, Participation.approved == True)
+            ).scalars().all()
+            upcoming = db.execute(
+                select(Match.id)
+                .where(Match.tournament_id.in_(tournament_ids), Match.start_time_utc > now)
+                .order_by(Match.start_time_utc)
+                .limit(20)
+            ).scalars().all()
+            token = create_jwt_token({"id": user.tg_id, "first_name": user.name,
+                                      "uid": user_id, "tournaments": tournament_ids})
+            clients.append((token, tournament_ids, upcoming))
+    engine.dispose()
+    return clients
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}  # endpoint -> [seconds]
+        self.errors = {}
+
+    def add(self, endpoint: str, seconds: float, ok: bool) -> None:
+        self.samples.setdefault(endpoint, []).append(seconds)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        result = {}
+        for endpoint, values in sorted(self.samples.items()):
+            values.sort()
+            result[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput_rps": round(len(values) / elapsed, 1),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+            }
+        return result
+
+async def _request(client, recorder: Recorder, method: str, endpoint: str, token: str, **kwargs):
+    started = time.perf_counter()
+    response = None
+    try:
+        response = await client.request(method, endpoint, headers={"Authorization": "Bearer " + token}, **kwargs)
+        ok = response.status_code < 400
+    except Exception:
+        ok = False
+    recorder.add(endpoint, time.perf_counter() - started, ok)
+    return response if ok else None
+
+async def browse(client, recorder: Recorder, clients: list, duration: float, rng: random.Random) -> None:
+    # Every client reopens the app and refreshes: mostly /user-matches, some /sync and /standings
+    deadline = time.perf_counter() + duration
+
+    async def session(token, tournament_ids, upcoming):
+        version = 0
+        while time.perf_counter() < deadline:
+            roll = rng.random()
+            if roll < 0.7:
+                response = await _request(client, recorder, "GET", "/user-matches", token)
+                if response is not None:
+                    version = response.json().get("version", version)
+            elif roll < 0.9:
+                response = await _request(client, recorder, "GET", "/sync", token, params={"since": version})
+                if response is not None:
+                    version = response.json().get("version", version)
+            elif tournament_ids:
+                await _request(client, recorder, "GET", "/standings", token,
+                               params={"tournament_id": rng.choice(tournament_ids)})
+            await asyncio.sleep(rng.uniform(0, 0.05))
+
+    await asyncio.gather(*(session(*c) for c in clients))
+
+async def kickoff_burst(client, recorder: Recorder, clients: list, bets_per_client: int, rng: random.Random) -> None:
+    # Everybody places (and corrects) bets on the next matches at once
+    async def session(token, tournament_ids, upcoming):
+        for match_id in upcoming[:bets_per_client]:
+            await _request(client, recorder, "POST", "/place-bet", token,
+                           json={"match_id": match_id, "score_1": rng.randint(0, 3), "score_2": rng.randint(0, 3)})
+
+    await asyncio.gather(*(session(*c) for c in clients))
+
+async def run(url: str, base_url: str, clients: list, duration: float, bets_per_client: int,
+              rng: random.Random) -> dict:
+    import httpx
+
+    if base_url:
+        return await _run_phases(None, base_url, clients, duration, bets_per_client, rng)
+
+    # ASGITransport does not send lifespan events, the app's context is entered here
+    import app as app_module
+    async with app_module.app.router.lifespan_context(app_module.app):
+        return await _run_phases(httpx.ASGITransport(app=app_module.app), "http://bench",
+                                 clients, duration, bets_per_client, rng)
+
+async def _run_phases(transport, base_url: str, clients: list, duration: float, bets_per_client: int,
+                      rng: random.Random) -> dict:
+    import httpx
+
+    limits = httpx.Limits(max_connections=len(clients) or 1)
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, limits=limits,
+                                 verify=False, timeout=30) as client:
+        phases = {}
+        recorder = Recorder()
+        started = time.perf_counter()
+        await browse(client, recorder, clients, duration, rng)
+        phases["browse"] = recorder.report(time.perf_counter() - started)
+
+        recorder = Recorder()
+        started = time.perf_counter()
+        await kickoff_burst(client, recorder, clients, bets_per_client, rng)
+        phases["kickoff"] = recorder.report(time.perf_counter() - started)
+    return phases
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a synthetic database and load test the API")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = sub.add_parser("seed")
+    seed_parser.add_argument("--db", required=True, help="SQLite file to create")
+    seed_parser.add_argument("--tournaments", type=int, default=50)
+    seed_parser.add_argument("--users", type=int, default=5000)
+    seed_parser.add_argument("--teams", type=int, default=200)
+    seed_parser.add_argument("--matches", type=int, default=20000)
+    seed_parser.add_argument("--bets", type=int, default=1000000)
+    seed_parser.add_argument("--tournaments-per-user", type=int, default=3)
+    seed_parser.add_argument("--seed", type=int, default=42)
+    seed_parser.add_argument("--force", action="store_true", help="overwrite an existing file")
+
+    run_parser = sub.add_parser("run")
+    run_parser.add_argument("--db", required=True, help="SQLite file created by seed")
+    run_parser.add_argument("--url", help="base URL of a running server, in-process when omitted")
+    run_parser.add_argument("--clients", type=int, default=200, help="concurrent users")
+    run_parser.add_argument("--duration", type=float, default=30, help="seconds of the browse phase")
+    run_parser.add_argument("--bets-per-client", type=int, default=5)
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--out", help="also write the JSON report to this file")
+
+    args = parser.parse_args()
+    url = "sqlite:///" + os.path.abspath(args.db)
+    # config.py reads DATABASE_URL on import, and the app's lifespan opens that file
+    os.environ["DATABASE_URL"] = url
+    os.environ.setdefault("NOTIFICATIONS_ENABLED", "0")
+    rng = random.Random(args.seed)
+
+    if args.command == "seed":
+        if os.path.exists(args.db):
+            if not args.force:
+                sys.exit(f"{args.db} exists, pass --force to overwrite it")
+            os.remove(args.db)
+        started = time.perf_counter()
+        report = seed(url, args.tournaments, args.users, args.teams, args.matches, args.bets,
+                      args.tournaments_per_user, rng)
+        report["seconds"] = round(time.perf_counter() - started, 1)
+    else:
+        clients = load_clients(url, args.clients, rng)
+        report = {
+            "started_at": datetime.utcnow().isoformat() + "Z",
+            "target": args.url or "in-process",
+            "clients": len(clients),
+            "duration": args.duration,
+            "phases": asyncio.run(run(url, args.url, clients, args.duration, args.bets_per_client, rng)),
+        }
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    if getattr(args, "out", None):
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from db import init_db, SessionLocal, Match, Participation, Bet, IdempotencyKey
+from config import PLACE_BETS_MAX_ITEMS, IDEMPOTENCY_KEY_TTL_HOURS
+import betstats
+import sync
+
+logger = logging.getLogger(__name__)
+
+# Batch bet submission for /place-bets. Whatever the number of bets, the work
+# is one query for the matches, at most one for participations not yet in the
+# token, one for the bets being replaced, the bet statistics upsert and a
+# single INSERT ... ON CONFLICT(user_id, match_id) DO UPDATE, all in one
+# transaction. With an Idempotency-Key the response is stored in the
+# same transaction, so a retry of a request that already went through is
+# answered from idempotency_keys without touching the bets again.
+
+def _request_hash(items: list) -> str:
+    return hashlib.sha256(json.dumps(items, sort_keys=True).encode()).hexdigest()
+
+def parse_bet(item) -> tuple:
+    # (match_id, score_1, score_2) or raises ValueError; shared with /place-bet
+    if not isinstance(item, dict):
+        raise ValueError("Bet must be an object")
+    try:
+        match_id, score_1, score_2 = int(item['match_id']), int(item['score_1']), int(item['score_2'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("match_id, score_1 and score_2 are required")
+    if score_1 < 0 or score_2 < 0:
+        raise ValueError("Scores must not be negative")
+    return match_id, score_1, score_2
+
+def upsert_bets(db: Session, user_id: int, rows: list) -> None:
+    # Writes bets rows ({"match_id", "score_1", "score_2"} plus user_id) with
+    # one INSERT ... ON CONFLICT, so concurrent identical requests cannot trip
+    # the unique index, and moves the bet statistics. Does not commit.
+    previous = {
+        match_id: (score_1, score_2) for match_id, score_1, score_2 in db.execute(
+            select(Bet.match_id, Bet.score_1, Bet.score_2)
+            .where(Bet.user_id == user_id, Bet.match_id.in_([row["match_id"] for row in rows]))
+        )
+    }
+    betstats.apply(db, betstats.bet_deltas(
+        (row["match_id"], previous.get(row["match_id"]), (row["score_1"], row["score_2"])) for row in rows
+    ))
+    stmt = sqlite_insert(Bet).values([{"user_id": user_id, **row} for row in rows])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'match_id'],
+        set_={'score_1': stmt.excluded.score_1, 'score_2': stmt.excluded.score_2},
+    ))
+
+def _stored_response(db: Session, user_id: int, key: str, request_hash: str):
+    stored = db.get(IdempotencyKey, (user_id, key))
+    if stored is None:
+        return None
+    if stored.request_hash != request_hash:
+        return {"success": False, "error": "Idempotency key reused with a different request"}, 422
+    return json.loads(stored.response), stored.status_code
+
+def save_bets(db: Session, user: dict, items: list, idempotency_key: str = None) -> tuple:
+    # Returns (payload, status_code); payload["results"] follows the order of items
+    user_id = user['uid']
+    if not isinstance(items, list) or not items:
+        return {"success": False, "error": "bets must be a non-empty list"}, 400
+    if len(items) > PLACE_BETS_MAX_ITEMS:
+        return {"success": False, "error": f"At most {PLACE_BETS_MAX_ITEMS} bets per request"}, 400
+
+    request_hash = _request_hash(items)
+    if idempotency_key:
+        stored = _stored_response(db, user_id, idempotency_key, request_hash)
+        if stored is not None:
+            return stored
+
+    results = [None] * len(items)
+    parsed = {}  # match_id -> (index, score_1, score_2), the last bet on a match wins
+    for index, item in enumerate(items):
+        try:
+            match_id, score_1, score_2 = parse_bet(item)
+        except ValueError as e:
+            results[index] = {"success": False, "error": str(e), "status": 400}
+            continue
+        if match_id in parsed:
+            previous = parsed[match_id][0]
+            results[previous] = {"match_id": match_id, "success": False, "error": "Superseded by a later bet", "status": 409}
+        parsed[match_id] = (index, score_1, score_2)
+
+    matches = {}
+    if parsed:
+        matches = {
+            row.id: row for row in db.execute(
+                select(Match.id, Match.tournament_id, Match.start_time_utc, Match.locked)
+                .where(Match.id.in_(parsed))
+            )
+        }
+
+    # Participation is checked once for all tournaments the token does not know yet
+    known = set(user.get('tournaments', ()))
+    unknown = {row.tournament_id for row in matches.values()} - known
+    if unknown:
+        known.update(db.execute(
+            select(Participation.tournament_id).where(
+                Participation.user_id == user_id,
+                Participation.approved == True,
+                Participation.tournament_id.in_(unknown)
+            )
+        ).scalars())
+
+    now = datetime.utcnow()
+    rows = []
+    for match_id, (index, score_1, score_2) in parsed.items():
+        match = matches.get(match_id)
+        if match is None:
+            results[index] = {"match_id": match_id, "success": False, "error": "Match not found", "status": 404}
+        elif match.locked or match.start_time_utc <= now:
+            results[index] = {"match_id": match_id, "success": False, "error": "Cannot place bet on started match", "status": 400}
+        elif match.tournament_id not in known:
+            results[index] = {"match_id": match_id, "success": False,
+                              "error": "User is not participating in this tournament", "status": 403}
+        else:
+            results[index] = {"match_id": match_id, "success": True}
+            rows.append({"match_id": match_id, "score_1": score_1, "score_2": score_2})
+            sync.record_change(db, 'bet', match_id, tournament_id=match.tournament_id, user_id=user_id)
+
+    if rows:
+        upsert_bets(db, user_id, rows)
+
+    payload = {"success": True, "saved": len(rows), "results": results}
+    if idempotency_key:
+        inserted = db.execute(
+            sqlite_insert(IdempotencyKey).values(
+                user_id=user_id,
+                key=idempotency_key,
+                request_hash=request_hash,
+                status_code=200,
+                response=json.dumps(payload, ensure_ascii=False),
+            ).on_conflict_do_nothing()
+        ).rowcount
+        if not inserted:
+            # A concurrent retry committed first, its response is the answer
+            db.rollback()
+            return _stored_response(db, user_id, idempotency_key, request_hash)
+    db.commit()
+    return payload, 200
+
+def prune_idempotency_keys(db: Session, hours: int = IDEMPOTENCY_KEY_TTL_HOURS) -> int:
+    result = db.execute(
+        delete(IdempotencyKey).where(IdempotencyKey.created_at < datetime.utcnow() - timedelta(hours=hours))
+    )
+    db.commit()
+    logger.info("Pruned %s idempotency keys older than %s hours", result.rowcount, hours)
+    return result.rowcount
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain batch bet state")
+    parser.add_argument("command", choices=["prune"])
+    parser.add_argument("--hours", type=int, default=IDEMPOTENCY_KEY_TTL_HOURS)
+    args = parser.parse_args()
+
+    init_db()
+    with SessionLocal() as session:
+        prune_idempotency_keys(session, args.hours)
@@ -0,0 +1,115 @@
+import argparse
+import logging
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from db import init_db, SessionLocal, Match, Bet, MatchBetStat
+from config import BET_STATS_CACHE_SIZE, BET_STATS_TOP_SCORES
+from cache import GenerationCache, bump_generation
+
+logger = logging.getLogger(__name__)
+
+# How everyone bet on a match: bet counts per predicted scoreline in
+# match_bet_stats. Writers keep it current in their own transaction: a new bet
+# adds one to its scoreline, an edited bet also takes one from the old one.
+# Once a match is locked no bet can change, so its distribution is cached in
+# memory and /bet-stats costs one generation lookup. `python betstats.py
+# rebuild` recounts the table from the bets and, like archiving, bumps the
+# "bet_stats" generation so every worker drops its copies.
+
+def apply(db: Session, deltas: Counter) -> None:
+    # deltas: (match_id, score_1, score_2) -> change in bets. Does not commit.
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    stmt = sqlite_insert(MatchBetStat).values([
+        {"match_id": match_id, "score_1": score_1, "score_2": score_2, "bets": delta}
+        for (match_id, score_1, score_2), delta in deltas.items()
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['match_id', 'score_1', 'score_2'],
+        set_={'bets': MatchBetStat.bets + stmt.excluded.bets},
+    ))
+    emptied = {match_id for (match_id, _, _), delta in deltas.items() if delta < 0}
+    if emptied:
+        db.execute(delete(MatchBetStat).where(MatchBetStat.match_id.in_(emptied), MatchBetStat.bets <= 0))
+
+def bet_deltas(changes) -> Counter:
+    # changes: (match_id, old (score_1, score_2) or None, new (score_1, score_2))
+    deltas = Counter()
+    for match_id, old, new in changes:
+        if old == new:
+            continue
+        if old is not None:
+            deltas[(match_id, *old)] -= 1
+        deltas[(match_id, *new)] += 1
+    return deltas
+
+_cache = GenerationCache('bet_stats', BET_STATS_CACHE_SIZE)
+
+def _summary(match_id: int, rows: list) -> dict:
+    total = sum(bets for _, _, bets in rows)
+    split = {"home": 0, "draw": 0, "away": 0}
+    for score_1, score_2, bets in rows:
+        split["home" if score_1 > score_2 else "away" if score_1 < score_2 else "draw"] += bets
+    rows = sorted(rows, key=lambda row: (-row[2], row[0], row[1]))[:BET_STATS_TOP_SCORES]
+    return {
+        "match_id": match_id,
+        "total": total,
+        "split": {outcome: {"bets": bets, "share": round(bets / total, 3) if total else 0.0}
+                  for outcome, bets in split.items()},
+        "scorelines": [{"score_1": score_1, "score_2": score_2, "bets": bets,
+                        "share": round(bets / total, 3) if total else 0.0}
+                       for score_1, score_2, bets in rows],
+    }
+
+def get_stats(db: Session, match_id: int) -> tuple:
+    # Returns (tournament_id, summary); summary is None while bets are still open
+    generation, cached = _cache.get(db, match_id)
+    if cached is not None:
+        return cached
+    match = db.execute(
+        select(Match.tournament_id, Match.start_time_utc, Match.locked).where(Match.id == match_id)
+    ).first()
+    if match is None:
+        return None, None
+    if not match.locked and match.start_time_utc > datetime.utcnow():
+        return match.tournament_id, None
+
+    rows = db.execute(
+        select(MatchBetStat.score_1, MatchBetStat.score_2, MatchBetStat.bets)
+        .where(MatchBetStat.match_id == match_id, MatchBetStat.bets > 0)
+    ).all()
+    result = (match.tournament_id, _summary(match_id, [tuple(row) for row in rows]))
+    _cache.set(match_id, generation, result)
+    return result
+
+def rebuild(db: Session, match_id: int = None) -> int:
+    # Recounts the aggregate from the bets, for all matches or one
+    cleanup = delete(MatchBetStat)
+    counts = select(Bet.match_id, Bet.score_1, Bet.score_2, func.count()).group_by(Bet.match_id, Bet.score_1, Bet.score_2)
+    if match_id is not None:
+        cleanup = cleanup.where(MatchBetStat.match_id == match_id)
+        counts = counts.where(Bet.match_id == match_id)
+    db.execute(cleanup)
+    inserted = db.execute(
+        insert(MatchBetStat).from_select(['match_id', 'score_1', 'score_2', 'bets'], counts)
+    ).rowcount
+    bump_generation(db, 'bet_stats')
+    db.commit()
+    logger.info("Rebuilt bet statistics: %d scoreline rows", inserted)
+    return inserted
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the per-match bet statistics")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--match", type=int, default=None, help="only this match")
+    args = parser.parse_args()
+
+    init_db()
+    with SessionLocal() as session:
+        rebuild(session, args.match)
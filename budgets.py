@@ -0,0 +1,52 @@
+import collections
+import logging
+
+from config import QUERY_BUDGET_MODE
+
+logger = logging.getLogger(__name__)
+
+# Per-endpoint SQL budgets. Every route in routes.py declares how many
+# statements it may run and how much work SQLite may do for it:
+#
+#   @router.get("/user-matches")
+#   @query_budget(statements=2, kilosteps=50)
+#
+# kilosteps counts thousands of SQLite VM instructions. It grows with the rows
+# a query visits, so an unbounded listing or a lost index goes over it long
+# before the statement count changes. Budgets are only checked when
+# QUERY_BUDGET_MODE=log (MetricsMiddleware reports overruns); querybudget.py
+# drives every route that way against a seeded database.
+
+def query_budget(statements: int, kilosteps: int = None):
+    def decorator(endpoint):
+        endpoint.query_budget = {"statements": statements, "kilosteps": kilosteps}
+        return endpoint
+    return decorator
+
+def enabled() -> bool:
+    return QUERY_BUDGET_MODE != "off"
+
+# (method, route) -> (statements, kilosteps) of the last request, and the
+# number of overruns per (method, route); both stay as small as the route table.
+# querybudget.py sets record to a list to collect every overrun in full.
+observed = {}
+violations = collections.Counter()
+record = None
+
+def check(method: str, route: str, endpoint, statements: int, kilosteps: int) -> list:
+    observed[(method, route)] = (statements, kilosteps)
+    budget = getattr(endpoint, "query_budget", None)
+    if budget is None:
+        return []
+
+    problems = []
+    if statements > budget["statements"]:
+        problems.append(f"{statements} statements, budget {budget['statements']}")
+    if budget["kilosteps"] is not None and kilosteps > budget["kilosteps"]:
+        problems.append(f"{kilosteps} kilosteps, budget {budget['kilosteps']}")
+    for problem in problems:
+        violations[(method, route)] += 1
+        if record is not None:
+            record.append((method, route, problem))
+        logger.warning("Query budget exceeded on %s %s: %s", method, route, problem)
+    return problems
@@ -0,0 +1,222 @@
+import codecs
+import csv
+import json
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from db import Tournament, Team, Match, Change
+from config import IMPORT_MAX_LINES, IMPORT_MAX_LINE_BYTES, IMPORT_CHUNK_SIZE
+from cache import bump_generation
+import archive
+import queries
+
+logger = logging.getLogger(__name__)
+
+# Bulk import of tournaments, teams and matches for /import. The body is
+# NDJSON or CSV with one record per line:
+#
+#   {"type": "tournament", "name": "АПЛ 2026/27"}
+#   {"type": "team", "name": "Арсенал"}
+#   {"type": "match", "tournament": "АПЛ 2026/27", "team_1": "Арсенал", "team_2": 12,
+#    "date": "2026-08-15T14:00:00Z"}
+#
+#   type,name,tournament,team_1,team_2,date          (CSV header, same fields)
+#
+# Tournaments and teams are referenced by id or by name, including names
+# created earlier in the same file. Every line is validated against an
+# in-memory lookup before anything is written; any error rejects the whole
+# import and the report lists the errors by line. A line longer than
+# IMPORT_MAX_LINE_BYTES is such an error too, dropped as it streams in rather
+# than buffered whole. Otherwise the rows are inserted in executemany chunks
+# and committed once. dry_run stops after validation.
+
+class ImportTooLarge(Exception):
+    pass
+
+async def read_records(chunks, fmt: str) -> tuple:
+    # Decodes the request stream line by line into (records, errors),
+    # records are (line number, dict) and errors (line number, message)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    records, errors = [], []
+    header = None
+    buffer = ""
+    line_no = 0
+    too_long = False  # the current line went over the limit, the rest of it is dropped
+
+    def parse(line: str):
+        nonlocal header, too_long
+        if not (line.strip() or too_long):
+            return
+        if len(records) + len(errors) >= IMPORT_MAX_LINES:
+            raise ImportTooLarge(f"At most {IMPORT_MAX_LINES} lines per import")
+        if too_long or len(line.encode()) > IMPORT_MAX_LINE_BYTES:
+            too_long = False
+            errors.append((line_no, f"Line longer than {IMPORT_MAX_LINE_BYTES} bytes"))
+            return
+        if fmt == "csv":
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [name.strip().lower() for name in values]
+                return
+            records.append((line_no, dict(zip(header, values))))
+            return
+        try:
+            record = json.loads(line)
+        except ValueError:
+            errors.append((line_no, "Invalid JSON"))
+            return
+        if not isinstance(record, dict):
+            errors.append((line_no, "Record must be a JSON object"))
+            return
+        records.append((line_no, record))
+
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            line_no += 1
+            parse(line)
+        # A character takes at least one byte, so this line is already too long
+        if len(buffer) > IMPORT_MAX_LINE_BYTES:
+            too_long, buffer = True, ""
+    buffer += decoder.decode(b"", final=True)
+    if buffer or too_long:
+        line_no += 1
+        parse(buffer)
+    return records, errors
+
+def _key(name) -> str:
+    return str(name).strip().casefold()
+
+def _resolve(reference, by_id: set, by_name: dict):
+    # id or name -> id, None when unknown
+    if reference is None or str(reference).strip() == "":
+        return None
+    text = str(reference).strip()
+    if text.isdigit() and int(text) in by_id:
+        return int(text)
+    return by_name.get(_key(text))
+
+def _parse_date(value) -> datetime:
+    start = datetime.fromisoformat(str(value).strip().replace('Z', '+00:00'))
+    if start.tzinfo is not None:
+        start = start.astimezone(timezone.utc).replace(tzinfo=None)
+    return start
+
+def _insert_returning_ids(db: Session, model, rows: list) -> list:
+    ids = []
+    for i in range(0, len(rows), IMPORT_CHUNK_SIZE):
+        result = db.execute(
+            insert(model).returning(model.id, sort_by_parameter_order=True),
+            rows[i:i + IMPORT_CHUNK_SIZE]
+        )
+        ids.extend(result.scalars().all())
+    return ids
+
+def import_records(db: Session, records: list, errors: list, dry_run: bool = False) -> tuple:
+    # Returns (report, status_code)
+    errors = list(errors)
+    tournaments = queries.list_tournaments(db)
+    teams = queries.list_teams(db)
+    tournament_ids = {t["id"] for t in tournaments}
+    # Archived tournaments take no new matches, they are reported as such rather than unknown
+    archived = archive.list_archives(db)
+    archived_ids = {t["id"] for t in archived}
+    archived_names = {_key(t["name_ru"]): t["id"] for t in archived}
+    team_ids = {t["id"] for t in teams}
+    # Names of new rows map to a placeholder until they are inserted
+    tournament_names = {_key(t["name_ru"]): t["id"] for t in tournaments}
+    team_names = {_key(t["name_ru"]): t["id"] for t in teams}
+
+    new_tournaments, new_teams, new_matches = [], [], []
+    skipped = 0
+    for line_no, record in records:
+        kind = str(record.get("type", "")).strip().lower()
+        if kind in ("tournament", "team"):
+            name = str(record.get("name") or record.get("name_ru") or "").strip()
+            if not name:
+                errors.append((line_no, "name is required"))
+                continue
+            names, rows = (tournament_names, new_tournaments) if kind == "tournament" else (team_names, new_teams)
+            if _key(name) in names:
+                skipped += 1
+                continue
+            names[_key(name)] = ("new", len(rows))
+            rows.append({"name_ru": name})
+        elif kind == "match":
+            tournament = _resolve(record.get("tournament"), tournament_ids, tournament_names)
+            team_1 = _resolve(record.get("team_1"), team_ids, team_names)
+            team_2 = _resolve(record.get("team_2"), team_ids, team_names)
+            problems = []
+            if tournament is None:
+                if _resolve(record.get("tournament"), archived_ids, archived_names) is not None:
+                    problems.append(f"tournament {record.get('tournament')!r} is archived")
+                else:
+                    problems.append(f"unknown tournament {record.get('tournament')!r}")
+            if team_1 is None:
+                problems.append(f"unknown team_1 {record.get('team_1')!r}")
+            if team_2 is None:
+                problems.append(f"unknown team_2 {record.get('team_2')!r}")
+            if team_1 is not None and team_1 == team_2:
+                problems.append("team_1 and team_2 are the same team")
+            try:
+                start = _parse_date(record.get("date"))
+            except (TypeError, ValueError):
+                problems.append(f"invalid date {record.get('date')!r}")
+            if problems:
+                errors.append((line_no, "; ".join(problems)))
+                continue
+            new_matches.append((tournament, team_1, team_2, start))
+        else:
+            errors.append((line_no, f"unknown type {record.get('type')!r}"))
+
+    report = {
+        "success": not errors,
+        "dry_run": dry_run,
+        "tournaments": len(new_tournaments),
+        "teams": len(new_teams),
+        "matches": len(new_matches),
+        "skipped": skipped,
+        "errors": [{"line": line_no, "error": message} for line_no, message in sorted(errors)],
+    }
+    if errors:
+        return report, 422
+    if dry_run:
+        return report, 200
+
+    created_tournaments = _insert_returning_ids(db, Tournament, new_tournaments)
+    created_teams = _insert_returning_ids(db, Team, new_teams)
+
+    def real_id(value, created):
+        return created[value[1]] if isinstance(value, tuple) else value
+
+    match_rows = [{
+        "tournament_id": real_id(tournament, created_tournaments),
+        "team_1_id": real_id(team_1, created_teams),
+        "team_2_id": real_id(team_2, created_teams),
+        "start_time_utc": start,
+        "is_finished": False,
+    } for tournament, team_1, team_2, start in new_matches]
+    match_ids = _insert_returning_ids(db, Match, match_rows)
+
+    change_rows = [
+        {"entity": "match", "entity_id": match_id, "tournament_id": row["tournament_id"], "deleted": False,
+         "created_at": datetime.utcnow()}
+        for match_id, row in zip(match_ids, match_rows)
+    ]
+    for i in range(0, len(change_rows), IMPORT_CHUNK_SIZE):
+        db.execute(insert(Change), change_rows[i:i + IMPORT_CHUNK_SIZE])
+
+    if new_tournaments:
+        bump_generation(db, 'tournaments')
+    if new_teams:
+        bump_generation(db, 'teams')
+    db.commit()
+
+    logger.info("Imported %d tournaments, %d teams, %d matches",
+                len(new_tournaments), len(new_teams), len(new_matches))
+    report["tournament_ids"] = sorted({row["tournament_id"] for row in match_rows})
+    return report, 200
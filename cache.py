@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from db import CacheGeneration
+
+logger = logging.getLogger(__name__)
+
+# In-process cache for rarely changing reference data (tournaments, teams).
+# Every entry is tagged with a generation number stored in cache_generations;
+# writers bump it in their own transaction, so a single primary key lookup
+# tells any worker whether its copy is still current. The generation also
+# makes a strong ETag, and a matching If-None-Match skips loading entirely.
+
+def get_generation(db: Session, name: str) -> int:
+    return db.execute(
+        select(CacheGeneration.generation).where(CacheGeneration.name == name)
+    ).scalar() or 0
+
+def bump_generation(db: Session, name: str) -> None:
+    # Does not commit, the bump lands together with the write it invalidates
+    stmt = sqlite_insert(CacheGeneration).values(name=name, generation=1)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['name'],
+        set_={'generation': CacheGeneration.generation + 1},
+    ))
+
+def make_etag(*parts) -> str:
+    return '"' + "-".join(str(part) for part in parts) + '"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return any(tag.strip() in (etag, "*") for tag in if_none_match.split(","))
+
+def hash_ids(ids) -> str:
+    return hashlib.sha1(",".join(str(i) for i in sorted(ids)).encode()).hexdigest()[:12]
+
+class ReferenceCache:
+    def __init__(self):
+        self._entries = {}  # name -> (generation, data, JSON body)
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, name: str, loader, generation: int = None) -> tuple:
+        # Returns (generation, data, body) with loader(db) called only when stale.
+        # body is the serialized {"success": true, <name>: data} response.
+        if generation is None:
+            generation = get_generation(db, name)
+        entry = self._entries.get(name)
+        if entry is not None and entry[0] == generation:
+            return entry
+
+        data = loader(db)
+        body = json.dumps({"success": True, name: data}, ensure_ascii=False).encode()
+        entry = (generation, data, body)
+        with self._lock:
+            current = self._entries.get(name)
+            if current is None or current[0] <= generation:
+                self._entries[name] = entry
+        logger.debug("Reference cache %s reloaded at generation %s", name, generation)
+        return entry
+
+    def invalidate(self, name: str = None) -> None:
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+reference_cache = ReferenceCache()
+
+class TTLCache:
+    # Bounded LRU whose entries also expire at an absolute wall-clock time
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# Expiry for entries that only the LRU bound or a generation bump removes
+FOREVER = float("inf")
+
+class GenerationCache:
+    # LRU of values that stay valid until the named generation is bumped, by
+    # any worker or CLI (e.g. a rebuild). Entries are tagged with the
+    # generation read before they were loaded, so a bump racing the load
+    # leaves a stale tag rather than stale data under a current one.
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self._entries = TTLCache(maxsize)
+
+    def get(self, db: Session, key) -> tuple:
+        # Returns (generation, value), value is None when missing or stale
+        generation = get_generation(db, self.name)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == generation:
+            return generation, entry[1]
+        return generation, None
+
+    def set(self, key, generation: int, value) -> None:
+        self._entries.set(key, (generation, value), FOREVER)
@@ -1,25 +1,157 @@
+import functools
 import os
 import logging
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from log import setup_logging, parse_levels
+
+# Logging settings: LOG_LEVELS overrides single modules, e.g. "routes=DEBUG,auth=WARNING";
+# LOG_DEBUG_SAMPLE_RATE keeps only that share of DEBUG records (1.0 keeps all)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = parse_levels(os.environ.get("LOG_LEVELS", ""))
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", 1.0))
+
+setup_logging(LOG_LEVEL, LOG_LEVELS, LOG_DEBUG_SAMPLE_RATE)
 logger = logging.getLogger(__name__)
 
+# Requests slower than this log every SQL statement they ran, seconds (0 disables)
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 0))
+# "log" checks every request against the @query_budget of its route (see budgets.py)
+QUERY_BUDGET_MODE = os.environ.get("QUERY_BUDGET_MODE", "off")
+
 # JWT settings
 JWT_SECRET = "your-secret-key"  # Change this to a secure secret key
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION = 15  # minutes
+JWT_CACHE_SIZE = 4096  # decoded tokens kept in memory until they expire
+
+# Telegram initData older than this is rejected, seconds. The mini app trades
+# it for a JWT right after opening, so a short window limits replays of a
+# leaked initData string without affecting real clients
+INIT_DATA_MAX_AGE = int(os.environ.get("INIT_DATA_MAX_AGE", 10 * 60))
+# Recently verified initData strings kept to skip the HMAC on app reopen
+INIT_DATA_CACHE_SIZE = 4096
+
+# Database settings
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///daggybot.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 4))
+DB_POOL_TIMEOUT = 10  # seconds
+DB_BUSY_TIMEOUT = 5000  # milliseconds, how long SQLite waits for the write lock
+DB_SYNCHRONOUS = "NORMAL"  # safe with WAL, fsync only on checkpoint
+# Threads running blocking DB work off the event loop, one per pooled connection
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", DB_POOL_SIZE))
+
+# Mini app shell, built and precompressed once per process by shell.py
+SHELL_TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'templates', 'index.html')
+
+# Match listings: page size and the default window of "upcoming + last N days"
+MATCHES_PAGE_SIZE = 50
+MATCHES_MAX_PAGE_SIZE = 200
+MATCHES_DEFAULT_PAST_DAYS = 7
+
+# Delta sync: changes returned per /sync call and how long the change log is kept
+SYNC_MAX_CHANGES = 500
+CHANGES_RETENTION_DAYS = 30
+
+# Batch bets: items per /place-bets request and how long idempotency keys are kept
+PLACE_BETS_MAX_ITEMS = 100
+IDEMPOTENCY_KEY_TTL_HOURS = 48
+
+# Bulk import: lines accepted per /import request, bytes per line and rows per executemany chunk
+IMPORT_MAX_LINES = 20000
+IMPORT_MAX_LINE_BYTES = 4096
+IMPORT_CHUNK_SIZE = 500
+
+# Bet distribution of locked matches: matches kept in memory, scorelines listed by /bet-stats
+BET_STATS_CACHE_SIZE = 1024
+BET_STATS_TOP_SCORES = 10
+
+# Archived tournament summaries kept in memory per worker
+ARCHIVE_CACHE_SIZE = 256
+
+# Live updates over /events: events buffered per client and idle heartbeat interval
+EVENTS_QUEUE_SIZE = 100
+EVENTS_HEARTBEAT_SECONDS = 15
+# Lifetime of the stream token /events is opened with, seconds
+EVENTS_TOKEN_SECONDS = 60
+# With several workers each one writes its events to bus_events and reads the
+# others' this often, seconds; rows are kept for EVENTS_RELAY_RETENTION_SECONDS
+EVENTS_RELAY_SECONDS = 1.0
+EVENTS_RELAY_RETENTION_SECONDS = 60
+
+# Kickoff scheduler: full reload of upcoming kickoffs from the DB, seconds
+SCHEDULER_RELOAD_SECONDS = 300
+
+# Admission control (admission.py): token bucket budgets as (requests per
+# minute, burst) per Telegram user, per client IP for /init and /bootstrap.
+# RATE_LIMITS overrides them, e.g. "place_bet=60/10,init=30/10".
+RATE_LIMITS = {
+    "init": (120, 30),
+    "bootstrap": (120, 30),
+    "place_bet": (120, 20),
+    "place_bets": (30, 10),
+    "participate": (10, 5),
+}
+for _item in filter(None, os.environ.get("RATE_LIMITS", "").split(",")):
+    _name, _, _budget = _item.partition("=")
+    _per_minute, _, _burst = _budget.partition("/")
+    RATE_LIMITS[_name.strip()] = (float(_per_minute), float(_burst or _per_minute))
+RATE_LIMIT_MAX_KEYS = 100000  # buckets kept per route, least recently used are dropped
+# Write requests running at once per worker, how many may queue for a slot and for how long
+WRITE_CONCURRENCY = int(os.environ.get("WRITE_CONCURRENCY", 2))
+WRITE_QUEUE_LIMIT = int(os.environ.get("WRITE_QUEUE_LIMIT", 64))
+WRITE_QUEUE_SECONDS = float(os.environ.get("WRITE_QUEUE_SECONDS", 2))
+
+# Telegram notifications: the Bot API base URL (point it at a fake server in
+# development), send rates per worker process and per chat (messages per
+# second), retry backoff and the lead time of the "betting closes soon" reminder
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+NOTIFICATIONS_ENABLED = os.environ.get("NOTIFICATIONS_ENABLED", "1") == "1"
+NOTIFY_GLOBAL_RATE = float(os.environ.get("NOTIFY_GLOBAL_RATE", 25))
+NOTIFY_CHAT_RATE = 1.0
+NOTIFY_BATCH_SIZE = 200  # rows claimed per round
+NOTIFY_CONCURRENCY = 8  # chats sent to in parallel
+NOTIFY_LEASE_SECONDS = 60  # a claimed row is retried after this if the worker dies
+NOTIFY_POLL_SECONDS = 5
+NOTIFY_MAX_ATTEMPTS = 8
+NOTIFY_BACKOFF_SECONDS = 2  # doubled on every failed attempt
+NOTIFY_BACKOFF_MAX_SECONDS = 600
+NOTIFY_MESSAGE_LIMIT = 4096  # Bot API limit, coalesced messages are split to fit
+MATCH_REMINDER_MINUTES = int(os.environ.get("MATCH_REMINDER_MINUTES", 60))
+
+# Bet scoring used for tournaments without their own scoring_rules row
+DEFAULT_SCORING = {
+    "exact_score": 3.0,      # угадан точный счёт
+    "goal_difference": 2.0,  # угадана разница мячей
+    "outcome": 1.0,          # угадан исход
+}
+
+# Bot token: BOT_TOKEN from the environment or the secrets file, read on first
+# use so that importing the app (scripts, workers) does not require the secret
+BOT_TOKEN_PATH = os.environ.get("BOT_TOKEN_PATH", os.path.join(os.path.dirname(__file__), 'secrets', 'bot_token.txt'))
 
-# Read bot token from file
-BOT_TOKEN_PATH = os.path.join(os.path.dirname(__file__), 'secrets', 'bot_token.txt')
-with open(BOT_TOKEN_PATH, 'r') as f:
-    BOT_TOKEN = f.read().strip()
+@functools.lru_cache(maxsize=None)
+def get_bot_token() -> str:
+    token = os.environ.get("BOT_TOKEN")
+    if token:
+        return token.strip()
+    with open(BOT_TOKEN_PATH, 'r') as f:
+        return f.read().strip()
 
-# Authorized users
-AUTHORIZED_USERS = {128772612}  # Replace with your authorized user IDs 
+# Production server (python app.py): worker processes share the SQLite file in
+# WAL mode; SSE streams are cut after the graceful shutdown timeout
+SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", 5000))
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", os.cpu_count() or 1))
+SERVER_GRACEFUL_SHUTDOWN_SECONDS = int(os.environ.get("SERVER_GRACEFUL_SHUTDOWN_SECONDS", 10))
+SSL_KEYFILE = os.environ.get("SSL_KEYFILE", "/etc/ssl/daggybot.bet/mydomain.key")
+SSL_CERTFILE = os.environ.get("SSL_CERTFILE", "/etc/ssl/daggybot.bet/daggybot_bet.crt")
+# How long a starting worker waits for another one to finish the schema upgrade, seconds
+MIGRATION_LOCK_TIMEOUT = 120
 
-# Admin users
-ADMIN_USERS = {128772612}  # Replace with your authorized user IDs 
\ No newline at end of file
+# Initial players and admins, copied into the roles table when it is empty;
+# afterwards roles are managed with /roles or `python roles.py grant|revoke`
+AUTHORIZED_USERS = {128772612}
+ADMIN_USERS = {128772612}
+# How often workers check whether another process changed the roles, seconds
+ROLES_REFRESH_SECONDS = 5
\ No newline at end of file
@@ -1,6 +1,16 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime, Double
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import create_engine, event, inspect, Index, Column, Integer, String, Boolean, ForeignKey, DateTime, Double
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, sessionmaker
+
+from config import (DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+                    DB_BUSY_TIMEOUT, DB_SYNCHRONOUS, DB_EXECUTOR_WORKERS)
+import metrics
 
 Base = declarative_base()
 
@@ -9,6 +19,8 @@ class Tournament(Base):
     
     id = Column(Integer, primary_key=True)
     name_ru = Column(String, nullable=False)
+    # Set once the tournament's rows are moved to the archive tables (archive.py)
+    archived_at = Column(DateTime, nullable=True)
     
     matches = relationship("Match", back_populates="tournament")
     participations = relationship("Participation", back_populates="tournament")
@@ -43,12 +55,22 @@ class Match(Base):
     score_1 = Column(Integer, nullable=True)
     score_2 = Column(Integer, nullable=True)
     is_finished = Column(Boolean, default=False)
+    # Set by the scheduler at kickoff, bets are accepted only while it is False
+    locked = Column(Boolean, nullable=False, default=False, server_default='0')
+    # Set by the scheduler once the "betting closes soon" reminder is queued
+    reminded = Column(Boolean, nullable=False, default=False, server_default='0')
     
     tournament = relationship("Tournament", back_populates="matches")
     team1 = relationship("Team", foreign_keys=[team_1_id], back_populates="matches_as_team1")
     team2 = relationship("Team", foreign_keys=[team_2_id], back_populates="matches_as_team2")
     bets = relationship("Bet", back_populates="match")
 
+    __table_args__ = (
+        Index('ix_matches_tournament_start', 'tournament_id', 'start_time_utc'),
+        Index('ix_matches_start', 'start_time_utc'),
+        Index('ix_matches_locked_start', 'locked', 'start_time_utc'),
+    )
+
 class Bet(Base):
     __tablename__ = 'bets'
     
@@ -62,6 +84,11 @@ class Bet(Base):
     user = relationship("User", back_populates="bets")
     match = relationship("Match", back_populates="bets")
 
+    __table_args__ = (
+        Index('uq_bets_user_match', 'user_id', 'match_id', unique=True),
+        Index('ix_bets_match', 'match_id'),
+    )
+
 class Participation(Base):
     __tablename__ = 'participations'
     
@@ -73,10 +100,239 @@ class Participation(Base):
     user = relationship("User", back_populates="participations")
     tournament = relationship("Tournament", back_populates="participations")
 
-def init_db():
-    engine = create_engine('sqlite:///daggybot.db')
-    Base.metadata.create_all(engine)
+    __table_args__ = (
+        Index('uq_participations_user_tournament', 'user_id', 'tournament_id', unique=True),
+        Index('ix_participations_tournament_approved', 'tournament_id', 'approved', 'user_id'),
+        Index('ix_participations_approved', 'approved'),
+    )
+
+class ScoringRule(Base):
+    __tablename__ = 'scoring_rules'
+
+    tournament_id = Column(Integer, ForeignKey('tournaments.id'), primary_key=True)
+    exact_score = Column(Double, nullable=False)
+    goal_difference = Column(Double, nullable=False)
+    outcome = Column(Double, nullable=False)
+
+class Standing(Base):
+    __tablename__ = 'standings'
+
+    tournament_id = Column(Integer, ForeignKey('tournaments.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    points = Column(Double, nullable=False, default=0.0)
+    # Position by points (ties share a rank), recomputed on every settlement
+    rank = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        Index('ix_standings_tournament_rank', 'tournament_id', 'rank'),
+    )
+
+class Change(Base):
+    # Append-only change log, the row id is the sync version handed to clients
+    __tablename__ = 'changes'
+
+    id = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)  # 'match', 'bet' or 'participation'
+    entity_id = Column(Integer, nullable=False)
+    tournament_id = Column(Integer, nullable=True)
+    user_id = Column(Integer, nullable=True)  # set for rows visible to one user only
+    deleted = Column(Boolean, nullable=False, default=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_changes_created_at', 'created_at'),
+        {'sqlite_autoincrement': True},
+    )
+
+class MatchBetStat(Base):
+    # Bets per predicted scoreline of a match, kept current by the bet writers (betstats.py)
+    __tablename__ = 'match_bet_stats'
+
+    match_id = Column(Integer, ForeignKey('matches.id'), primary_key=True)
+    score_1 = Column(Integer, primary_key=True)
+    score_2 = Column(Integer, primary_key=True)
+    bets = Column(Integer, nullable=False, default=0)
+
+class CacheGeneration(Base):
+    # Bumped by writers so every worker can tell its in-process cache is stale
+    __tablename__ = 'cache_generations'
+
+    name = Column(String, primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+
+class IdempotencyKey(Base):
+    # Stored /place-bets responses, a retry with the same key is answered from here
+    __tablename__ = 'idempotency_keys'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    key = Column(String, primary_key=True)
+    request_hash = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=False)
+    response = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_idempotency_keys_created_at', 'created_at'),
+    )
+
+class Role(Base):
+    # Telegram ids allowed to use the app ("player") or to manage it ("admin"), see roles.py
+    __tablename__ = 'roles'
+
+    tg_id = Column(Integer, primary_key=True)
+    role = Column(String, primary_key=True)
+    name = Column(String, nullable=True)  # free-form note for the role list
+    granted_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class Notification(Base):
+    # Outbound Telegram messages, a row is deleted once it has been delivered
+    __tablename__ = 'notifications'
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False)  # Telegram id of the user
+    text = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    # Due time; a dispatcher claiming the row moves it forward by the lease
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    failed = Column(Boolean, nullable=False, default=False)  # given up, kept for inspection
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_notifications_due', 'failed', 'next_attempt_at'),
+    )
+
+class BusEvent(Base):
+    # Events a worker published on its /events bus, read by the other workers (events.py)
+    __tablename__ = 'bus_events'
+
+    id = Column(Integer, primary_key=True)
+    origin = Column(Integer, nullable=False)  # process id of the publishing worker
+    type = Column(String, nullable=False)
+    data = Column(String, nullable=False)  # the event as JSON
+    user_id = Column(Integer, nullable=True)
+    tournament_id = Column(Integer, nullable=True)
+    admins = Column(Boolean, nullable=False, default=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_bus_events_created_at', 'created_at'),
+        {'sqlite_autoincrement': True},
+    )
+
+class TournamentArchive(Base):
+    # Compact summary of an archived tournament: totals and the final table as
+    # JSON [[rank, points, user_id, user_name], ...], written once by archive.py
+    __tablename__ = 'tournament_archives'
+
+    tournament_id = Column(Integer, ForeignKey('tournaments.id'), primary_key=True)
+    archived_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    matches = Column(Integer, nullable=False)
+    bets = Column(Integer, nullable=False)
+    participants = Column(Integer, nullable=False)
+    standings = Column(String, nullable=False)
+
+# Rows of archived tournaments, moved out of matches, bets and participations
+# so that live queries and their indexes only cover the active set
+
+class ArchivedMatch(Base):
+    __tablename__ = 'archived_matches'
+
+    id = Column(Integer, primary_key=True)
+    tournament_id = Column(Integer, ForeignKey('tournaments.id'), nullable=False)
+    team_1_id = Column(Integer, ForeignKey('teams.id'), nullable=False)
+    team_2_id = Column(Integer, ForeignKey('teams.id'), nullable=False)
+    start_time_utc = Column(DateTime, nullable=False)
+    score_1 = Column(Integer, nullable=True)
+    score_2 = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        Index('ix_archived_matches_tournament_start', 'tournament_id', 'start_time_utc'),
+    )
+
+class ArchivedBet(Base):
+    __tablename__ = 'archived_bets'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    match_id = Column(Integer, ForeignKey('archived_matches.id'), nullable=False)
+    score_1 = Column(Integer, nullable=False)
+    score_2 = Column(Integer, nullable=False)
+    points = Column(Double, nullable=True)
+
+    __table_args__ = (
+        Index('uq_archived_bets_user_match', 'user_id', 'match_id', unique=True),
+    )
+
+class ArchivedParticipation(Base):
+    __tablename__ = 'archived_participations'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    tournament_id = Column(Integer, ForeignKey('tournaments.id'), nullable=False)
+    approved = Column(Boolean, default=False)
+
+    __table_args__ = (
+        Index('uq_archived_participations_user_tournament', 'user_id', 'tournament_id', unique=True),
+    )
+
+SessionLocal = sessionmaker(expire_on_commit=False)
+
+# Bounded pool for blocking DB work so queries never run on the event loop
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT)}")
+    cursor.close()
+
+def create_db_engine(url: str = DATABASE_URL):
+    if url.startswith("sqlite"):
+        engine = create_engine(
+            url,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            connect_args={"check_same_thread": False, "timeout": DB_BUSY_TIMEOUT / 1000},
+        )
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    else:
+        engine = create_engine(url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                               pool_timeout=DB_POOL_TIMEOUT, pool_pre_ping=True)
+    metrics.instrument_engine(engine)
+    return engine
+
+def init_db(url: str = DATABASE_URL):
+    import migrations
+    import roles
+
+    engine = create_db_engine(url)
+    # Schema creation and upgrades run under the write lock in one
+    # transaction, so several workers can start on the same file at once
+    with engine.begin() as conn:
+        migrations.acquire_lock(conn)
+        fresh = not inspect(conn).has_table(Match.__tablename__)
+        Base.metadata.create_all(conn)
+        migrations.upgrade(conn, fresh=fresh)
+        roles.seed(conn)
+        roles.cache.reload(conn)
+    SessionLocal.configure(bind=engine)
     return engine
 
+def _call_with_session(func, *args, **kwargs):
+    with SessionLocal() as session:
+        return func(session, *args, **kwargs)
+
+async def run_db(func, *args, **kwargs):
+    # Runs func(session, *args, **kwargs) on the DB executor with its own session.
+    # The context is copied so SQL run there is counted for the current request.
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        db_executor, functools.partial(context.run, _call_with_session, func, *args, **kwargs)
+    )
+
 if __name__ == "__main__":
     init_db()
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+from db import BusEvent, run_db
+from config import (EVENTS_QUEUE_SIZE, EVENTS_HEARTBEAT_SECONDS, EVENTS_RELAY_SECONDS,
+                    EVENTS_RELAY_RETENTION_SECONDS, SERVER_WORKERS)
+
+logger = logging.getLogger(__name__)
+
+# In-process pub/sub behind the /events Server-Sent Events stream. Write routes
+# publish after their transaction commits; every connected client has a
+# bounded queue and only receives events addressed to it:
+#
+#   user_id         that user only (their bets, their approvals)
+#   tournament_id   approved participants of the tournament
+#   admins=True     admins only (new participation requests)
+#
+# A client whose queue fills up loses the backlog and gets a single "resync"
+# event instead, after which it reloads through /sync. Events are hints, the
+# data itself is always read through the regular endpoints.
+#
+# The bus lives in one process. With several workers, start() runs a relay:
+# every EVENTS_RELAY_SECONDS a worker appends what it published to the
+# bus_events table and delivers the rows the other workers appended since its
+# last look, so a client hears writes served by any worker about a second later.
+
+class Subscriber:
+    def __init__(self, user_id: int, tournament_ids, is_admin: bool):
+        self.user_id = user_id
+        self.tournament_ids = set(tournament_ids)
+        self.is_admin = is_admin
+        self.queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+
+    def wants(self, user_id: int, tournament_id: int, admins: bool) -> bool:
+        if user_id is not None:
+            return user_id == self.user_id
+        if admins:
+            return self.is_admin
+        if tournament_id is not None:
+            return tournament_id in self.tournament_ids or self.is_admin
+        return True
+
+    def put(self, event: dict) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync"})
+            logger.info("Event queue of user %s overflowed, asking for a resync", self.user_id)
+
+# Pseudo event type relaying grant() to the other workers
+_GRANT = "_grant"
+
+def exchange(db: Session, origin: int, last_id: int, outbox: list) -> tuple:
+    # Appends this worker's events (bus_events column dicts) and returns
+    # (last row id, rows of the other workers after last_id). With last_id
+    # None the relay starts from the current end of the table.
+    if outbox:
+        db.execute(insert(BusEvent), [{"origin": origin, **row} for row in outbox])
+        db.execute(delete(BusEvent).where(
+            BusEvent.created_at < datetime.utcnow() - timedelta(seconds=EVENTS_RELAY_RETENTION_SECONDS)
+        ).execution_options(synchronize_session=False))
+        db.commit()
+    if last_id is None:
+        return db.execute(select(func.max(BusEvent.id))).scalar() or 0, []
+    rows = db.execute(
+        select(BusEvent.id, BusEvent.origin, BusEvent.type, BusEvent.data,
+               BusEvent.user_id, BusEvent.tournament_id, BusEvent.admins)
+        .where(BusEvent.id > last_id)
+        .order_by(BusEvent.id)
+    ).all()
+    if rows:
+        last_id = rows[-1].id
+    return last_id, [row for row in rows if row.origin != origin]
+
+class EventBus:
+    def __init__(self):
+        self._subscribers = set()
+        self._origin = os.getpid()
+        self._outbox = None  # a list while the relay runs
+        self._last_id = None
+        self._task = None
+
+    def subscribe(self, user_id: int, tournament_ids, is_admin: bool) -> Subscriber:
+        subscriber = Subscriber(user_id, tournament_ids, is_admin)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self._subscribers.discard(subscriber)
+
+    def publish(self, event_type: str, data: dict = None, user_id: int = None,
+                tournament_id: int = None, admins: bool = False) -> int:
+        # Must be called on the event loop, i.e. from the async route after run_db()
+        event = {"type": event_type, **(data or {})}
+        if self._outbox is not None:
+            self._outbox.append({"type": event_type, "data": json.dumps(event), "user_id": user_id,
+                                 "tournament_id": tournament_id, "admins": admins})
+        return self._deliver(event, user_id, tournament_id, admins)
+
+    def _deliver(self, event: dict, user_id: int, tournament_id: int, admins: bool) -> int:
+        delivered = 0
+        for subscriber in list(self._subscribers):
+            if subscriber.wants(user_id, tournament_id, admins):
+                subscriber.put(event)
+                delivered += 1
+        return delivered
+
+    def grant(self, user_id: int, tournament_id: int) -> None:
+        # Approved participants start receiving the tournament without reconnecting
+        if self._outbox is not None:
+            self._outbox.append({"type": _GRANT, "data": "{}", "user_id": user_id,
+                                 "tournament_id": tournament_id, "admins": False})
+        self._grant(user_id, tournament_id)
+
+    def _grant(self, user_id: int, tournament_id: int) -> None:
+        for subscriber in self._subscribers:
+            if subscriber.user_id == user_id:
+                subscriber.tournament_ids.add(tournament_id)
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    async def _relay(self) -> None:
+        while True:
+            outbox, self._outbox = self._outbox, []
+            try:
+                self._last_id, rows = await run_db(exchange, self._origin, self._last_id, outbox)
+            except Exception as e:
+                # Events are hints: the lost ones are caught up through /sync
+                logger.error("Event relay failed, %d events not relayed: %s", len(outbox), e, exc_info=True)
+                rows = []
+            for row in rows:
+                if row.type == _GRANT:
+                    self._grant(row.user_id, row.tournament_id)
+                else:
+                    self._deliver(json.loads(row.data), row.user_id, row.tournament_id, row.admins)
+            await asyncio.sleep(EVENTS_RELAY_SECONDS)
+
+    def start(self) -> None:
+        # A single worker has nobody to relay to
+        if self._task is None and SERVER_WORKERS > 1:
+            self._outbox = []
+            self._task = asyncio.create_task(self._relay(), name="events-relay")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._outbox = None
+
+bus = EventBus()
+
+def format_event(event: dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+async def stream(user_id: int, tournament_ids, is_admin: bool):
+    # SSE body: events as they arrive, a comment line as heartbeat when idle.
+    # Starlette cancels the generator when the client disconnects.
+    subscriber = bus.subscribe(user_id, tournament_ids, is_admin)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), EVENTS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            yield format_event(event)
+    finally:
+        bus.unsubscribe(subscriber)
@@ -0,0 +1,65 @@
+import argparse
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+# A stand-in for the Telegram Bot API to run the notification dispatcher
+# against locally. It accepts sendMessage for any bot token, keeps what it
+# received and answers like Telegram does, including the errors the
+# dispatcher has to handle:
+#
+#   python fakebotapi.py --port 8081 --flood-every 5 --blocked 42 --flood-chats 7
+#   TELEGRAM_API_URL=http://127.0.0.1:8081 python app.py --no-ssl --workers 2
+#
+# GET /messages lists the delivered messages with their arrival time,
+# DELETE /messages clears them. notifycheck.py runs the dispatcher against it.
+
+def create_app(flood_every: int = 0, retry_after: int = 1, blocked=(), fail_every: int = 0,
+               flood_chats=()) -> Starlette:
+    messages = []
+    calls = {"count": 0}
+
+    async def send_message(request: Request):
+        calls["count"] += 1
+        body = await request.json()
+        chat_id = int(body["chat_id"])
+        if chat_id in blocked:
+            return JSONResponse({"ok": False, "error_code": 403,
+                                 "description": "Forbidden: bot was blocked by the user"}, status_code=403)
+        if chat_id in flood_chats or (flood_every and calls["count"] % flood_every == 0):
+            return JSONResponse({"ok": False, "error_code": 429,
+                                 "description": f"Too Many Requests: retry after {retry_after}",
+                                 "parameters": {"retry_after": retry_after}}, status_code=429)
+        if fail_every and calls["count"] % fail_every == 0:
+            return JSONResponse({"ok": False, "error_code": 502, "description": "Bad Gateway"}, status_code=502)
+        messages.append({"chat_id": chat_id, "text": body["text"], "at": time.time()})
+        return JSONResponse({"ok": True, "result": {"message_id": len(messages), "chat": {"id": chat_id},
+                                                    "text": body["text"]}})
+
+    async def list_messages(request: Request):
+        if request.method == "DELETE":
+            messages.clear()
+        return JSONResponse({"calls": calls["count"], "messages": messages})
+
+    return Starlette(routes=[
+        Route("/bot{token}/sendMessage", send_message, methods=["POST"]),
+        Route("/messages", list_messages, methods=["GET", "DELETE"]),
+    ])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API for local notification runs")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--flood-every", type=int, default=0, help="answer every Nth call with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--fail-every", type=int, default=0, help="answer every Nth call with 502")
+    parser.add_argument("--blocked", type=int, nargs="*", default=[], help="chat ids answered with 403")
+    parser.add_argument("--flood-chats", type=int, nargs="*", default=[], help="chat ids always answered with 429")
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(args.flood_every, args.retry_after, set(args.blocked), args.fail_every,
+                           set(args.flood_chats)),
+                host="127.0.0.1", port=args.port)
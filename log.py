@@ -0,0 +1,102 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import re
+
+# Non-blocking logging: every module logs through its own logger into a
+# QueueHandler, and a QueueListener thread formats and writes the records.
+# The calling thread never formats a message, so use lazy %-style arguments
+# (logger.debug("matches %d", len(matches))) rather than f-strings.
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats the record before enqueueing it;
+    # the queue is in-process, so the record can be handed over as is
+    def prepare(self, record):
+        return record
+
+class SamplingFilter(logging.Filter):
+    # Passes DEBUG records with probability debug_rate. Any record can set its
+    # own rate with extra={"sample_rate": 0.01} for high-volume events.
+    def __init__(self, debug_rate: float = 1.0):
+        super().__init__()
+        self.debug_rate = debug_rate
+
+    def filter(self, record):
+        rate = getattr(record, "sample_rate", None)
+        if rate is None:
+            rate = self.debug_rate if record.levelno <= logging.DEBUG else 1.0
+        return rate >= 1.0 or random.random() < rate
+
+class RedactFilter(logging.Filter):
+    # Replaces pattern matches in the message and in each argument. Arguments
+    # are redacted one by one rather than merged into the message, because
+    # uvicorn's access formatter unpacks them; non-str arguments (httpx URLs)
+    # are swapped for their redacted text only when they contain a match.
+    def __init__(self, pattern: str, replacement: str):
+        super().__init__()
+        self._re = re.compile(pattern)
+        self._replacement = replacement
+
+    def _redact(self, value):
+        if isinstance(value, (int, float)):
+            return value
+        text = str(value)
+        redacted = self._re.sub(self._replacement, text)
+        return redacted if redacted != text else value
+
+    def filter(self, record):
+        if isinstance(record.msg, str):
+            record.msg = self._redact(record.msg)
+        if isinstance(record.args, tuple):
+            record.args = tuple(self._redact(arg) for arg in record.args)
+        return True
+
+# HTTP client loggers are quiet unless LOG_LEVELS asks for them
+QUIET_LOGGERS = {"httpx": "WARNING", "httpcore": "WARNING"}
+
+# Secrets kept out of the logs either way: Bot API URLs carry the bot token,
+# and /events is opened with its stream token in the query string
+REDACTED_LOGGERS = {
+    "httpx": (r"/bot[^/\s]+/", "/bot<redacted>/"),
+    "httpcore": (r"/bot[^/\s]+/", "/bot<redacted>/"),
+    "uvicorn.access": (r"([?&]token=)[^&\s]+", r"\1<redacted>"),
+}
+
+def parse_levels(spec: str) -> dict:
+    # "routes=DEBUG,auth=WARNING" -> {"routes": "DEBUG", "auth": "WARNING"}
+    levels = {}
+    for item in spec.split(","):
+        name, sep, level = item.partition("=")
+        if sep and name.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+_listener = None
+
+def setup_logging(level: str = "INFO", module_levels: dict = None, debug_sample_rate: float = 1.0):
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+    for name, module_level in {**QUIET_LOGGERS, **(module_levels or {})}.items():
+        logging.getLogger(name).setLevel(module_level)
+    for name, (pattern, replacement) in REDACTED_LOGGERS.items():
+        logging.getLogger(name).addFilter(RedactFilter(pattern, replacement))
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,194 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+from config import SLOW_REQUEST_SECONDS
+import budgets
+
+logger = logging.getLogger(__name__)
+
+# Request instrumentation: MetricsMiddleware times every HTTP request and
+# engine hooks count the SQL statements it runs. The per-request state lives in
+# a context variable; run_db() copies the context into the executor thread, so
+# statements issued there are attributed to the request that awaited them.
+# Everything is rendered on /metrics in the Prometheus text format.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+class RequestStats:
+    __slots__ = ("statements", "db_seconds", "kilosteps", "log")
+
+    def __init__(self, keep_statements: bool):
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.kilosteps = 0  # only counted while query budgets are checked
+        # (seconds, SQL) of every statement, collected only for the slow request log
+        self.log = [] if keep_statements else None
+
+_current = contextvars.ContextVar("request_stats", default=None)
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self, label_names: tuple) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            base = _labels(label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{base}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{base}}} {series[-1]}")
+        return lines
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple, value: float = 1) -> None:
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + value
+
+    def render(self, label_names: tuple) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._series.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{{{_labels(label_names, labels)}}} {value}")
+        return lines
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: tuple, values: tuple) -> str:
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+ROUTE_LABELS = ("method", "route")
+
+requests_total = Counter("http_requests_total", "HTTP requests by route and status")
+request_seconds = Histogram("http_request_duration_seconds", "Request latency", LATENCY_BUCKETS)
+response_bytes = Histogram("http_response_size_bytes", "Response body size", SIZE_BUCKETS)
+db_statements = Histogram("http_request_db_statements", "SQL statements run per request", STATEMENT_BUCKETS)
+db_seconds = Histogram("http_request_db_seconds", "Time spent in SQL per request", LATENCY_BUCKETS)
+admission_rejections = Counter("admission_rejections_total", "Requests refused by admission control")
+
+def render() -> str:
+    lines = requests_total.render(ROUTE_LABELS + ("status",))
+    lines.extend(admission_rejections.render(("limit", "reason")))
+    for histogram in (request_seconds, response_bytes, db_statements, db_seconds):
+        lines.extend(histogram.render(ROUTE_LABELS))
+    return "\n".join(lines) + "\n"
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None:
+        return
+    started = conn.info.get("query_start")
+    elapsed = time.perf_counter() - started.pop() if started else 0.0
+    stats.statements += 1
+    stats.db_seconds += elapsed
+    if stats.log is not None:
+        stats.log.append((elapsed, statement))
+
+def _count_steps():
+    stats = _current.get()
+    if stats is not None:
+        stats.kilosteps += 1
+    return 0
+
+def _install_step_counter(dbapi_connection, connection_record):
+    # SQLite calls the handler every 1000 VM instructions
+    dbapi_connection.set_progress_handler(_count_steps, 1000)
+
+def instrument_engine(engine) -> None:
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    if budgets.enabled() and engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _install_step_counter)
+
+def _route_label(scope) -> str:
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    # Mounted apps such as /static only leave their prefix in root_path
+    if scope.get("endpoint") is not None:
+        return scope.get("root_path") or "<mount>"
+    return "<unmatched>"
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(keep_statements=SLOW_REQUEST_SECONDS > 0)
+        token = _current.set(stats)
+        status = 500
+        size = 0
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+            labels = (scope["method"], _route_label(scope))
+            requests_total.inc(labels + (status,))
+            request_seconds.observe(labels, elapsed)
+            response_bytes.observe(labels, size)
+            db_statements.observe(labels, stats.statements)
+            db_seconds.observe(labels, stats.db_seconds)
+
+            if budgets.enabled():
+                budgets.check(labels[0], labels[1], scope.get("endpoint"), stats.statements, stats.kilosteps)
+
+            if SLOW_REQUEST_SECONDS > 0 and elapsed >= SLOW_REQUEST_SECONDS:
+                logger.warning(
+                    "Slow request %s %s: %.3fs, %d statements in %.3fs\n%s",
+                    scope["method"], scope["path"], elapsed, stats.statements, stats.db_seconds,
+                    "\n".join(f"  {seconds * 1000:.1f}ms {' '.join(sql.split())}" for seconds, sql in stats.log),
+                )
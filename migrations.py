@@ -0,0 +1,157 @@
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from config import MIGRATION_LOCK_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Schema upgrades for existing daggybot.db files. The applied version is kept in
+# SQLite's PRAGMA user_version. Fresh databases get the current schema from
+# create_all() and are stamped with the latest version without running steps.
+# Each step receives a connection inside a transaction and must be safe to
+# re-run on a database where it was partially applied.
+
+# Steps spell out their indexes instead of reading them from the models in
+# db.py: the models describe the latest schema, which may reference columns a
+# later step has not added yet.
+
+def _create_indexes(conn, *indexes):
+    # indexes: (name, table, columns, unique)
+    for name, table, columns, unique in indexes:
+        conn.exec_driver_sql(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+        )
+
+def _v1_indexes_and_uniqueness(conn):
+    # Bets used to be stored with the Telegram id in bets.user_id
+    conn.execute(text("""
+        UPDATE bets SET user_id = (SELECT users.id FROM users WHERE users.tg_id = bets.user_id)
+        WHERE user_id NOT IN (SELECT id FROM users)
+          AND user_id IN (SELECT tg_id FROM users)
+    """))
+    # Keep the latest bet per (user, match) before adding the unique index
+    conn.execute(text("""
+        DELETE FROM bets WHERE id NOT IN (
+            SELECT MAX(id) FROM bets GROUP BY user_id, match_id
+        )
+    """))
+    # Keep one participation per (user, tournament), preferring the approved one
+    conn.execute(text("""
+        DELETE FROM participations WHERE id NOT IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY user_id, tournament_id ORDER BY approved DESC, id
+                ) AS rn
+                FROM participations
+            ) WHERE rn = 1
+        )
+    """))
+    _create_indexes(
+        conn,
+        ("ix_matches_tournament_start", "matches", ("tournament_id", "start_time_utc"), False),
+        ("ix_matches_start", "matches", ("start_time_utc",), False),
+        ("uq_bets_user_match", "bets", ("user_id", "match_id"), True),
+        ("ix_bets_match", "bets", ("match_id",), False),
+        ("uq_participations_user_tournament", "participations", ("user_id", "tournament_id"), True),
+        ("ix_participations_tournament_approved", "participations", ("tournament_id", "approved", "user_id"), False),
+        ("ix_participations_approved", "participations", ("approved",), False),
+    )
+
+def _v2_match_locked(conn):
+    columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(matches)")}
+    if 'locked' not in columns:
+        conn.exec_driver_sql("ALTER TABLE matches ADD COLUMN locked BOOLEAN NOT NULL DEFAULT 0")
+    # Matches that already kicked off; start_time_utc is stored as naive UTC
+    conn.execute(
+        text("UPDATE matches SET locked = 1 WHERE locked = 0 AND start_time_utc <= :now"),
+        {"now": datetime.utcnow().isoformat(sep=" ")}
+    )
+    _create_indexes(conn, ("ix_matches_locked_start", "matches", ("locked", "start_time_utc"), False))
+
+def _v3_match_reminded(conn):
+    columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(matches)")}
+    if 'reminded' not in columns:
+        conn.exec_driver_sql("ALTER TABLE matches ADD COLUMN reminded BOOLEAN NOT NULL DEFAULT 0")
+    # No reminders for matches that already kicked off
+    conn.execute(text("UPDATE matches SET reminded = 1 WHERE reminded = 0 AND locked = 1"))
+
+def _v4_match_bet_stats(conn):
+    # The table comes from create_all(), filled here from the existing bets
+    conn.execute(text("DELETE FROM match_bet_stats"))
+    conn.execute(text("""
+        INSERT INTO match_bet_stats (match_id, score_1, score_2, bets)
+        SELECT match_id, score_1, score_2, COUNT(*) FROM bets GROUP BY match_id, score_1, score_2
+    """))
+
+def _v5_tournament_archives(conn):
+    # The archive tables come from create_all()
+    columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(tournaments)")}
+    if 'archived_at' not in columns:
+        conn.exec_driver_sql("ALTER TABLE tournaments ADD COLUMN archived_at DATETIME")
+
+def _v6_standings(conn):
+    # The standings table came from create_all() empty; fill it for the
+    # participants approved before it existed. reconcile() only reads columns
+    # every schema since v1 has.
+    import standings
+    standings.reconcile(conn)
+
+MIGRATIONS = [
+    (1, _v1_indexes_and_uniqueness),
+    (2, _v2_match_locked),
+    (3, _v3_match_reminded),
+    (4, _v4_match_bet_stats),
+    (5, _v5_tournament_archives),
+    (6, _v6_standings),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_version(conn) -> int:
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+def _set_version(conn, version: int) -> None:
+    conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+def acquire_lock(conn, timeout: float = MIGRATION_LOCK_TIMEOUT) -> None:
+    # Takes the SQLite write lock for the rest of the transaction. Workers
+    # starting together serialize here: the first one creates and upgrades
+    # the schema, the others find it current once they get the lock.
+    if conn.dialect.name != "sqlite":
+        return
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            return
+        except OperationalError as e:
+            if "locked" not in str(e) or time.monotonic() >= deadline:
+                raise
+            logger.info("Waiting for another worker to finish the schema upgrade")
+            time.sleep(0.5)
+
+def upgrade(conn, fresh: bool = False) -> int:
+    # Runs inside the caller's transaction, see db.init_db()
+    current = get_version(conn)
+    if fresh:
+        _set_version(conn, LATEST_VERSION)
+        return LATEST_VERSION
+
+    applied = False
+    for version, step in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info("Applying schema migration %s: %s", version, step.__name__)
+        step(conn)
+        _set_version(conn, version)
+        current = version
+        applied = True
+
+    if applied:
+        # Refresh planner statistics for the new indexes
+        conn.exec_driver_sql("ANALYZE")
+    return current
@@ -0,0 +1,316 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import delete, func, insert, literal, select, update
+from sqlalchemy.orm import Session, aliased
+
+from db import Notification, Match, Team, Tournament, User, Bet, Participation, run_db
+from config import (TELEGRAM_API_URL, NOTIFICATIONS_ENABLED, NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE,
+                    NOTIFY_BATCH_SIZE, NOTIFY_CONCURRENCY, NOTIFY_LEASE_SECONDS, NOTIFY_POLL_SECONDS,
+                    NOTIFY_MAX_ATTEMPTS, NOTIFY_BACKOFF_SECONDS, NOTIFY_BACKOFF_MAX_SECONDS,
+                    NOTIFY_MESSAGE_LIMIT, MATCH_REMINDER_MINUTES, SERVER_WORKERS, get_bot_token)
+
+logger = logging.getLogger(__name__)
+
+# Outbound Telegram messages. Writers queue rows in the notifications table
+# inside their own transaction (a results broadcast is one INSERT ... SELECT),
+# so a request never waits for the Bot API and a restart loses nothing.
+#
+# The dispatcher runs in every worker. Each round it claims a batch of due
+# rows by pushing next_attempt_at forward by a lease, so workers never send
+# the same row twice unless one dies mid-send. Messages for the same chat are
+# coalesced into as few sendMessage calls as fit NOTIFY_MESSAGE_LIMIT. Token
+# buckets keep to the Bot API limits: NOTIFY_GLOBAL_RATE is shared out
+# between SERVER_WORKERS processes, and each chat gets NOTIFY_CHAT_RATE per
+# worker. Delivered rows are deleted. A 429 reschedules after retry_after.
+# Other failures back off exponentially up to NOTIFY_MAX_ATTEMPTS. Rejections
+# such as a user who blocked the bot are marked failed at once.
+
+# Queueing, called by writers before they commit
+
+def _match_title(db: Session, match_id: int) -> str:
+    team_1, team_2 = aliased(Team), aliased(Team)
+    names = db.execute(
+        select(team_1.name_ru, team_2.name_ru)
+        .select_from(Match)
+        .join(team_1, team_1.id == Match.team_1_id)
+        .join(team_2, team_2.id == Match.team_2_id)
+        .where(Match.id == match_id)
+    ).one()
+    return f"{names[0]} – {names[1]}"
+
+def queue_participation_approved(db: Session, user_id: int, tournament_id: int) -> None:
+    db.execute(insert(Notification).from_select(
+        ["chat_id", "text"],
+        select(
+            User.tg_id,
+            literal("Заявка на участие в турнире «")
+            + select(Tournament.name_ru).where(Tournament.id == tournament_id).scalar_subquery()
+            + literal("» одобрена")
+        )
+        .where(User.id == user_id)
+    ))
+
+def queue_match_results(db: Session, match_id: int, score_1: int, score_2: int) -> None:
+    # One message per bettor with their prediction and points, in a single statement
+    title = _match_title(db, match_id)
+    db.execute(insert(Notification).from_select(
+        ["chat_id", "text"],
+        select(
+            User.tg_id,
+            literal(f"Матч {title} завершился {score_1}:{score_2}. Ваш прогноз ")
+            + func.printf("%d:%d, очки: %g", Bet.score_1, Bet.score_2, func.coalesce(Bet.points, 0))
+        )
+        .select_from(Bet)
+        .join(User, User.id == Bet.user_id)
+        .where(Bet.match_id == match_id)
+    ))
+
+def queue_score_correction(db: Session, match_id: int, score_1: int, score_2: int) -> None:
+    # Short notice to the bettors of a match settled again with another score
+    title = _match_title(db, match_id)
+    db.execute(insert(Notification).from_select(
+        ["chat_id", "text"],
+        select(
+            User.tg_id,
+            literal(f"Счёт матча {title} исправлен на {score_1}:{score_2}. ")
+            + func.printf("Ваши очки: %g", func.coalesce(Bet.points, 0))
+        )
+        .select_from(Bet)
+        .join(User, User.id == Bet.user_id)
+        .where(Bet.match_id == match_id)
+    ))
+
+def queue_match_reminder(db: Session, match_id: int, tournament_id: int, start_time_utc: datetime) -> None:
+    # Approved participants who have not bet on the match yet
+    minutes = max(int((start_time_utc - datetime.utcnow()).total_seconds() // 60), 1)
+    text = f"Через {minutes} мин. начинается матч {_match_title(db, match_id)}, а ставки от вас ещё нет"
+    db.execute(insert(Notification).from_select(
+        ["chat_id", "text"],
+        select(User.tg_id, literal(text))
+        .select_from(Participation)
+        .join(User, User.id == Participation.user_id)
+        .where(
+            Participation.tournament_id == tournament_id,
+            Participation.approved == True,
+            ~select(Bet.id).where(Bet.match_id == match_id, Bet.user_id == Participation.user_id).exists()
+        )
+    ))
+
+def remind_due_matches(db: Session, now: datetime = None) -> int:
+    # Queues reminders for unlocked matches starting within MATCH_REMINDER_MINUTES,
+    # the UPDATE makes sure each match is reminded once across workers
+    now = now or datetime.utcnow()
+    due = db.execute(
+        update(Match)
+        .where(Match.locked == False, Match.reminded == False,
+               Match.start_time_utc <= now + timedelta(minutes=MATCH_REMINDER_MINUTES),
+               Match.start_time_utc > now)
+        .values(reminded=True)
+        .returning(Match.id, Match.tournament_id, Match.start_time_utc)
+        .execution_options(synchronize_session=False)
+    ).all()
+    for match_id, tournament_id, start_time_utc in due:
+        queue_match_reminder(db, match_id, tournament_id, start_time_utc)
+    db.commit()
+    return len(due)
+
+# Delivery
+
+def claim_due(db: Session, limit: int = NOTIFY_BATCH_SIZE, now: datetime = None) -> list:
+    # Returns (id, chat_id, text, attempts) of the claimed rows, oldest first
+    now = now or datetime.utcnow()
+    due = (
+        select(Notification.id)
+        .where(Notification.failed == False, Notification.next_attempt_at <= now)
+        .order_by(Notification.next_attempt_at)
+        .limit(limit)
+        .scalar_subquery()
+    )
+    rows = db.execute(
+        update(Notification)
+        .where(Notification.id.in_(due))
+        .values(next_attempt_at=now + timedelta(seconds=NOTIFY_LEASE_SECONDS))
+        .returning(Notification.id, Notification.chat_id, Notification.text, Notification.attempts)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+    return sorted(rows)
+
+def complete(db: Session, delivered: list, retry: dict, failed: dict) -> None:
+    # delivered: ids; retry: id -> (next attempt, error, counts as an attempt); failed: id -> error
+    if delivered:
+        db.execute(delete(Notification).where(Notification.id.in_(delivered)))
+    for notification_id, (next_attempt_at, error, counts) in retry.items():
+        values = {"next_attempt_at": next_attempt_at, "last_error": error}
+        if counts:
+            values["attempts"] = Notification.attempts + 1
+        db.execute(update(Notification).where(Notification.id == notification_id).values(**values))
+    for notification_id, error in failed.items():
+        db.execute(
+            update(Notification).where(Notification.id == notification_id)
+            .values(failed=True, attempts=Notification.attempts + 1, last_error=error)
+        )
+    db.commit()
+
+def coalesce(rows: list, limit: int = NOTIFY_MESSAGE_LIMIT) -> list:
+    # Groups claimed rows into (chat_id, text, ids) messages, keeping each chat's order
+    chats = OrderedDict()
+    for notification_id, chat_id, text, attempts in rows:
+        messages = chats.setdefault(chat_id, [])
+        if messages and len(messages[-1][0]) + 2 + len(text) <= limit:
+            messages[-1][0] += "\n\n" + text
+            messages[-1][1].append(notification_id)
+        else:
+            messages.append([text[:limit], [notification_id]])
+    return [(chat_id, text, ids) for chat_id, messages in chats.items() for text, ids in messages]
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self) -> None:
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        # After a 429: no tokens until retry_after has passed. Pauses do not
+        # add up, several chats hitting the flood limit at once wait only once.
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+def backoff(attempts: int) -> float:
+    delay = min(NOTIFY_BACKOFF_SECONDS * 2 ** attempts, NOTIFY_BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+class NotificationDispatcher:
+    def __init__(self):
+        self._global = TokenBucket(NOTIFY_GLOBAL_RATE / max(SERVER_WORKERS, 1))
+        self._chats = {}  # chat_id -> TokenBucket
+        self._wakeup = None  # created in start(), on the loop it belongs to
+        self._task = None
+        self._client = None
+
+    def wake(self) -> None:
+        # Called by writers on the event loop after committing new notifications
+        if self._task is not None:
+            self._wakeup.set()
+
+    async def _send(self, chat_id: int, text: str) -> tuple:
+        # Returns (outcome, delay, error): outcome is "ok", "retry" or "failed",
+        # delay is the Bot API's retry_after, None to back off as usual
+        chat = self._chats.setdefault(chat_id, TokenBucket(NOTIFY_CHAT_RATE))
+        await chat.take()
+        await self._global.take()
+        try:
+            response = await self._client.post(
+                f"{TELEGRAM_API_URL}/bot{get_bot_token()}/sendMessage",
+                json={"chat_id": chat_id, "text": text},
+            )
+            body = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            return "retry", None, f"{type(e).__name__}: {e}"
+        if response.status_code == 200 and body.get("ok"):
+            return "ok", None, None
+        error = body.get("description") or f"HTTP {response.status_code}"
+        if response.status_code == 429:
+            retry_after = float((body.get("parameters") or {}).get("retry_after", 1))
+            chat.pause(retry_after)
+            # The flood limit is per bot as well, the other chats wait too
+            self._global.pause(retry_after)
+            return "retry", retry_after, error
+        if response.status_code >= 500:
+            return "retry", None, error
+        return "failed", None, error
+
+    async def dispatch_once(self) -> int:
+        # One round: claim, send, record the outcome. Returns the rows claimed.
+        rows = await run_db(claim_due)
+        if not rows:
+            return 0
+        attempts = {notification_id: count for notification_id, _, _, count in rows}
+        delivered, retry, failed = [], {}, {}
+        semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+        async def send_chat(messages):
+            # A chat's messages go out in order, one after another
+            async with semaphore:
+                for chat_id, text, ids in messages:
+                    outcome, delay, error = await self._send(chat_id, text)
+                    if outcome == "ok":
+                        delivered.extend(ids)
+                        continue
+                    for notification_id in ids:
+                        if outcome == "failed" or (delay is None and attempts[notification_id] + 1 >= NOTIFY_MAX_ATTEMPTS):
+                            failed[notification_id] = error
+                        else:
+                            wait = delay if delay is not None else backoff(attempts[notification_id])
+                            retry[notification_id] = (datetime.utcnow() + timedelta(seconds=wait), error, delay is None)
+                    logger.warning("Notification to chat %s not sent: %s", chat_id, error)
+
+        by_chat = OrderedDict()
+        for message in coalesce(rows):
+            by_chat.setdefault(message[0], []).append(message)
+        await asyncio.gather(*(send_chat(messages) for messages in by_chat.values()))
+        await run_db(complete, delivered, retry, failed)
+
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.idle()]:
+            del self._chats[chat_id]
+        logger.debug("Notifications: %d delivered, %d to retry, %d failed", len(delivered), len(retry), len(failed))
+        return len(rows)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                # Cleared first, so rows queued while a round is sending wake the next one
+                self._wakeup.clear()
+                if await self.dispatch_once() >= NOTIFY_BATCH_SIZE:
+                    continue  # more are waiting
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), NOTIFY_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Notification dispatcher error: %s", e, exc_info=True)
+                await asyncio.sleep(NOTIFY_POLL_SECONDS)
+
+    def start(self) -> None:
+        if NOTIFICATIONS_ENABLED and self._task is None:
+            self._wakeup = asyncio.Event()
+            self._client = httpx.AsyncClient(timeout=10)
+            self._task = asyncio.create_task(self._run(), name="notification-dispatcher")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self._client.aclose()
+
+dispatcher = NotificationDispatcher()
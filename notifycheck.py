@@ -0,0 +1,146 @@
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Runs the notification dispatcher against fakebotapi.py on a scratch
+# database and checks how it handles the Bot API's answers:
+#
+#   delivery     rows are sent and deleted, a chat's rows go out coalesced
+#                into one sendMessage
+#   429          the row stays queued, due after retry_after, the attempt
+#                is not counted and the worker's sends to every chat pause
+#   403          the row is marked failed at once
+#
+# Usage: python notifycheck.py   (exit status 1 when a check fails)
+
+RETRY_AFTER = 7
+FLOOD_CHAT = 700
+BLOCKED_CHAT = 403
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_fake_api(port: int):
+    import httpx
+    import uvicorn
+    from fakebotapi import create_app
+
+    server = uvicorn.Server(uvicorn.Config(
+        create_app(retry_after=RETRY_AFTER, blocked={BLOCKED_CHAT}, flood_chats={FLOOD_CHAT}),
+        host="127.0.0.1", port=port, log_level="warning",
+    ))
+    threading.Thread(target=server.run, daemon=True).start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/messages")
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError("fakebotapi did not start")
+
+async def dispatch(rows: list) -> list:
+    # Queues (chat_id, text) rows and runs the dispatcher until they are all
+    # handled; returns the ids of the queued rows
+    from db import SessionLocal, Notification, run_db
+    from notifications import dispatcher
+
+    def queue(db):
+        notifications = [Notification(chat_id=chat_id, text=text) for chat_id, text in rows]
+        db.add_all(notifications)
+        db.commit()
+        return [notification.id for notification in notifications]
+
+    def pending(db, ids):
+        # Rows neither delivered nor answered yet (claimed rows have attempts == 0 and no error)
+        return db.query(Notification).filter(
+            Notification.id.in_(ids), Notification.failed == False, Notification.last_error.is_(None)
+        ).count()
+
+    ids = await run_db(queue)
+    dispatcher.wake()
+    deadline = time.monotonic() + 10
+    while await run_db(pending, ids) and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    return ids
+
+async def check(api_url: str) -> list:
+    import httpx
+    from db import Notification, run_db
+    from notifications import dispatcher
+
+    failures = []
+
+    def expect(condition: bool, message: str) -> None:
+        print(("ok   " if condition else "FAIL ") + message)
+        if not condition:
+            failures.append(message)
+
+    def load(db, ids):
+        return {n.id: n for n in db.query(Notification).filter(Notification.id.in_(ids))}
+
+    dispatcher.start()
+    try:
+        ids = await dispatch([(101, "first"), (101, "second"), (101, "third"), (102, "other chat")])
+        messages = httpx.get(f"{api_url}/messages").json()["messages"]
+        by_chat = {}
+        for message in messages:
+            by_chat.setdefault(message["chat_id"], []).append(message["text"])
+        expect(by_chat.get(101) == ["first\n\nsecond\n\nthird"], "chat 101 got its three rows in one message")
+        expect(by_chat.get(102) == ["other chat"], "chat 102 got its row")
+        expect(not await run_db(load, ids), "delivered rows are deleted")
+
+        started = datetime.utcnow()
+        ids = await dispatch([(FLOOD_CHAT, "flooded")])
+        row = (await run_db(load, ids)).get(ids[0])
+        expect(row is not None and not row.failed, "429: the row stays queued")
+        if row is not None:
+            due_in = (row.next_attempt_at - started).total_seconds()
+            expect(RETRY_AFTER - 1 <= due_in <= RETRY_AFTER + 2,
+                   f"429: due again after retry_after={RETRY_AFTER}s (in {due_in:.1f}s)")
+            expect(row.attempts == 0, "429: not counted as an attempt")
+        paused = -dispatcher._global.tokens / dispatcher._global.rate
+        expect(RETRY_AFTER - 2 <= paused <= RETRY_AFTER, f"429: sends to other chats pause too (for {paused:.1f}s)")
+        # The remaining checks need the Bot API again
+        dispatcher._global.tokens = dispatcher._global.capacity
+
+        ids = await dispatch([(BLOCKED_CHAT, "blocked")])
+        row = (await run_db(load, ids)).get(ids[0])
+        expect(row is not None and row.failed and row.attempts == 1, "403: the row is marked failed")
+        expect(row is not None and "blocked" in (row.last_error or ""), "403: the Bot API's reason is kept")
+    finally:
+        await dispatcher.stop()
+    return failures
+
+def main() -> int:
+    tmp = tempfile.mkdtemp()
+    port = _free_port()
+    api_url = f"http://127.0.0.1:{port}"
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tmp, "notifycheck.db")
+    os.environ["TELEGRAM_API_URL"] = api_url
+    os.environ["NOTIFICATIONS_ENABLED"] = "1"
+    os.environ["SERVER_WORKERS"] = "1"
+    os.environ.setdefault("BOT_TOKEN", "123456:notifycheck")
+
+    from db import init_db
+
+    init_db()
+    server = start_fake_api(port)
+    try:
+        failures = asyncio.run(check(api_url))
+    finally:
+        server.should_exit = True
+    if failures:
+        return 1
+    print("Notification dispatcher checks passed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,379 @@
+import logging
+import base64
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from sqlalchemy import tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, aliased
+
+from db import Tournament, Team, Match, User, Participation, Bet, ScoringRule
+from config import DEFAULT_SCORING, MATCHES_PAGE_SIZE, MATCHES_MAX_PAGE_SIZE, MATCHES_DEFAULT_PAST_DAYS
+import bets
+import notifications
+import standings
+import sync
+from cache import reference_cache, get_generation, bump_generation, make_etag, etag_matches, hash_ids
+
+logger = logging.getLogger(__name__)
+
+# Data access layer: every function takes a Session as its first argument and
+# is meant to be called through db.run_db(), i.e. on the DB executor thread.
+# Results are returned as plain dicts so no ORM object leaves the thread.
+
+def create_tournament(db: Session, name_ru: str, scoring: dict = None) -> int:
+    tournament = Tournament(name_ru=name_ru)
+    db.add(tournament)
+    if scoring:
+        db.flush()
+        values = {key: float(scoring.get(key, default)) for key, default in DEFAULT_SCORING.items()}
+        db.add(ScoringRule(tournament_id=tournament.id, **values))
+    bump_generation(db, 'tournaments')
+    db.commit()
+    return tournament.id
+
+def create_team(db: Session, name_ru: str) -> int:
+    team = Team(name_ru=name_ru)
+    db.add(team)
+    bump_generation(db, 'teams')
+    db.commit()
+    return team.id
+
+def create_match(db: Session, tournament_id: int, team_1_id: int, team_2_id: int, start_time_utc: datetime) -> int:
+    # Get tournament by ID
+    tournament = db.query(Tournament).filter(Tournament.id == tournament_id).first()
+    if not tournament:
+        raise HTTPException(status_code=404, detail="Tournament not found")
+    if tournament.archived_at is not None:
+        raise HTTPException(status_code=409, detail="Tournament is archived")
+
+    # Get teams by ID
+    team1 = db.query(Team).filter(Team.id == team_1_id).first()
+    if not team1:
+        raise HTTPException(status_code=404, detail="Team 1 not found")
+
+    team2 = db.query(Team).filter(Team.id == team_2_id).first()
+    if not team2:
+        raise HTTPException(status_code=404, detail="Team 2 not found")
+
+    match = Match(
+        tournament_id=tournament.id,
+        team_1_id=team1.id,
+        team_2_id=team2.id,
+        start_time_utc=start_time_utc
+    )
+    db.add(match)
+    db.flush()
+    sync.record_change(db, 'match', match.id, tournament_id=match.tournament_id)
+    db.commit()
+    return match.id
+
+def _load_tournaments(db: Session) -> list:
+    # Archived tournaments are listed by archive.list_archives()
+    return [
+        {"id": t.id, "name_ru": t.name_ru}
+        for t in db.query(Tournament).filter(Tournament.archived_at.is_(None)).order_by(Tournament.id).all()
+    ]
+
+def _load_teams(db: Session) -> list:
+    return [{"id": t.id, "name_ru": t.name_ru} for t in db.query(Team).order_by(Team.id).all()]
+
+_REFERENCE_LOADERS = {
+    'tournaments': _load_tournaments,
+    'teams': _load_teams,
+}
+
+def get_reference_listing(db: Session, name: str, if_none_match: str = None) -> tuple:
+    # Returns (etag, JSON body), body is None when the client copy is current
+    generation = get_generation(db, name)
+    etag = make_etag(name, generation)
+    if etag_matches(if_none_match, etag):
+        return etag, None
+    _, _, body = reference_cache.get(db, name, _REFERENCE_LOADERS[name], generation)
+    return etag, body
+
+def list_tournaments(db: Session) -> list:
+    return reference_cache.get(db, 'tournaments', _load_tournaments)[1]
+
+def list_teams(db: Session) -> list:
+    return reference_cache.get(db, 'teams', _load_teams)[1]
+
+def list_available_tournaments(db: Session, user_id: int, if_none_match: str = None) -> tuple:
+    # Get tournaments where user is not already participating.
+    # Returns (etag, tournaments), tournaments is None when the client copy is current
+    existing_participations = db.query(Participation.tournament_id).filter(
+        Participation.user_id == user_id
+    ).all()
+    existing_tournament_ids = {p[0] for p in existing_participations}
+
+    generation = get_generation(db, 'tournaments')
+    etag = make_etag('available', generation, hash_ids(existing_tournament_ids))
+    if etag_matches(if_none_match, etag):
+        return etag, None
+
+    tournaments = reference_cache.get(db, 'tournaments', _load_tournaments, generation)[1]
+    return etag, [t for t in tournaments if t["id"] not in existing_tournament_ids]
+
+def upsert_user(db: Session, user_data: dict) -> tuple:
+    # Called once per /init: returns (users.id, approved tournament ids) for the token
+    name = (user_data.get('first_name', '') + ' ' + user_data.get('last_name', '')).strip()
+    stmt = sqlite_insert(User).values(tg_id=user_data['id'], name=name)
+    user_id = db.execute(
+        stmt.on_conflict_do_update(index_elements=['tg_id'], set_={'name': stmt.excluded.name})
+        .returning(User.id)
+    ).scalar_one()
+    db.commit()
+    return user_id, approved_tournament_ids(db, user_id)
+
+def approved_tournament_ids(db: Session, user_id: int) -> list:
+    tournament_ids = db.query(Participation.tournament_id).filter(
+        Participation.user_id == user_id,
+        Participation.approved == True
+    ).all()
+    return [t[0] for t in tournament_ids]
+
+def create_participation(db: Session, user_id: int, tournament_id: int) -> None:
+    # Check if already participating
+    existing = db.query(Participation).filter(
+        Participation.user_id == user_id,
+        Participation.tournament_id == tournament_id
+    ).first()
+
+    if existing:
+        raise HTTPException(status_code=400, detail="Already participating in this tournament")
+
+    tournament = db.get(Tournament, tournament_id)
+    if tournament is None or tournament.archived_at is not None:
+        raise HTTPException(status_code=404, detail="Tournament not found")
+
+    participation = Participation(
+        user_id=user_id,
+        tournament_id=tournament_id,
+        approved=False
+    )
+    db.add(participation)
+    db.commit()
+
+def list_pending_participations(db: Session) -> list:
+    # Get pending participations with user and tournament info
+    participations = db.query(
+        Participation,
+        User.name.label('user_name'),
+        Tournament.name_ru.label('tournament_name')
+    ).join(
+        User, Participation.user_id == User.id
+    ).join(
+        Tournament, Participation.tournament_id == Tournament.id
+    ).filter(
+        Participation.approved == False
+    ).all()
+
+    return [
+        {
+            "id": p.Participation.id,
+            "user_name": p.user_name,
+            "tournament_name": p.tournament_name
+        }
+        for p in participations
+    ]
+
+def approve_participation(db: Session, participation_id: int) -> dict:
+    # Returns None when the participation is already approved. The UPDATE only
+    # matches a pending row, so a double tap, a retry or two admins approving
+    # at once add the standings row, change and message a single time.
+    approved = db.execute(
+        update(Participation)
+        .where(Participation.id == participation_id, Participation.approved == False)
+        .values(approved=True)
+        .returning(Participation.user_id, Participation.tournament_id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if approved is None:
+        if db.get(Participation, participation_id) is None:
+            raise HTTPException(status_code=404, detail="Participation not found")
+        return None
+
+    user_id, tournament_id = approved
+    standings.add_participant(db, tournament_id, user_id)
+    sync.record_change(db, 'participation', tournament_id, tournament_id=tournament_id, user_id=user_id)
+    notifications.queue_participation_approved(db, user_id, tournament_id)
+    db.commit()
+    return {"user_id": user_id, "tournament_id": tournament_id}
+
+def encode_cursor(start_time_utc: datetime, match_id: int) -> str:
+    raw = f"{start_time_utc.isoformat()}|{match_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        start_time, match_id = raw.split("|", 1)
+        return datetime.fromisoformat(start_time), int(match_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _paginate_matches(query, cursor: str = None, date_from: datetime = None, date_to: datetime = None,
+                      tournament_id: int = None, limit: int = MATCHES_PAGE_SIZE):
+    # Keyset pagination on (start_time_utc, id). Without a cursor or an explicit
+    # window the listing starts MATCHES_DEFAULT_PAST_DAYS ago.
+    limit = min(max(limit, 1), MATCHES_MAX_PAGE_SIZE)
+    if cursor:
+        query = query.filter(tuple_(Match.start_time_utc, Match.id) > tuple_(*decode_cursor(cursor)))
+    elif date_from is None:
+        date_from = datetime.utcnow() - timedelta(days=MATCHES_DEFAULT_PAST_DAYS)
+    if date_from is not None:
+        query = query.filter(Match.start_time_utc >= date_from)
+    if date_to is not None:
+        query = query.filter(Match.start_time_utc < date_to)
+    if tournament_id is not None:
+        query = query.filter(Match.tournament_id == tournament_id)
+
+    rows = query.order_by(Match.start_time_utc, Match.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0]
+        next_cursor = encode_cursor(last.start_time_utc, last.id)
+    return rows, next_cursor
+
+def user_matches_query(db: Session, user_id: int):
+    # Matches of the user's approved tournaments with the user's own bet
+    Team1 = aliased(Team)
+    Team2 = aliased(Team)
+
+    return db.query(
+        Match,
+        Tournament.name_ru.label('tournament_name'),
+        Team1.name_ru.label('team_1_name'),
+        Team2.name_ru.label('team_2_name'),
+        Bet.score_1.label('bet_score_1'),
+        Bet.score_2.label('bet_score_2'),
+        Bet.points
+    ).join(
+        Tournament, Match.tournament_id == Tournament.id
+    ).join(
+        Participation,
+        (Participation.tournament_id == Match.tournament_id) &
+        (Participation.approved == True) &
+        (Participation.user_id == user_id)
+    ).join(
+        Team1, Match.team_1_id == Team1.id
+    ).join(
+        Team2, Match.team_2_id == Team2.id
+    ).outerjoin(
+        Bet, (Bet.match_id == Match.id) & (Bet.user_id == user_id)
+    )
+
+def user_match_data(row) -> dict:
+    match, tournament_name, team1_name, team2_name, bet_score_1, bet_score_2, points = row
+    return {
+        'id': match.id,
+        'tournament_id': match.tournament_id,
+        'tournament_name': tournament_name,
+        'team_1_name': team1_name,
+        'team_2_name': team2_name,
+        'date': match.start_time_utc.isoformat(),
+        'score_1': match.score_1,
+        'score_2': match.score_2,
+        'locked': match.locked,
+        'bet': {
+            'score_1': bet_score_1,
+            'score_2': bet_score_2,
+            'points': points
+        } if bet_score_1 is not None else None
+    }
+
+def list_user_matches(db: Session, user_id: int, **page) -> tuple:
+    # The sync version is read first: a change racing the listing is sent
+    # again by /sync rather than lost
+    version = sync.current_version(db)
+    matches, next_cursor = _paginate_matches(user_matches_query(db, user_id), **page)
+    return [user_match_data(row) for row in matches], next_cursor, version
+
+def list_pending_matches(db: Session, **page) -> tuple:
+    Team1 = aliased(Team)
+    Team2 = aliased(Team)
+
+    matches = db.query(
+        Match,
+        Tournament.name_ru.label('tournament_name'),
+        Team1.name_ru.label('team_1_name'),
+        Team2.name_ru.label('team_2_name')
+    ).join(
+        Tournament, Match.tournament_id == Tournament.id
+    ).join(
+        Team1, Match.team_1_id == Team1.id
+    ).join(
+        Team2, Match.team_2_id == Team2.id
+    )
+    matches, next_cursor = _paginate_matches(matches, **page)
+
+    # Формируем ответ
+    matches_data = []
+    for match, tournament_name, team1_name, team2_name in matches:
+        matches_data.append({
+            'id': match.id,
+            'tournament_name': tournament_name,
+            'team_1_name': team1_name,
+            'team_2_name': team2_name,
+            'date': match.start_time_utc.isoformat(),
+            'score_1': match.score_1,
+            'score_2': match.score_2,
+            'locked': match.locked,
+        })
+    return matches_data, next_cursor
+
+def bootstrap(db: Session, user_data: dict, is_admin: bool) -> dict:
+    # Everything the mini app renders on open, read in one session on one
+    # executor hop: SQLite serves a session serially, so running these
+    # queries side by side would only contend for the pool
+    user_id, tournament_ids = upsert_user(db, user_data)
+    matches, next_cursor, version = list_user_matches(db, user_id)
+    data = {
+        "uid": user_id,
+        "tournament_ids": tournament_ids,
+        "matches": matches,
+        "next_cursor": next_cursor,
+        "version": version,
+        "tournaments": list_tournaments(db),
+        "teams": list_teams(db),
+    }
+    if is_admin:
+        pending_matches, pending_next_cursor = list_pending_matches(db)
+        data.update({
+            "pending_participations": list_pending_participations(db),
+            "pending_matches": pending_matches,
+            "pending_matches_next_cursor": pending_next_cursor,
+        })
+    return data
+
+def save_bet(db: Session, user: dict, match_id: int, score_1: int, score_2: int) -> tuple:
+    # Returns (payload, status_code) in the /place-bet response format.
+    # user is the decoded token carrying users.id and approved tournament ids.
+    user_id = user['uid']
+
+    # Проверяем, что матч еще не начался
+    match = db.query(Match).filter(Match.id == match_id).first()
+    if not match:
+        return {"success": False, "error": "Match not found"}, 404
+
+    if match.locked or match.start_time_utc <= datetime.utcnow():
+        logger.debug("Cannot place bet on started match")
+        return {"success": False, "error": "Cannot place bet on started match"}, 400
+
+    # Проверяем, что пользователь участвует в турнире: токен знает одобренные
+    # турниры, в базу идём только за одобренными после выдачи токена
+    if match.tournament_id not in user.get('tournaments', ()):
+        participation = db.query(Participation.id).filter(
+            Participation.tournament_id == match.tournament_id,
+            Participation.approved == True,
+            Participation.user_id == user_id
+        ).first()
+
+        if not participation:
+            return {"success": False, "error": "User is not participating in this tournament"}, 403
+
+    # Создаем или обновляем ставку тем же upsert, что и /place-bets
+    bets.upsert_bets(db, user_id, [{"match_id": match_id, "score_1": score_1, "score_2": score_2}])
+    sync.record_change(db, 'bet', match_id, tournament_id=match.tournament_id, user_id=user_id)
+    db.commit()
+    return {"success": True}, 200
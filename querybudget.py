@@ -0,0 +1,149 @@
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, quote
+
+# Drives every route through the TestClient against a seeded scratch database
+# and compares the SQL it runs with the route's @query_budget (see budgets.py).
+# Usage: python querybudget.py   (exit status 1 on an overrun or a route without a budget)
+#
+# The kilostep budgets are calibrated for this fixture: a few hundred users
+# and matches, thousands of bets, so a query that reads more than its own
+# user's or match's rows stands out.
+
+FIXTURE = {"tournaments": 5, "users": 300, "teams": 40, "matches": 1000, "bets": 30000, "per_user": 2}
+
+ADMIN_TG_ID = 128772612
+
+def _init_data(user: dict) -> str:
+    from auth import webapp_secret_key
+
+    fields = {"auth_date": str(int(time.time())), "query_id": "budget", "user": json.dumps(user)}
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    fields["hash"] = hmac.new(webapp_secret_key(), check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields, quote_via=quote)
+
+def requests_to_run(token_headers: dict, tournament_id: int, match_id: int, finished_id: int,
+                    archive_id: int) -> list:
+    # (method, path, request kwargs) covering every route once, except the
+    # never-ending /events stream
+    start = (datetime.utcnow() + timedelta(days=3)).isoformat() + "Z"
+    return [
+        ("GET", "/", {}),
+        ("GET", "/metrics", {}),
+        ("POST", "/init", {"json": {"initData": _init_data({"id": ADMIN_TG_ID, "first_name": "Admin"})}}),
+        ("POST", "/bootstrap", {"json": {"initData": _init_data({"id": ADMIN_TG_ID, "first_name": "Admin"})}}),
+        ("GET", "/tournaments", {}),
+        ("GET", "/teams", {}),
+        ("POST", "/add_tournament", {"json": {"name_ru": "Новый турнир"}, "headers": token_headers}),
+        ("POST", "/add_team", {"json": {"name_ru": "Новая команда"}, "headers": token_headers}),
+        ("POST", "/add_match", {"json": {"tournament_id": tournament_id, "team_1_id": 1, "team_2_id": 2, "date": start},
+                                "headers": token_headers}),
+        ("POST", "/import", {"content": "\n".join(json.dumps(record) for record in (
+            {"type": "team", "name": "Импорт 1"},
+            {"type": "team", "name": "Импорт 2"},
+            {"type": "match", "tournament": tournament_id, "team_1": "Импорт 1", "team_2": "Импорт 2", "date": start},
+            {"type": "match", "tournament": tournament_id, "team_1": 1, "team_2": "Импорт 1", "date": start},
+        )), "headers": token_headers}),
+        ("GET", "/available-tournaments", {"headers": token_headers}),
+        ("POST", "/participate", {"json": {"tournament_id": FIXTURE["tournaments"] + 1}, "headers": token_headers}),
+        ("GET", "/pending-participations", {"headers": token_headers}),
+        ("POST", "/approve-participation", {"json": {"participation_id": "latest"}, "headers": token_headers}),
+        ("GET", "/roles", {"headers": token_headers}),
+        ("POST", "/roles", {"json": {"tg_id": 1000001, "role": "player"}, "headers": token_headers}),
+        ("GET", "/user-matches", {"headers": token_headers}),
+        ("GET", "/pending-matches", {"headers": token_headers}),
+        ("GET", "/sync", {"params": {"since": 0}, "headers": token_headers}),
+        ("POST", "/events-token", {"headers": token_headers}),
+        ("GET", "/standings", {"params": {"tournament_id": tournament_id}, "headers": token_headers}),
+        ("POST", "/place-bet", {"json": {"match_id": match_id, "score_1": 1, "score_2": 0}, "headers": token_headers}),
+        ("POST", "/place-bets", {"json": {"bets": [{"match_id": match_id, "score_1": 2, "score_2": 2},
+                                                  {"match_id": finished_id, "score_1": 0, "score_2": 0}]},
+                                 "headers": {**token_headers, "Idempotency-Key": "budget-1"}}),
+        ("GET", "/bet-stats", {"params": {"match_id": finished_id}, "headers": token_headers}),
+        ("POST", "/scoring-rules", {"json": {"tournament_id": tournament_id, "exact_score": 4}, "headers": token_headers}),
+        ("POST", "/finish-match", {"json": {"match_id": finished_id, "score_1": 2, "score_2": 1}, "headers": token_headers}),
+        ("POST", "/archive-tournament", {"json": {"tournament_id": archive_id}, "headers": token_headers}),
+        ("GET", "/archived-tournaments", {"headers": token_headers}),
+        ("GET", "/archived-standings", {"params": {"tournament_id": archive_id}, "headers": token_headers}),
+        ("GET", "/archived-matches", {"params": {"tournament_id": archive_id}, "headers": token_headers}),
+    ]
+
+def main() -> int:
+    tmp = tempfile.mkdtemp()
+    url = "sqlite:///" + os.path.join(tmp, "querybudget.db")
+    os.environ["DATABASE_URL"] = url
+    os.environ["QUERY_BUDGET_MODE"] = "log"
+    # Notifications are queued as usual but not sent anywhere
+    os.environ["NOTIFICATIONS_ENABLED"] = "0"
+
+    from fastapi.routing import APIRoute
+    from fastapi.testclient import TestClient
+    from sqlalchemy import select, func
+
+    import bench
+    bench.seed(url, FIXTURE["tournaments"], FIXTURE["users"], FIXTURE["teams"], FIXTURE["matches"],
+               FIXTURE["bets"], FIXTURE["per_user"], random.Random(1))
+
+    import app as app_module
+    import budgets
+    from auth import create_jwt_token
+    from db import SessionLocal, User, Match, Participation
+
+    with SessionLocal() as db:
+        # The admin user stands in for a regular participant too
+        db.query(User).filter(User.id == 1).update({"tg_id": ADMIN_TG_ID})
+        db.commit()
+        tournament_ids = db.execute(
+            select(Participation.tournament_id).where(Participation.user_id == 1)
+        ).scalars().all()
+        tournament_id = tournament_ids[0]
+        upcoming = db.execute(
+            select(Match.id).where(Match.tournament_id == tournament_id, Match.start_time_utc > datetime.utcnow())
+            .order_by(Match.start_time_utc).limit(1)
+        ).scalar_one()
+        finished = db.execute(
+            select(Match.id).where(Match.tournament_id == tournament_id, Match.is_finished == True).limit(1)
+        ).scalar_one()
+        # The user's other tournament is played out and archived at the end
+        archive_id = tournament_ids[-1]
+        db.query(Match).filter(Match.tournament_id == archive_id).update({"is_finished": True})
+        db.commit()
+
+    token = create_jwt_token({"id": ADMIN_TG_ID, "first_name": "Admin", "uid": 1, "tournaments": tournament_ids})
+    headers = {"Authorization": "Bearer " + token}
+
+    failures = []
+    budgets.record = []
+    with TestClient(app_module.app) as client:
+        # A tournament to ask participation in, outside the seeded ones
+        client.post("/add_tournament", json={"name_ru": "Ещё турнир"}, headers=headers)
+        for method, path, kwargs in requests_to_run(headers, tournament_id, upcoming, finished, archive_id):
+            if path == "/approve-participation":
+                with SessionLocal() as db:
+                    kwargs = {**kwargs, "json": {"participation_id": db.execute(select(func.max(Participation.id))).scalar()}}
+            response = client.request(method, path, **kwargs)
+            statements, kilosteps = budgets.observed.get((method, path), (None, None))
+            print(f"{response.status_code} {method:4} {path:26} {statements} statements, {kilosteps} kilosteps")
+            if response.status_code >= 400:
+                failures.append(f"{method} {path}: HTTP {response.status_code}")
+
+        for route in app_module.app.routes:
+            if isinstance(route, APIRoute) and not hasattr(route.endpoint, "query_budget"):
+                failures.append(f"{route.path}: no @query_budget")
+
+    failures.extend(f"{method} {route}: {problem}" for method, route, problem in budgets.record)
+    for failure in failures:
+        print("FAIL", failure)
+    if not failures:
+        print("All routes within their query budgets")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
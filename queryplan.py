@@ -0,0 +1,137 @@
+import os
+import re
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from db import init_db, Base, SessionLocal
+import queries
+import archive
+import bets
+import betstats
+import settlement
+import standings
+import sync
+import scheduler
+import notifications
+import roles
+import events
+
+# Runs the data access call behind every route against a scratch database,
+# captures the SQL it emits and checks EXPLAIN QUERY PLAN for full table scans.
+# Usage: python queryplan.py   (exit status 1 when a scan is found)
+
+# Reference tables, roles and archive summaries are listed in full on purpose and stay tiny
+SCAN_ALLOWED_TABLES = {"tournaments", "teams", "roles", "tournament_archives"}
+
+_SCAN_RE = re.compile(r"^SCAN (\w+)")
+
+TG_USER = {"id": 1000001, "first_name": "Test"}
+
+def _fixture(db):
+    tournament_id = queries.create_tournament(db, "Турнир")
+    team_1 = queries.create_team(db, "Команда 1")
+    team_2 = queries.create_team(db, "Команда 2")
+    match_id = queries.create_match(db, tournament_id, team_1, team_2, datetime.utcnow() + timedelta(days=1))
+    user_id, _ = queries.upsert_user(db, TG_USER)
+    queries.create_participation(db, user_id, tournament_id)
+    queries.approve_participation(db, 1)
+    return tournament_id, match_id, user_id
+
+def route_calls(tournament_id: int, match_id: int, user_id: int) -> dict:
+    # route -> (data access function, arguments after the session).
+    # The token carries no tournaments so /place-bet takes the DB check.
+    token = {"id": TG_USER["id"], "uid": user_id, "tournaments": []}
+    return {
+        "/init": (queries.upsert_user, (TG_USER,)),
+        "/bootstrap": (queries.bootstrap, (TG_USER, True)),
+        "/tournaments": (queries.list_tournaments, ()),
+        "/teams": (queries.list_teams, ()),
+        "/available-tournaments": (queries.list_available_tournaments, (user_id,)),
+        "/pending-participations": (queries.list_pending_participations, ()),
+        "/user-matches": (queries.list_user_matches, (user_id,)),
+        "/pending-matches": (queries.list_pending_matches, ()),
+        "/place-bet": (queries.save_bet, (token, match_id, 2, 1)),
+        "/place-bets": (bets.save_bets, (token, [{"match_id": match_id, "score_1": 1, "score_2": 1}], "plan-1")),
+        "/standings": (standings.get_standings, (tournament_id, user_id)),
+        "/bet-stats": (betstats.get_stats, (match_id,)),
+        "/sync": (sync.changes_since, (user_id, 0)),
+        "/approve-participation": (queries.approve_participation, (1,)),
+        # Before /finish-match locks the fixture match
+        "scheduler: remind": (notifications.remind_due_matches, (datetime.utcnow() + timedelta(hours=23, minutes=30),)),
+        "/finish-match": (settlement.settle_match, (match_id, 2, 1)),
+        "/roles": (roles.list_roles, ()),
+        "/roles (update)": (roles.set_role, (TG_USER["id"], "player", True)),
+        "betstats: rebuild": (betstats.rebuild, (match_id,)),
+        "scheduler: kickoffs": (scheduler.load_kickoffs, ()),
+        "scheduler: lock": (scheduler.lock_due_matches, ()),
+        "notifications: claim": (notifications.claim_due, ()),
+        "events: relay": (events.exchange, (1, 0, [{"type": "match", "data": "{}", "user_id": None,
+                                                     "tournament_id": tournament_id, "admins": False}])),
+        "notifications: complete": (notifications.complete, ([1], {2: (datetime.utcnow(), "error", True)}, {3: "error"})),
+        # Last: the fixture tournament is played out once /finish-match ran
+        "/archive-tournament": (archive.archive_tournament, (tournament_id,)),
+        "/archived-tournaments": (archive.list_archives, ()),
+        "/archived-standings": (archive.get_standings, (tournament_id, user_id)),
+        "/archived-matches": (archive.list_matches, (tournament_id, user_id)),
+    }
+
+@contextmanager
+def capture_statements(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT")):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+def find_scans(engine, statement: str, parameters) -> list:
+    with engine.connect() as conn:
+        plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        found = _SCAN_RE.match(detail)
+        if not found or detail == "SCAN CONSTANT ROW":
+            continue
+        # Aliased tables are rendered as e.g. teams_1, subqueries are not tables
+        table = re.sub(r"_\d+$", "", found.group(1))
+        if table in Base.metadata.tables and table not in SCAN_ALLOWED_TABLES:
+            scans.append(detail)
+    return scans
+
+def check(engine) -> dict:
+    with SessionLocal() as db:
+        tournament_id, match_id, user_id = _fixture(db)
+
+    problems = {}
+    for route, (func, args) in route_calls(tournament_id, match_id, user_id).items():
+        with capture_statements(engine) as statements:
+            with SessionLocal() as db:
+                func(db, *args)
+        for statement, parameters in statements:
+            scans = find_scans(engine, statement, parameters)
+            if scans:
+                problems.setdefault(route, []).append((" ".join(statement.split()), scans))
+    return problems
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = init_db("sqlite:///" + os.path.join(tmp, "queryplan.db"))
+        problems = check(engine)
+        engine.dispose()
+
+    for route, items in problems.items():
+        for statement, scans in items:
+            print(f"{route}: {'; '.join(scans)}\n    {statement}")
+    if problems:
+        sys.exit(1)
+    print("No full table scans found")
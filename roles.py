@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import logging
+import threading
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from db import init_db, SessionLocal, Role, run_db
+from config import AUTHORIZED_USERS, ADMIN_USERS, ROLES_REFRESH_SECONDS
+from cache import get_generation, bump_generation
+
+logger = logging.getLogger(__name__)
+
+# Who may use the app ("player") and who manages it ("admin"), by Telegram id.
+# The roles table is the source of truth; every worker keeps it as in-memory
+# sets, so the checks in auth.py are set lookups with no query per request.
+# Writers bump the "roles" generation in their transaction (see cache.py) and
+# reload their own copy at once; other workers compare the generation every
+# ROLES_REFRESH_SECONDS and reload when it moved. On an empty table the
+# AUTHORIZED_USERS and ADMIN_USERS sets from config.py are copied in once.
+
+ROLES = ("player", "admin")
+
+def seed(conn) -> None:
+    # Called by init_db() under the schema lock, which then loads the cache
+    if conn.execute(select(func.count()).select_from(Role)).scalar():
+        return
+    rows = [{"tg_id": tg_id, "role": "player"} for tg_id in AUTHORIZED_USERS]
+    rows += [{"tg_id": tg_id, "role": "admin"} for tg_id in ADMIN_USERS]
+    if rows:
+        conn.execute(sqlite_insert(Role).values(rows).on_conflict_do_nothing())
+        logger.info("Seeded %d roles from config", len(rows))
+
+class RoleCache:
+    def __init__(self):
+        self.generation = None
+        self._members = {role: frozenset() for role in ROLES}
+        self._lock = threading.Lock()
+        self._task = None
+
+    def has(self, tg_id: int, role: str) -> bool:
+        return tg_id in self._members[role]
+
+    def reload(self, db, generation: int = None) -> None:
+        # db is a Session or, from init_db(), a Connection
+        if generation is None:
+            generation = get_generation(db, 'roles')
+        members = {role: set() for role in ROLES}
+        for tg_id, role in db.execute(select(Role.tg_id, Role.role)):
+            members.setdefault(role, set()).add(tg_id)
+        with self._lock:
+            self._members = {role: frozenset(ids) for role, ids in members.items()}
+            self.generation = generation
+        logger.debug("Roles reloaded at generation %s", generation)
+
+    def refresh(self, db: Session) -> bool:
+        # One primary key lookup; reloads only when another worker changed roles
+        generation = get_generation(db, 'roles')
+        if generation == self.generation:
+            return False
+        self.reload(db, generation)
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(ROLES_REFRESH_SECONDS)
+            try:
+                if await run_db(self.refresh):
+                    logger.info("Roles changed, reloaded")
+            except Exception as e:
+                logger.error("Roles refresh failed: %s", e, exc_info=True)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="roles-refresh")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+cache = RoleCache()
+
+def list_roles(db: Session) -> list:
+    return [
+        {"tg_id": tg_id, "role": role, "name": name}
+        for tg_id, role, name in db.execute(select(Role.tg_id, Role.role, Role.name).order_by(Role.role, Role.tg_id))
+    ]
+
+def set_role(db: Session, tg_id: int, role: str, granted: bool, name: str = None) -> bool:
+    # Grants or revokes a role; returns False when nothing changed
+    if role not in ROLES:
+        raise ValueError(f"Unknown role {role!r}")
+    if granted:
+        changed = db.execute(
+            sqlite_insert(Role).values(tg_id=tg_id, role=role, name=name).on_conflict_do_nothing()
+        ).rowcount
+    else:
+        if role == "admin" and db.execute(
+            select(func.count()).select_from(Role).where(Role.role == "admin", Role.tg_id != tg_id)
+        ).scalar() == 0:
+            raise ValueError("The last admin cannot be removed")
+        changed = db.execute(delete(Role).where(Role.tg_id == tg_id, Role.role == role)).rowcount
+    if not changed:
+        return False
+    bump_generation(db, 'roles')
+    db.commit()
+    cache.reload(db)
+    logger.info("Role %s %s for %s", role, "granted" if granted else "revoked", tg_id)
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage player and admin roles")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list")
+    for command in ("grant", "revoke"):
+        command_parser = sub.add_parser(command)
+        command_parser.add_argument("tg_id", type=int)
+        command_parser.add_argument("role", choices=ROLES)
+        command_parser.add_argument("--name", help="note shown in the role list")
+    args = parser.parse_args()
+
+    init_db()
+    with SessionLocal() as session:
+        if args.command == "list":
+            for entry in list_roles(session):
+                print(f"{entry['role']:7} {entry['tg_id']:>12}  {entry['name'] or ''}")
+        else:
+            changed = set_role(session, args.tg_id, args.role, args.command == "grant", args.name)
+            print("updated" if changed else "unchanged")
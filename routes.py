@@ -1,67 +1,86 @@
-from fastapi import APIRouter, HTTPException, Request, Depends
-from fastapi.responses import HTMLResponse, JSONResponse
-from datetime import datetime
-from sqlalchemy.orm import Session, aliased
+import logging
+from fastapi import APIRouter, HTTPException, Request, Depends, Query
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from datetime import datetime, timezone
 import json
 
-from db import init_db, Tournament, Team, Match, User, Participation, Bet
-from auth import get_current_user, verify_telegram_data, parse_user_data, create_jwt_token, is_user_admin, is_user_authorized
-from config import logger
+from db import run_db
+from auth import (get_current_user, require_admin, user_from_stream_token, verify_init_data, create_jwt_token,
+                  create_stream_token, is_user_admin, is_user_authorized)
+from config import MATCHES_PAGE_SIZE
+import queries
+import archive
+import bets
+import betstats
+import bulk_import
+import settlement
+import standings
+import sync
+from shell import get_shell
+import metrics
+from budgets import query_budget
+import events
+import notifications
+import admission
+import roles
+from scheduler import scheduler
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-engine = init_db()
+@router.get("/", response_class=HTMLResponse)
+@query_budget(statements=0, kilosteps=0)
+async def index(request: Request):
+    return get_shell().index_response(
+        request.headers.get("accept-encoding"),
+        request.headers.get("if-none-match")
+    )
 
-def get_db():
-    db = Session(engine)
-    try:
-        yield db
-    finally:
-        db.close()
+@router.get("/metrics")
+@query_budget(statements=0, kilosteps=0)
+async def get_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
-@router.get("/", response_class=HTMLResponse)
-async def index():
-    logger.debug("Serving index page")
-    with open("templates/index.html") as f:
-        return f.read()
+async def verified_user(request: Request) -> dict:
+    data = await request.json()
+    init_data = data.get('initData')
+
+    if not init_data:
+        logger.warning("No initData provided in request")
+        raise HTTPException(status_code=400, detail="No initData provided")
+
+    user_data = verify_init_data(init_data)
+    if not user_data:
+        logger.warning("Invalid Telegram data in init request")
+        raise HTTPException(status_code=401, detail="Invalid Telegram data")
+    return user_data
 
-@router.post("/init")
+@router.post("/init", dependencies=[Depends(admission.per_ip("init")), Depends(admission.write_slot)])
+@query_budget(statements=2, kilosteps=5)
 async def init_mini_app(request: Request):
     try:
         logger.debug("Processing mini app initialization request")
-        data = await request.json()
-        init_data = data.get('initData')
-        
-        if not init_data:
-            logger.warning("No initData provided in request")
-            raise HTTPException(status_code=400, detail="No initData provided")
-        
-        is_verified_telegram_user = verify_telegram_data(init_data)
-        if not is_verified_telegram_user:
-            logger.warning("Invalid Telegram data in init request")
-            raise HTTPException(status_code=401, detail="Invalid Telegram data")
-        
-        user_data = parse_user_data(init_data)
-        if not user_data:
-            logger.warning("Missing user in Telegram initData")
-            raise HTTPException(status_code=401, detail="Invalid user data")
-
-        user_id = int(user_data.get("id"))        
-        if not user_id:
-            logger.warning("Missing user ID in Telegram data")
-            raise HTTPException(status_code=401, detail="Invalid user data")
-        
+        user_data = await verified_user(request)
+        user_id = int(user_data["id"])
+
         # Check if user is authorized
         is_authorized = is_user_authorized(user_id)
         is_admin = is_user_admin(user_id)
         # Create JWT token for authorized users
         token = None
         if is_authorized:
-            token = create_jwt_token(user_data)
-            logger.debug(f"Created JWT token for authorized user {user_id}")
-        
-        logger.debug(f"Successfully initialized mini app for user {user_id}")
-        
+            # Resolve the internal user once; routes read it from the token
+            internal_id, tournament_ids = await run_db(queries.upsert_user, user_data)
+            token = create_jwt_token({
+                **user_data,
+                "uid": internal_id,
+                "tournaments": tournament_ids
+            })
+            logger.debug("Created JWT token for authorized user %s", user_id)
+
+        logger.debug("Successfully initialized mini app for user %s", user_id)
+
         return JSONResponse({
             "status": "success",
             "authenticated": is_authorized,
@@ -69,427 +88,597 @@ async def init_mini_app(request: Request):
             "is_admin": is_admin,
             "user_data": user_data
         })
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error processing init request: {str(e)}", exc_info=True)
+        logger.error("Error processing init request: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.post("/add_tournament")
-async def add_tournament(request: Request, db: Session = Depends(get_db)):
+@router.post("/bootstrap", dependencies=[Depends(admission.per_ip("bootstrap")), Depends(admission.write_slot)])
+@query_budget(statements=12, kilosteps=30)
+async def bootstrap(request: Request):
+    # /init plus the first page of every dataset the user's role needs
+    try:
+        user_data = await verified_user(request)
+        user_id = int(user_data["id"])
+        is_authorized = is_user_authorized(user_id)
+        is_admin = is_user_admin(user_id)
+
+        response = {
+            "status": "success",
+            "authenticated": is_authorized,
+            "token": None,
+            "is_admin": is_admin,
+            "user_data": user_data
+        }
+        if is_authorized:
+            data = await run_db(queries.bootstrap, user_data, is_admin)
+            response["token"] = create_jwt_token({
+                **user_data,
+                "uid": data.pop("uid"),
+                "tournaments": data.pop("tournament_ids")
+            })
+            response.update(data)
+
+        return JSONResponse({"success": True, **response})
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error processing bootstrap request: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/add_tournament", dependencies=[Depends(require_admin), Depends(admission.write_slot)])
+@query_budget(statements=2, kilosteps=5)
+async def add_tournament(request: Request):
     try:
         data = await request.json()
         tournament_name = data.get('name_ru')
-        
+
         if not tournament_name:
             raise HTTPException(status_code=400, detail="Tournament name is required")
-        
-        # Create new tournament
-        tournament = Tournament(name_ru=tournament_name)
-        db.add(tournament)
-        db.commit()
-        db.refresh(tournament)
-        
+
+        # Create new tournament, optionally with its own scoring rules
+        tournament_id = await run_db(queries.create_tournament, tournament_name, data.get('scoring'))
+
         return JSONResponse({
             "success": True,
-            "tournament_id": tournament.id
+            "tournament_id": tournament_id
         })
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error adding tournament: {str(e)}", exc_info=True)
+        logger.error("Error adding tournament: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.post("/add_match")
-async def add_match(request: Request, db: Session = Depends(get_db)):
+@router.post("/add_match", dependencies=[Depends(require_admin), Depends(admission.write_slot)])
+@query_budget(statements=5, kilosteps=5)
+async def add_match(request: Request):
     try:
         data = await request.json()
         tournament_id = data.get('tournament_id')
         team_1_id = data.get('team_1_id')
         team_2_id = data.get('team_2_id')
         match_date = data.get('date')
-        
+
         if not all([tournament_id, team_1_id, team_2_id, match_date]):
             raise HTTPException(status_code=400, detail="All fields are required")
-        
-        # Get tournament by ID
-        tournament = db.query(Tournament).filter(Tournament.id == tournament_id).first()
-        if not tournament:
-            raise HTTPException(status_code=404, detail="Tournament not found")
-        
-        # Get teams by ID
-        team1 = db.query(Team).filter(Team.id == team_1_id).first()
-        if not team1:
-            raise HTTPException(status_code=404, detail="Team 1 not found")
-            
-        team2 = db.query(Team).filter(Team.id == team_2_id).first()
-        if not team2:
-            raise HTTPException(status_code=404, detail="Team 2 not found")
-        
+
         # Create match
-        match = Match(
-            tournament_id=tournament.id,
-            team_1_id=team1.id,
-            team_2_id=team2.id,
-            start_time_utc=datetime.fromisoformat(match_date.replace('Z', '+00:00'))
+        start_time_utc = datetime.fromisoformat(match_date.replace('Z', '+00:00'))
+        if start_time_utc.tzinfo is not None:
+            start_time_utc = start_time_utc.astimezone(timezone.utc).replace(tzinfo=None)
+
+        match_id = await run_db(
+            queries.create_match,
+            tournament_id,
+            team_1_id,
+            team_2_id,
+            start_time_utc
         )
-        db.add(match)
-        db.commit()
-        db.refresh(match)
-        
+        scheduler.schedule(match_id, start_time_utc)
+        events.bus.publish("match", {"match_id": match_id, "tournament_id": int(tournament_id)},
+                           tournament_id=int(tournament_id))
+
         return JSONResponse({
             "success": True,
-            "match_id": match.id
+            "match_id": match_id
         })
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error adding match: {str(e)}", exc_info=True)
+        logger.error("Error adding match: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/tournaments")
-async def get_tournaments(db: Session = Depends(get_db)):
+@router.post("/finish-match", dependencies=[Depends(admission.write_slot)])
+@query_budget(statements=9, kilosteps=20)
+async def finish_match(request: Request, user: dict = Depends(require_admin)):
     try:
-        tournaments = db.query(Tournament).all()
+        data = await request.json()
+        match_id = data.get('match_id')
+        score_1 = data.get('score_1')
+        score_2 = data.get('score_2')
+
+        if match_id is None or score_1 is None or score_2 is None:
+            raise HTTPException(status_code=400, detail="match_id, score_1 and score_2 are required")
+
+        result = await run_db(settlement.settle_match, int(match_id), int(score_1), int(score_2))
+        events.bus.publish("match", {"match_id": result["match_id"], "tournament_id": result["tournament_id"]},
+                           tournament_id=result["tournament_id"])
+        # Results and points go out to the bettors from the queue, not from here
+        notifications.dispatcher.wake()
+
         return JSONResponse({
             "success": True,
-            "tournaments": [{"id": t.id, "name_ru": t.name_ru} for t in tournaments]
+            **result
         })
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error getting tournaments: {str(e)}", exc_info=True)
+        logger.error("Error finishing match: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/teams")
-async def get_teams(db: Session = Depends(get_db)):
+@router.post("/scoring-rules", dependencies=[Depends(admission.write_slot)])
+@query_budget(statements=3, kilosteps=5)
+async def update_scoring_rules(request: Request, user: dict = Depends(require_admin)):
+    try:
+        data = await request.json()
+        tournament_id = data.get('tournament_id')
+
+        if not tournament_id:
+            raise HTTPException(status_code=400, detail="Tournament ID is required")
+
+        scoring = await run_db(settlement.set_scoring_rule, int(tournament_id), data)
+
+        return JSONResponse({
+            "success": True,
+            "scoring": scoring
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error updating scoring rules: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/archive-tournament", dependencies=[Depends(admission.write_slot)])
+@query_budget(statements=18, kilosteps=600)
+async def archive_tournament(request: Request, user: dict = Depends(require_admin)):
+    # Moves the rows only: VACUUM would stall every writer while it rewrites
+    # the file, so compaction is left to `python archive.py compact`
     try:
-        teams = db.query(Team).all()
+        data = await request.json()
+        tournament_id = data.get('tournament_id')
+
+        if not tournament_id:
+            raise HTTPException(status_code=400, detail="Tournament ID is required")
+
+        result = await run_db(archive.archive_tournament, int(tournament_id))
+        # Participants' clients reload through /sync, admins drop its pending requests
+        events.bus.publish("match", {"tournament_id": result["tournament_id"]}, tournament_id=result["tournament_id"])
+        events.bus.publish("participations_changed", admins=True)
+
         return JSONResponse({
             "success": True,
-            "teams": [{"id": t.id, "name_ru": t.name_ru} for t in teams]
+            **result
         })
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error getting teams: {str(e)}", exc_info=True)
+        logger.error("Error archiving tournament: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.post("/add_team")
-async def add_team(request: Request, db: Session = Depends(get_db)):
+@router.post("/import", dependencies=[Depends(admission.write_slot)])
+@query_budget(statements=14, kilosteps=50)
+async def import_data(request: Request, format: str = "ndjson", dry_run: bool = False,
+                      user: dict = Depends(require_admin)):
+    try:
+        if format not in ("ndjson", "csv"):
+            raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+
+        try:
+            records, errors = await bulk_import.read_records(request.stream(), format)
+        except bulk_import.ImportTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+
+        report, status_code = await run_db(bulk_import.import_records, records, errors, dry_run)
+        if report["matches"] and not dry_run and status_code == 200:
+            await scheduler.reload()
+        for tournament_id in report.pop("tournament_ids", ()):
+            events.bus.publish("match", {"tournament_id": tournament_id}, tournament_id=tournament_id)
+        return JSONResponse(report, status_code=status_code)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error importing data: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+def cached_response(etag: str, body: bytes = None, data: dict = None) -> Response:
+    # no-cache: the webview may keep the copy but has to revalidate with If-None-Match
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if body is None and data is None:
+        return Response(status_code=304, headers=headers)
+    if body is None:
+        return JSONResponse(data, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@router.get("/tournaments")
+@query_budget(statements=2, kilosteps=5)
+async def get_tournaments(request: Request):
+    try:
+        etag, body = await run_db(queries.get_reference_listing, 'tournaments', request.headers.get('if-none-match'))
+        return cached_response(etag, body)
+    except Exception as e:
+        logger.error("Error getting tournaments: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/teams")
+@query_budget(statements=2, kilosteps=5)
+async def get_teams(request: Request):
+    try:
+        etag, body = await run_db(queries.get_reference_listing, 'teams', request.headers.get('if-none-match'))
+        return cached_response(etag, body)
+    except Exception as e:
+        logger.error("Error getting teams: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/add_team", dependencies=[Depends(require_admin), Depends(admission.write_slot)])
+@query_budget(statements=2, kilosteps=5)
+async def add_team(request: Request):
     try:
         data = await request.json()
         team_name = data.get('name_ru')
-        
+
         if not team_name:
             raise HTTPException(status_code=400, detail="Team name is required")
-        
+
         # Create new team
-        team = Team(name_ru=team_name)
-        db.add(team)
-        db.commit()
-        db.refresh(team)
-        
+        team_id = await run_db(queries.create_team, team_name)
+
         return JSONResponse({
             "success": True,
-            "team_id": team.id
+            "team_id": team_id
         })
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error adding team: {str(e)}", exc_info=True)
+        logger.error("Error adding team: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/available-tournaments")
-async def get_available_tournaments(db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+@query_budget(statements=3, kilosteps=5)
+async def get_available_tournaments(request: Request, user: dict = Depends(get_current_user)):
     try:
-        # Get tournaments where user is not already participating
-        db_user = db.query(User).filter(User.tg_id == user['id']).first()
-        if not db_user:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        existing_participations = db.query(Participation.tournament_id).filter(
-            Participation.user_id == db_user.id
-        ).all()
-        existing_tournament_ids = [p[0] for p in existing_participations]
-
-        available_tournaments = db.query(Tournament).filter(
-            ~Tournament.id.in_(existing_tournament_ids)
-        ).all()
-
-        return JSONResponse({
+        etag, tournaments = await run_db(
+            queries.list_available_tournaments, user['uid'], request.headers.get('if-none-match')
+        )
+        if tournaments is None:
+            return cached_response(etag)
+        return cached_response(etag, data={
             "success": True,
-            "tournaments": [{"id": t.id, "name_ru": t.name_ru} for t in available_tournaments]
+            "tournaments": tournaments
         })
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error getting available tournaments: {str(e)}", exc_info=True)
+        logger.error("Error getting available tournaments: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.post("/participate")
-async def participate_in_tournament(request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+@router.post("/participate", dependencies=[Depends(admission.per_user("participate")), Depends(admission.write_slot)])
+@query_budget(statements=3, kilosteps=5)
+async def participate_in_tournament(request: Request, user: dict = Depends(get_current_user)):
     try:
         data = await request.json()
         tournament_id = data.get('tournament_id')
-        
+
         if not tournament_id:
             raise HTTPException(status_code=400, detail="Tournament ID is required")
-        
-        # Get or create user
-        db_user = db.query(User).filter(User.tg_id == user['id']).first()
-        if not db_user:
-            db_user = User(
-                tg_id=user['id'],
-                name=user.get('first_name', '') + ' ' + user.get('last_name', '')
-            )
-            db.add(db_user)
-            db.commit()
-            db.refresh(db_user)
-        
-        # Check if already participating
-        existing = db.query(Participation).filter(
-            Participation.user_id == db_user.id,
-            Participation.tournament_id == tournament_id
-        ).first()
-        
-        if existing:
-            raise HTTPException(status_code=400, detail="Already participating in this tournament")
-        
-        # Create participation
-        participation = Participation(
-            user_id=db_user.id,
-            tournament_id=tournament_id,
-            approved=False
-        )
-        db.add(participation)
-        db.commit()
-        
+
+        await run_db(queries.create_participation, user['uid'], tournament_id)
+        events.bus.publish("participation_requested", {"tournament_id": int(tournament_id)}, admins=True)
+
         return JSONResponse({
             "success": True,
             "message": "Participation request submitted"
         })
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error participating in tournament: {str(e)}", exc_info=True)
+        logger.error("Error participating in tournament: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/pending-participations")
-async def get_pending_participations(db: Session = Depends(get_db)):
+@router.get("/pending-participations", dependencies=[Depends(require_admin)])
+@query_budget(statements=1, kilosteps=10)
+async def get_pending_participations():
     try:
-        # Get pending participations with user and tournament info
-        participations = db.query(
-            Participation,
-            User.name.label('user_name'),
-            Tournament.name_ru.label('tournament_name')
-        ).join(
-            User, Participation.user_id == User.id
-        ).join(
-            Tournament, Participation.tournament_id == Tournament.id
-        ).filter(
-            Participation.approved == False
-        ).all()
-        
+        participations = await run_db(queries.list_pending_participations)
         return JSONResponse({
             "success": True,
-            "participations": [
-                {
-                    "id": p.Participation.id,
-                    "user_name": p.user_name,
-                    "tournament_name": p.tournament_name
-                }
-                for p in participations
-            ]
+            "participations": participations
         })
     except Exception as e:
-        logger.error(f"Error getting pending participations: {str(e)}", exc_info=True)
+        logger.error("Error getting pending participations: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.post("/approve-participation")
-async def approve_participation(request: Request, db: Session = Depends(get_db)):
+@router.post("/approve-participation", dependencies=[Depends(require_admin), Depends(admission.write_slot)])
+@query_budget(statements=6, kilosteps=5)
+async def approve_participation(request: Request):
     try:
         data = await request.json()
         participation_id = data.get('participation_id')
-        
+
         if not participation_id:
             raise HTTPException(status_code=400, detail="Participation ID is required")
-        
-        # Update participation
-        participation = db.query(Participation).filter(Participation.id == participation_id).first()
-        if not participation:
-            raise HTTPException(status_code=404, detail="Participation not found")
-        
-        participation.approved = True
-        db.commit()
-        
+
+        approved = await run_db(queries.approve_participation, participation_id)
+        if approved is None:
+            return JSONResponse({
+                "success": True,
+                "message": "Participation already approved"
+            })
+        events.bus.grant(approved["user_id"], approved["tournament_id"])
+        events.bus.publish("participation_approved", {"tournament_id": approved["tournament_id"]},
+                           user_id=approved["user_id"])
+        events.bus.publish("participations_changed", admins=True)
+        notifications.dispatcher.wake()
+
         return JSONResponse({
             "success": True,
             "message": "Participation approved"
         })
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error approving participation: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/roles", dependencies=[Depends(require_admin)])
+@query_budget(statements=1, kilosteps=5)
+async def get_roles():
+    try:
+        return JSONResponse({
+            "success": True,
+            "roles": await run_db(roles.list_roles)
+        })
+    except Exception as e:
+        logger.error("Error listing roles: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/roles", dependencies=[Depends(require_admin), Depends(admission.write_slot)])
+@query_budget(statements=5, kilosteps=5)
+async def update_role(request: Request):
+    # {"tg_id": ..., "role": "player" | "admin", "granted": true | false, "name": optional note}
+    try:
+        data = await request.json()
+        tg_id = data.get('tg_id')
+        role = data.get('role')
+        if tg_id is None or role not in roles.ROLES:
+            raise HTTPException(status_code=400, detail="tg_id and role (player or admin) are required")
+
+        try:
+            changed = await run_db(roles.set_role, int(tg_id), role, bool(data.get('granted', True)), data.get('name'))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return JSONResponse({
+            "success": True,
+            "changed": changed
+        })
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error approving participation: {str(e)}", exc_info=True)
+        logger.error("Error updating role: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/bet-stats")
+@query_budget(statements=4, kilosteps=5)
+async def get_bet_stats(match_id: int, user: dict = Depends(get_current_user)):
+    # How the tournament's players bet on a match, available from kickoff
+    try:
+        tournament_id, stats = await run_db(betstats.get_stats, match_id)
+        if tournament_id is None:
+            raise HTTPException(status_code=404, detail="Match not found")
+        # The token's tournaments first, the DB only for ones approved after it was issued
+        if (tournament_id not in user.get('tournaments', ()) and not is_user_admin(user['id'])
+                and tournament_id not in await run_db(queries.approved_tournament_ids, user['uid'])):
+            raise HTTPException(status_code=403, detail="User is not participating in this tournament")
+        if stats is None:
+            raise HTTPException(status_code=409, detail="Bet statistics are available after kickoff")
+
+        return JSONResponse({"success": True, **stats})
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error getting bet statistics: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/standings")
+@query_budget(statements=3, kilosteps=5)
+async def get_standings(tournament_id: int, limit: int = 20, user: dict = Depends(get_current_user)):
+    try:
+        result = await run_db(standings.get_standings, tournament_id, user['uid'], min(max(limit, 1), 100))
+        return JSONResponse({
+            "success": True,
+            **result
+        })
+    except Exception as e:
+        logger.error("Error getting standings: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/archived-tournaments")
+@query_budget(statements=2, kilosteps=5)
+async def get_archived_tournaments(user: dict = Depends(get_current_user)):
+    try:
+        tournaments = await run_db(archive.list_archives)
+        return JSONResponse({
+            "success": True,
+            "tournaments": tournaments
+        })
+    except Exception as e:
+        logger.error("Error getting archived tournaments: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/archived-standings")
+@query_budget(statements=2, kilosteps=5)
+async def get_archived_standings(tournament_id: int, limit: int = 20, user: dict = Depends(get_current_user)):
+    try:
+        result = await run_db(archive.get_standings, tournament_id, user['uid'], min(max(limit, 1), 100))
+        if result is None:
+            raise HTTPException(status_code=404, detail="Archived tournament not found")
+        return JSONResponse({
+            "success": True,
+            **result
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error getting archived standings: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/archived-matches")
+@query_budget(statements=1, kilosteps=20)
+async def get_archived_matches(tournament_id: int, user: dict = Depends(get_current_user)):
+    try:
+        matches = await run_db(archive.list_matches, tournament_id, user['uid'])
+        return JSONResponse({
+            "success": True,
+            "tournament_id": tournament_id,
+            "matches": matches
+        })
+    except Exception as e:
+        logger.error("Error getting archived matches: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+def match_page_params(
+    cursor: str = None,
+    date_from: datetime = Query(None, alias="from"),
+    date_to: datetime = Query(None, alias="to"),
+    tournament_id: int = None,
+    limit: int = MATCHES_PAGE_SIZE,
+) -> dict:
+    # Timestamps are stored as naive UTC
+    if date_from is not None and date_from.tzinfo is not None:
+        date_from = date_from.astimezone(timezone.utc).replace(tzinfo=None)
+    if date_to is not None and date_to.tzinfo is not None:
+        date_to = date_to.astimezone(timezone.utc).replace(tzinfo=None)
+    return {
+        "cursor": cursor,
+        "date_from": date_from,
+        "date_to": date_to,
+        "tournament_id": tournament_id,
+        "limit": limit,
+    }
+
 @router.get("/user-matches")
-async def get_user_matches(db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+@query_budget(statements=2, kilosteps=20)
+async def get_user_matches(page: dict = Depends(match_page_params), user: dict = Depends(get_current_user)):
+    try:
+        matches, next_cursor, version = await run_db(queries.list_user_matches, user['uid'], **page)
+        logger.debug("User %s matches page: %d matches", user['uid'], len(matches))
+
+        return JSONResponse({
+            "success": True,
+            "matches": matches,
+            "next_cursor": next_cursor,
+            "version": version
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error getting user matches and bets: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/sync")
+@query_budget(statements=4, kilosteps=10)
+async def sync_matches(since: int = 0, user: dict = Depends(get_current_user)):
     try:
-        Team1 = aliased(Team)
-        Team2 = aliased(Team)
-
-        matches = db.query(
-            Match,
-            Tournament.name_ru.label('tournament_name'),
-            Team1.name_ru.label('team_1_name'),
-            Team2.name_ru.label('team_2_name'),
-            Bet.score_1.label('bet_score_1'),
-            Bet.score_2.label('bet_score_2'),
-            Bet.points
-        ).join(
-            Tournament, Match.tournament_id == Tournament.id
-        ).join(
-            Participation, 
-            (Participation.tournament_id == Match.tournament_id) & 
-            (Participation.approved == True)
-        ).join(
-            User,
-            (User.id == Participation.user_id) &
-            (User.tg_id == user["id"])
-        ).join(
-            Team1, Match.team_1_id == Team1.id
-        ).join(
-            Team2, Match.team_2_id == Team2.id
-        ).outerjoin(
-            Bet, (Bet.match_id == Match.id) & (Bet.user_id == user['id'])
-        ).all()
-        logger.debug(f"matches {matches}")
-        
-        # Формируем ответ
-        matches_data = []
-        for match, tournament_name, team1_name, team2_name, bet_score_1, bet_score_2, points in matches:
-            match_data = {
-                'id': match.id,
-                'tournament_name': tournament_name,
-                'team_1_name': team1_name,
-                'team_2_name': team2_name,
-                'date': match.start_time_utc.isoformat(),
-                'score_1': match.score_1,
-                'score_2': match.score_2,
-                'bet': {
-                    'score_1': bet_score_1,
-                    'score_2': bet_score_2,
-                    'points': points
-                } if bet_score_1 is not None else None
-            }
-            matches_data.append(match_data)
-        
+        result = await run_db(sync.changes_since, user['uid'], since)
         return JSONResponse({
             "success": True,
-            "matches": matches_data
+            **result
         })
     except Exception as e:
-        logger.error(f"Error getting user matches and bets: {str(e)}", exc_info=True)
+        logger.error("Error syncing matches: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/events-token")
+@query_budget(statements=0, kilosteps=0)
+async def get_events_token(user: dict = Depends(get_current_user)):
+    # The session JWT never goes into a URL, /events is opened with this one
+    return JSONResponse({
+        "success": True,
+        "token": create_stream_token(user)
+    })
+
+@router.get("/events")
+@query_budget(statements=1, kilosteps=5)
+async def stream_events(token: str):
+    # EventSource cannot send an Authorization header, a stream token from
+    # /events-token comes in the query string instead
+    user = user_from_stream_token(token)
+    tournament_ids = await run_db(queries.approved_tournament_ids, user['uid'])
+    return StreamingResponse(
+        events.stream(user['uid'], tournament_ids, is_user_admin(user['id'])),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @router.get("/pending-matches")
-async def get_pending_matches(db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+@query_budget(statements=1, kilosteps=10)
+async def get_pending_matches(page: dict = Depends(match_page_params), user: dict = Depends(require_admin)):
     try:
-        Team1 = aliased(Team)
-        Team2 = aliased(Team)
-
-        matches = db.query(
-            Match,
-            Tournament.name_ru.label('tournament_name'),
-            Team1.name_ru.label('team_1_name'),
-            Team2.name_ru.label('team_2_name')
-        ).join(
-            Tournament, Match.tournament_id == Tournament.id
-        ).join(
-            Team1, Match.team_1_id == Team1.id
-        ).join(
-            Team2, Match.team_2_id == Team2.id
-        ).all()
-        logger.debug(f"matches {matches}")
-        
-        # Формируем ответ
-        matches_data = []
-        for match, tournament_name, team1_name, team2_name in matches:
-            match_data = {
-                'id': match.id,
-                'tournament_name': tournament_name,
-                'team_1_name': team1_name,
-                'team_2_name': team2_name,
-                'date': match.start_time_utc.isoformat(),
-                'score_1': match.score_1,
-                'score_2': match.score_2,
-            }
-            matches_data.append(match_data)
-        
+        matches, next_cursor = await run_db(queries.list_pending_matches, **page)
+        logger.debug("Pending matches page: %d matches", len(matches))
+
         return JSONResponse({
             "success": True,
-            "matches": matches_data
+            "matches": matches,
+            "next_cursor": next_cursor
         })
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error getting user matches and bets: {str(e)}", exc_info=True)
+        logger.error("Error getting user matches and bets: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.post("/place-bet")
-async def place_bet(request: Request, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+@router.post("/place-bet", dependencies=[Depends(admission.per_user("place_bet")), Depends(admission.write_slot)])
+@query_budget(statements=6, kilosteps=5)
+async def place_bet(request: Request, user: dict = Depends(get_current_user)):
     try:
         data = await request.json()
-        logger.debug(f"data {data}")
-        match_id = data.get('match_id')
-        score_1 = int(data.get('score_1'))
-        score_2 = int(data.get('score_2'))
-        
-        if not all([match_id, score_1 is not None, score_2 is not None]):
-            logger.debug(f"Missing required fields")
+        logger.debug("Bet from user %s on match %s", user['uid'], data.get('match_id'), extra={"sample_rate": 0.1})
+        # Same validation as /place-bets
+        try:
+            match_id, score_1, score_2 = bets.parse_bet(data)
+        except ValueError as e:
+            logger.debug("Invalid bet: %s", e)
             return JSONResponse({
                 "success": False,
-                "error": "Missing required fields"
+                "error": str(e)
             }, status_code=400)
-        
-        # Проверяем, что матч еще не начался
-        match = db.query(Match).filter(Match.id == match_id).first()
-        logger.debug(f"match {match}")
-        if not match:
-            return JSONResponse({
-                "success": False,
-                "error": "Match not found"
-            }, status_code=404)
-        
-        if match.start_time_utc <= datetime.now():
-            logger.debug(f"Cannot place bet on started match")
-            return JSONResponse({
-                "success": False,
-                "error": "Cannot place bet on started match"
-            }, status_code=400)
-        
-        # Проверяем, что пользователь участвует в турнире
-        participation = db.query(
-            Participation
-        ).join(
-            User, 
-            (Participation.user_id == User.id) & 
-            (User.tg_id == user["id"])
-        ).filter(
-            Participation.tournament_id == match.tournament_id,
-            Participation.approved == True
-        ).first()
-        
-        if not participation:
-            return JSONResponse({
-                "success": False,
-                "error": "User is not participating in this tournament"
-            }, status_code=403)
-        
-        # Создаем или обновляем ставку
-        bet = db.query(Bet).filter(
-            Bet.user_id == user['id'],
-            Bet.match_id == match_id
-        ).first()
-        
-        if bet:
-            bet.score_1 = score_1
-            bet.score_2 = score_2
-        else:
-            bet = Bet(
-                user_id=user['id'],
-                match_id=match_id,
-                score_1=score_1,
-                score_2=score_2
-            )
-            db.add(bet)
-        
-        db.commit()
-        return JSONResponse({
-            "success": True
-        })
+
+        result, status_code = await run_db(queries.save_bet, user, match_id, score_1, score_2)
+        if status_code == 200:
+            # Other open devices of the same user
+            events.bus.publish("bet", {"match_id": match_id}, user_id=user['uid'])
+        return JSONResponse(result, status_code=status_code)
+    except Exception as e:
+        logger.error("Error placing bet: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/place-bets", dependencies=[Depends(admission.per_user("place_bets")), Depends(admission.write_slot)])
+@query_budget(statements=9, kilosteps=10)
+async def place_bets(request: Request, user: dict = Depends(get_current_user)):
+    try:
+        data = await request.json()
+        idempotency_key = request.headers.get('idempotency-key') or data.get('idempotency_key')
+
+        result, status_code = await run_db(bets.save_bets, user, data.get('bets'), idempotency_key)
+        saved = [item["match_id"] for item in result.get("results", ()) if item["success"]]
+        if saved:
+            events.bus.publish("bet", {"match_ids": saved}, user_id=user['uid'])
+        return JSONResponse(result, status_code=status_code)
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error placing bet: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        logger.error("Error placing bets: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,128 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from db import Match, run_db
+from config import SCHEDULER_RELOAD_SECONDS, MATCH_REMINDER_MINUTES
+import events
+import notifications
+import sync
+
+logger = logging.getLogger(__name__)
+
+# Locks betting at kickoff. The scheduler keeps a heap of the kickoff times of
+# unlocked matches and sleeps until the earliest one; then a single UPDATE
+# locks every match that is due, records sync changes and the transition is
+# published on the event bus. The heap is rebuilt from the
+# ix_matches_locked_start index on startup and every SCHEDULER_RELOAD_SECONDS,
+# which also picks up matches created by other workers or scripts. Several
+# workers may run it at once: the UPDATE only touches still unlocked rows, so
+# each transition is recorded once and published by the worker that won, whose
+# bus relays it to the others (events.py). The heap also holds the reminder time of
+# every match not reminded yet, MATCH_REMINDER_MINUTES before kickoff, when the
+# "betting closes soon" notifications are queued (notifications.py).
+
+def load_kickoffs(db: Session) -> list:
+    return db.execute(
+        select(Match.start_time_utc, Match.id, Match.reminded)
+        .where(Match.locked == False)
+        .order_by(Match.start_time_utc)
+    ).all()
+
+def _wake_times(match_id: int, start_time_utc: datetime, reminded: bool = False) -> list:
+    times = [(start_time_utc, match_id)]
+    if not reminded:
+        times.append((start_time_utc - timedelta(minutes=MATCH_REMINDER_MINUTES), match_id))
+    return times
+
+def lock_due_matches(db: Session, now: datetime = None) -> list:
+    # Returns (match id, tournament id) of the matches locked by this call
+    now = now or datetime.utcnow()
+    locked = db.execute(
+        update(Match)
+        .where(Match.locked == False, Match.start_time_utc <= now)
+        .values(locked=True)
+        .returning(Match.id, Match.tournament_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    for match_id, tournament_id in locked:
+        sync.record_change(db, 'match', match_id, tournament_id=tournament_id)
+    db.commit()
+    return locked
+
+class KickoffScheduler:
+    def __init__(self):
+        self._heap = []  # (start_time_utc, match_id)
+        self._wakeup = None  # created in start(), on the loop it belongs to
+        self._task = None
+
+    def schedule(self, match_id: int, start_time_utc: datetime) -> None:
+        # Called by writers on the event loop when a match is created or moved
+        if self._task is None:
+            return
+        for entry in _wake_times(match_id, start_time_utc):
+            heapq.heappush(self._heap, entry)
+        self._wakeup.set()
+
+    async def reload(self) -> None:
+        self._heap = [entry for start, match_id, reminded in await run_db(load_kickoffs)
+                      for entry in _wake_times(match_id, start, reminded)]
+        heapq.heapify(self._heap)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _lock_due(self) -> None:
+        now = datetime.utcnow()
+        while self._heap and self._heap[0][0] <= now:
+            heapq.heappop(self._heap)
+        if await run_db(notifications.remind_due_matches, now):
+            notifications.dispatcher.wake()
+        for match_id, tournament_id in await run_db(lock_due_matches, now):
+            events.bus.publish("match", {"match_id": match_id, "tournament_id": tournament_id, "locked": True},
+                               tournament_id=tournament_id)
+            logger.info("Betting locked for match %s", match_id)
+
+    async def _run(self) -> None:
+        await self.reload()
+        reload_at = asyncio.get_running_loop().time() + SCHEDULER_RELOAD_SECONDS
+        while True:
+            try:
+                await self._lock_due()
+
+                timeout = reload_at - asyncio.get_running_loop().time()
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - datetime.utcnow()).total_seconds())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+
+                if asyncio.get_running_loop().time() >= reload_at:
+                    await self.reload()
+                    reload_at = asyncio.get_running_loop().time() + SCHEDULER_RELOAD_SECONDS
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Kickoff scheduler error: %s", e, exc_info=True)
+                await asyncio.sleep(5)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run(), name="kickoff-scheduler")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+scheduler = KickoffScheduler()
@@ -0,0 +1,85 @@
+import logging
+from fastapi import HTTPException
+from sqlalchemy import case, literal, update
+from sqlalchemy.orm import Session
+
+from db import Match, Bet, ScoringRule
+from config import DEFAULT_SCORING
+import notifications
+import standings
+import sync
+
+logger = logging.getLogger(__name__)
+
+SCORING_KEYS = ("exact_score", "goal_difference", "outcome")
+
+def get_scoring_rule(db: Session, tournament_id: int) -> dict:
+    rule = db.get(ScoringRule, tournament_id)
+    if rule is None:
+        return dict(DEFAULT_SCORING)
+    return {key: getattr(rule, key) for key in SCORING_KEYS}
+
+def set_scoring_rule(db: Session, tournament_id: int, scoring: dict) -> dict:
+    values = get_scoring_rule(db, tournament_id)
+    values.update({key: float(scoring[key]) for key in SCORING_KEYS if key in scoring})
+    db.merge(ScoringRule(tournament_id=tournament_id, **values))
+    db.commit()
+    return values
+
+def bet_points_expr(score_1: int, score_2: int, rule: dict):
+    # SQL expression scoring a bet against the final score, evaluated per row by SQLite
+    diff = score_1 - score_2
+    if diff > 0:
+        same_outcome = Bet.score_1 > Bet.score_2
+    elif diff < 0:
+        same_outcome = Bet.score_1 < Bet.score_2
+    else:
+        same_outcome = Bet.score_1 == Bet.score_2
+
+    return case(
+        ((Bet.score_1 == score_1) & (Bet.score_2 == score_2), literal(rule["exact_score"])),
+        ((Bet.score_1 - Bet.score_2) == diff, literal(rule["goal_difference"])),
+        (same_outcome, literal(rule["outcome"])),
+        else_=literal(0.0),
+    )
+
+def settle_match(db: Session, match_id: int, score_1: int, score_2: int) -> dict:
+    # Records the result and scores every bet on the match with a single UPDATE,
+    # so the write lock is held for one statement regardless of the number of bets.
+    # Re-running it with a corrected score simply rescores the match; the full
+    # results go out on the first settlement only, a correction sends a short notice.
+    match = db.get(Match, match_id)
+    if not match:
+        raise HTTPException(status_code=404, detail="Match not found")
+    previous = (match.score_1, match.score_2) if match.is_finished else None
+
+    rule = get_scoring_rule(db, match.tournament_id)
+
+    match.score_1 = score_1
+    match.score_2 = score_2
+    match.is_finished = True
+    match.locked = True
+
+    points = bet_points_expr(score_1, score_2, rule)
+    standings.apply_match_delta(db, match.tournament_id, match_id, points)
+
+    result = db.execute(
+        update(Bet)
+        .where(Bet.match_id == match_id)
+        .values(points=points)
+        .execution_options(synchronize_session=False)
+    )
+    standings.rerank(db, match.tournament_id)
+    sync.record_change(db, 'match', match_id, tournament_id=match.tournament_id)
+    if previous is None:
+        notifications.queue_match_results(db, match_id, score_1, score_2)
+    elif previous != (score_1, score_2):
+        notifications.queue_score_correction(db, match_id, score_1, score_2)
+    db.commit()
+
+    logger.info("Settled match %s %s:%s, %s bets scored", match_id, score_1, score_2, result.rowcount)
+    return {
+        "match_id": match_id,
+        "tournament_id": match.tournament_id,
+        "bets_settled": result.rowcount,
+    }
@@ -0,0 +1,137 @@
+import gzip
+import hashlib
+import logging
+import re
+import threading
+
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+from config import SHELL_TEMPLATE_PATH
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# The mini app shell (templates/index.html) is built once per process: inline
+# <style> and <script> blocks are minified and moved to content-hashed assets
+# under /static/shell/, and every file is precompressed in memory. The HTML
+# revalidates through its ETag, the hashed assets are cached forever.
+
+ASSET_PREFIX = "shell/"
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+SHELL_CACHE_CONTROL = "no-cache"
+
+_STYLE_RE = re.compile(r"<style>(.*?)</style>", re.S)
+_INLINE_SCRIPT_RE = re.compile(r"<script>(.*?)</script>", re.S)
+_HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.S)
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+
+class CompressedAsset:
+    def __init__(self, content: bytes, media_type: str):
+        self.media_type = media_type
+        self.etag = '"' + hashlib.sha256(content).hexdigest()[:16] + '"'
+        self.variants = {"identity": content, "gzip": gzip.compress(content, 9)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(content)
+
+    def response(self, accept_encoding: str, if_none_match: str, cache_control: str) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if if_none_match and self.etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        encoding = choose_encoding(accept_encoding, self.variants)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=self.variants[encoding], media_type=self.media_type, headers=headers)
+
+def choose_encoding(accept_encoding: str, available) -> str:
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in ("br", "gzip"):
+        if encoding in available and encoding in accepted:
+            return encoding
+    return "identity"
+
+def minify_css(css: str) -> str:
+    css = _CSS_COMMENT_RE.sub("", css)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+def minify_js(js: str) -> str:
+    # Conservative: drops indentation, blank lines and whole-line // comments only
+    lines = []
+    for line in js.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith("//"):
+            continue
+        lines.append(stripped)
+    return "\n".join(lines)
+
+def minify_html(html: str) -> str:
+    html = _HTML_COMMENT_RE.sub("", html)
+    return "\n".join(line.strip() for line in html.splitlines() if line.strip())
+
+def _asset_name(stem: str, content: bytes, extension: str) -> str:
+    return f"{ASSET_PREFIX}{stem}.{hashlib.sha256(content).hexdigest()[:12]}.{extension}"
+
+class Shell:
+    def __init__(self, template_path: str):
+        with open(template_path, encoding="utf-8") as f:
+            html = f.read()
+
+        self.assets = {}
+
+        def extract_style(found):
+            content = minify_css(found.group(1)).encode()
+            name = _asset_name("app", content, "css")
+            self.assets[name] = CompressedAsset(content, "text/css; charset=utf-8")
+            return f'<link rel="stylesheet" href="/static/{name}">'
+
+        def extract_script(found):
+            content = minify_js(found.group(1)).encode()
+            name = _asset_name("app", content, "js")
+            self.assets[name] = CompressedAsset(content, "application/javascript; charset=utf-8")
+            return f'<script src="/static/{name}"></script>'
+
+        html = _STYLE_RE.sub(extract_style, html)
+        html = _INLINE_SCRIPT_RE.sub(extract_script, html)
+        self.page = CompressedAsset(minify_html(html).encode(), "text/html; charset=utf-8")
+
+        logger.info(
+            "Built mini app shell: %d bytes html, %d gzipped, assets %s",
+            len(self.page.variants['identity']), len(self.page.variants['gzip']), sorted(self.assets)
+        )
+
+    def index_response(self, accept_encoding: str, if_none_match: str) -> Response:
+        return self.page.response(accept_encoding, if_none_match, SHELL_CACHE_CONTROL)
+
+_shell = None
+_shell_lock = threading.Lock()
+
+def get_shell() -> Shell:
+    global _shell
+    if _shell is None:
+        with _shell_lock:
+            if _shell is None:
+                _shell = Shell(SHELL_TEMPLATE_PATH)
+    return _shell
+
+class ShellStaticFiles(StaticFiles):
+    # /static mount that serves the in-memory shell assets before the directory
+    async def get_response(self, path: str, scope) -> Response:
+        asset = get_shell().assets.get(path.replace("\\", "/"))
+        if asset is None:
+            return await super().get_response(path, scope)
+
+        headers = dict((k.decode("latin-1").lower(), v.decode("latin-1")) for k, v in scope["headers"])
+        return asset.response(headers.get("accept-encoding"), headers.get("if-none-match"), ASSET_CACHE_CONTROL)
@@ -0,0 +1,148 @@
+import argparse
+import logging
+
+from sqlalchemy import delete, func, literal, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from db import init_db, SessionLocal, Match, User, Participation, Bet, Standing
+
+logger = logging.getLogger(__name__)
+
+# Materialized leaderboard. Settlement applies per-user point deltas and then
+# re-ranks the tournament once, so reads are plain index lookups on
+# (tournament_id, rank) and the (tournament_id, user_id) primary key.
+
+_RERANK_SQL = text("""
+    UPDATE standings SET rank = ranked.rnk
+    FROM (
+        SELECT user_id, RANK() OVER (ORDER BY points DESC) AS rnk
+        FROM standings
+        WHERE tournament_id = :tournament_id
+    ) AS ranked
+    WHERE standings.tournament_id = :tournament_id
+      AND standings.user_id = ranked.user_id
+      AND standings.rank IS NOT ranked.rnk
+""")
+
+def _upsert_points(select_stmt):
+    # INSERT ... SELECT (tournament_id, user_id, points) adding points to existing rows
+    stmt = sqlite_insert(Standing).from_select(['tournament_id', 'user_id', 'points'], select_stmt)
+    return stmt.on_conflict_do_update(
+        index_elements=['tournament_id', 'user_id'],
+        set_={'points': Standing.points + stmt.excluded.points},
+    )
+
+def rerank(db: Session, tournament_id: int) -> None:
+    db.execute(_RERANK_SQL, {"tournament_id": tournament_id})
+
+def apply_match_delta(db: Session, tournament_id: int, match_id: int, new_points) -> None:
+    # Must run before the bets are updated: the delta is new_points minus the
+    # points currently stored, so rescoring a corrected result is handled too.
+    # Does not commit, the caller owns the transaction.
+    db.execute(_upsert_points(
+        select(
+            literal(tournament_id),
+            Bet.user_id,
+            new_points - func.coalesce(Bet.points, 0.0),
+        ).where(Bet.match_id == match_id)
+    ))
+
+def add_participant(db: Session, tournament_id: int, user_id: int) -> None:
+    # Approved participants appear in the table with zero points before their first result
+    db.execute(
+        sqlite_insert(Standing)
+        .values(tournament_id=tournament_id, user_id=user_id, points=0.0)
+        .on_conflict_do_nothing(index_elements=['tournament_id', 'user_id'])
+    )
+    rerank(db, tournament_id)
+
+def top(db: Session, tournament_id: int, limit: int = 20) -> list:
+    rows = db.execute(
+        select(Standing.rank, Standing.points, User.name)
+        .join(User, User.id == Standing.user_id)
+        .where(Standing.tournament_id == tournament_id)
+        .order_by(Standing.rank, Standing.user_id)
+        .limit(limit)
+    ).all()
+    return [{"rank": rank, "points": points, "user_name": name} for rank, points, name in rows]
+
+def user_position(db: Session, tournament_id: int, user_id: int) -> dict:
+    row = db.execute(
+        select(Standing.rank, Standing.points)
+        .where(Standing.tournament_id == tournament_id, Standing.user_id == user_id)
+    ).first()
+    if row is None:
+        return None
+    return {"rank": row.rank, "points": row.points}
+
+def get_standings(db: Session, tournament_id: int, user_id: int, limit: int = 20) -> dict:
+    total = db.execute(
+        select(func.count()).select_from(Standing).where(Standing.tournament_id == tournament_id)
+    ).scalar()
+    return {
+        "tournament_id": tournament_id,
+        "total": total,
+        "standings": top(db, tournament_id, limit),
+        "me": user_position(db, tournament_id, user_id),
+    }
+
+def rebuild(db: Session, tournament_id: int = None) -> int:
+    count = reconcile(db, tournament_id)
+    db.commit()
+    logger.info("Rebuilt standings for %d tournament(s)", count)
+    return count
+
+def reconcile(db: Session, tournament_id: int = None) -> int:
+    # Refills the table from raw bets of approved participants and returns the
+    # number of tournaments ranked. Does not commit: db may also be the
+    # Connection of a schema migration (migrations.py).
+    participants = select(Participation.tournament_id, Participation.user_id).where(Participation.approved == True)
+    if tournament_id is not None:
+        participants = participants.where(Participation.tournament_id == tournament_id)
+    participants = participants.subquery()
+
+    bet_points = (
+        select(
+            Match.tournament_id.label('tournament_id'),
+            Bet.user_id.label('user_id'),
+            func.sum(Bet.points).label('points'),
+        )
+        .join(Match, Match.id == Bet.match_id)
+        .group_by(Match.tournament_id, Bet.user_id)
+        .subquery()
+    )
+
+    cleanup = delete(Standing)
+    if tournament_id is not None:
+        cleanup = cleanup.where(Standing.tournament_id == tournament_id)
+    db.execute(cleanup)
+
+    db.execute(_upsert_points(
+        select(
+            participants.c.tournament_id,
+            participants.c.user_id,
+            func.coalesce(bet_points.c.points, 0.0),
+        ).outerjoin(
+            bet_points,
+            (bet_points.c.tournament_id == participants.c.tournament_id) &
+            (bet_points.c.user_id == participants.c.user_id)
+        ).where(literal(True))  # keeps SQLite from parsing ON CONFLICT as a join constraint
+    ))
+
+    tournament_ids = db.execute(select(Standing.tournament_id).distinct()).scalars().all()
+    if tournament_id is not None:
+        tournament_ids = [t for t in tournament_ids if t == tournament_id]
+    for t in tournament_ids:
+        rerank(db, t)
+    return len(tournament_ids)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the standings table")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--tournament", type=int, default=None, help="only this tournament")
+    args = parser.parse_args()
+
+    init_db()
+    with SessionLocal() as session:
+        rebuild(session, args.tournament)
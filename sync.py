@@ -0,0 +1,116 @@
+import argparse
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, or_, and_, select
+from sqlalchemy.orm import Session
+
+from db import init_db, SessionLocal, Match, Participation, Change
+from config import SYNC_MAX_CHANGES, CHANGES_RETENTION_DAYS
+import queries
+
+logger = logging.getLogger(__name__)
+
+# Delta sync on top of the changes table. Writers call record_change() inside
+# their own transaction; since SQLite has a single writer, change ids are
+# assigned in commit order and a client only needs the last id it has seen.
+#
+#   entity          entity_id   visible to
+#   'match'         match id    approved participants of tournament_id
+#   'bet'           match id    user_id only
+#   'participation' tournament  user_id only, forces a full reload
+
+def record_change(db: Session, entity: str, entity_id: int, tournament_id: int = None,
+                  user_id: int = None, deleted: bool = False) -> None:
+    # Does not commit, the change becomes visible with the caller's transaction
+    db.add(Change(
+        entity=entity,
+        entity_id=entity_id,
+        tournament_id=tournament_id,
+        user_id=user_id,
+        deleted=deleted,
+    ))
+
+def current_version(db: Session) -> int:
+    return db.execute(select(func.max(Change.id))).scalar() or 0
+
+def changes_since(db: Session, user_id: int, since: int) -> dict:
+    latest = current_version(db)
+    oldest = db.execute(select(func.min(Change.id))).scalar()
+    reset = {"version": latest, "reset": True, "matches": [], "deleted_matches": []}
+
+    # The client missed pruned changes or comes from another database
+    if since > latest or (oldest is not None and since < oldest - 1):
+        return reset
+
+    tournament_ids = db.execute(
+        select(Participation.tournament_id).where(
+            Participation.user_id == user_id,
+            Participation.approved == True
+        )
+    ).scalars().all()
+
+    changes = db.execute(
+        select(Change.id, Change.entity, Change.entity_id, Change.deleted)
+        .where(
+            Change.id > since,
+            or_(
+                Change.user_id == user_id,
+                and_(Change.user_id.is_(None), Change.tournament_id.in_(tournament_ids)),
+            )
+        )
+        .order_by(Change.id)
+        .limit(SYNC_MAX_CHANGES + 1)
+    ).all()
+
+    more = len(changes) > SYNC_MAX_CHANGES
+    if more:
+        changes = changes[:SYNC_MAX_CHANGES]
+        version = changes[-1].id
+    else:
+        version = latest
+
+    # Later changes of the same match win
+    match_state = {}
+    for change in changes:
+        if change.entity == 'participation':
+            return reset
+        match_state[change.entity_id] = change.deleted
+
+    updated_ids = [match_id for match_id, deleted in match_state.items() if not deleted]
+    matches = []
+    if updated_ids:
+        rows = queries.user_matches_query(db, user_id).filter(Match.id.in_(updated_ids)).all()
+        matches = [queries.user_match_data(row) for row in rows]
+
+    return {
+        "version": version,
+        "reset": False,
+        "more": more,
+        "matches": matches,
+        "deleted_matches": [match_id for match_id, deleted in match_state.items() if deleted],
+    }
+
+def prune(db: Session, days: int = CHANGES_RETENTION_DAYS) -> int:
+    # Clients older than the retained window get reset=True and reload everything.
+    # The newest row is always kept so gaps stay detectable.
+    latest = current_version(db)
+    result = db.execute(
+        delete(Change).where(
+            Change.created_at < datetime.utcnow() - timedelta(days=days),
+            Change.id < latest
+        )
+    )
+    db.commit()
+    logger.info("Pruned %s changes older than %s days", result.rowcount, days)
+    return result.rowcount
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the sync change log")
+    parser.add_argument("command", choices=["prune"])
+    parser.add_argument("--days", type=int, default=CHANGES_RETENTION_DAYS)
+    args = parser.parse_args()
+
+    init_db()
+    with SessionLocal() as session:
+        prune(session, args.days)